@@ -1,8 +1,28 @@
-from fastapi import Depends, HTTPException, status, Header
+import os
+import hmac
+import time
+import hashlib
+from collections import namedtuple
+from fastapi import Depends, HTTPException, status, Header, Query
 from sqlalchemy.orm import Session
 from database import get_db
 from models import User
 from datetime import datetime
+from services.cache import TTLCache
+
+# Resolved user data kept in the auth cache (never the ORM object, which is bound to a session)
+CachedUser = namedtuple("CachedUser", ["id", "username", "status", "validade"])
+
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_MAXSIZE = int(os.getenv("AUTH_CACHE_MAXSIZE", "1024"))
+
+# There is no invalidation hook: the cache is per process and nothing in the app deactivates
+# users or rotates keys. After such a change in the database, a cached key keeps working for
+# at most AUTH_CACHE_TTL seconds (status and validade stay as they were when it was cached).
+auth_cache = TTLCache(maxsize=AUTH_CACHE_MAXSIZE, ttl=AUTH_CACHE_TTL)
+
+# Lifetime of the tokens EventSource clients put in the URL (see create_sse_token)
+SSE_TOKEN_TTL = int(os.getenv("SSE_TOKEN_TTL", "120"))
 
 async def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)):
     if not authorization:
@@ -19,16 +39,77 @@ async def get_current_user(authorization: str = Header(None), db: Session = Depe
     
     token = authorization.split(" ")[1]
     
-    # In this simple implementation, the token IS the api_key.
-    # In a JWT implementation, we would decode the token here.
-    user = db.query(User).filter(User.api_key == token).first()
-    
-    if not user:
+    return authenticate_token(token, db)
+
+async def get_current_user_or_sse_token(
+    authorization: str = Header(None),
+    token: str = Query(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Same as get_current_user, but also accepts ?token= for clients that cannot send
+    headers (the browser EventSource used by the SSE endpoints). That token must come from
+    create_sse_token, never the API key itself, which would end up in URLs and access logs.
+    """
+    if token and not authorization:
+        return authenticate_sse_token(token, db)
+    return await get_current_user(authorization, db)
+
+def _sse_signature(api_key: str, user_id: int, expires: int) -> str:
+    return hmac.new(api_key.encode(), f"sse:{user_id}:{expires}".encode(), hashlib.sha256).hexdigest()
+
+def create_sse_token(user_id: int, db: Session) -> str:
+    """
+    Short-lived token that only opens SSE streams: user id and expiry signed with the user's
+    API key, so any worker can verify it and changing the key revokes it.
+    """
+    api_key = db.query(User.api_key).filter(User.id == user_id).scalar()
+    expires = int(time.time()) + SSE_TOKEN_TTL
+    return f"{user_id}.{expires}.{_sse_signature(api_key, user_id, expires)}"
+
+def authenticate_sse_token(token: str, db: Session) -> CachedUser:
+    try:
+        user_id, expires, signature = token.split(".")
+        user_id, expires = int(user_id), int(expires)
+    except ValueError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Token inválido ou usuário não encontrado."
+            detail="Token de eventos inválido."
         )
+
+    if expires < time.time():
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token de eventos expirado. Solicite um novo."
+        )
+
+    api_key = db.query(User.api_key).filter(User.id == user_id).scalar()
+    if not api_key or not hmac.compare_digest(signature, _sse_signature(api_key, user_id, expires)):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token de eventos inválido."
+        )
+
+    # Status and validade checks of the regular API key path
+    return authenticate_token(api_key, db)
+
+def authenticate_token(token: str, db: Session) -> CachedUser:
+    # In this simple implementation, the token IS the api_key.
+    # In a JWT implementation, we would decode the token here.
+    user = auth_cache.get(token)
+    if user is None:
+        db_user = db.query(User).filter(User.api_key == token).first()
+
+        if not db_user:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Token inválido ou usuário não encontrado."
+            )
+        
+        user = CachedUser(db_user.id, db_user.username, db_user.status, db_user.validade)
+        auth_cache.set(token, user)
         
+    # Status and validade are re-checked on every request, cached or not
     if user.status != "Ativo":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -358,3 +358,626 @@ CREATE INDEX IF NOT EXISTS idx_patient_pei_updated_at ON patient_pei(updated_at)
 
 -- Jobs
 CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+
+
+-- MIGRATION: 0012_add_carteirinha_fingerprint.sql --
+
+-- Migration: Carteirinha Fingerprint
+-- Description: Stores a hash of paciente, id_paciente, id_pagamento and status so that
+-- re-imports can compare one value per row and skip the rows that did not change.
+-- Keep carteirinha_fingerprint() in sync with services/carteirinha_service.compute_fingerprint.
+
+CREATE OR REPLACE FUNCTION carteirinha_fingerprint(p_paciente TEXT, p_id_paciente INTEGER, p_id_pagamento INTEGER, p_status TEXT)
+RETURNS TEXT AS $$
+    SELECT md5(concat_ws('|',
+        coalesce(p_paciente, ''),
+        coalesce(p_id_paciente::TEXT, ''),
+        coalesce(p_id_pagamento::TEXT, ''),
+        coalesce(p_status, '')
+    ));
+$$ LANGUAGE sql IMMUTABLE;
+
+ALTER TABLE carteirinhas ADD COLUMN IF NOT EXISTS fingerprint TEXT;
+
+-- Every write path (upload, CRUD routes, temp patients) goes through this trigger
+CREATE OR REPLACE FUNCTION set_carteirinha_fingerprint() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.fingerprint := carteirinha_fingerprint(NEW.paciente, NEW.id_paciente, NEW.id_pagamento, NEW.status);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_carteirinha_fingerprint ON carteirinhas;
+CREATE TRIGGER trigger_carteirinha_fingerprint
+BEFORE INSERT OR UPDATE OF paciente, id_paciente, id_pagamento, status ON carteirinhas
+FOR EACH ROW
+EXECUTE FUNCTION set_carteirinha_fingerprint();
+
+-- Backfill existing rows (only the ones still missing or stale)
+UPDATE carteirinhas
+SET fingerprint = carteirinha_fingerprint(paciente, id_paciente, id_pagamento, status)
+WHERE fingerprint IS DISTINCT FROM carteirinha_fingerprint(paciente, id_paciente, id_pagamento, status);
+
+
+-- MIGRATION: 0013_trigram_search_indexes.sql --
+
+-- Migration: Trigram Search Indexes
+-- Description: Indexes for the search boxes of /carteirinhas and /pei (services/search_service.py).
+-- Free text uses ILIKE '%term%' (pg_trgm GIN); numeric / carteirinha-shaped input uses a
+-- digit-only prefix LIKE 'digits%' (B-tree text_pattern_ops).
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Digit-only normalized carteirinha (0064.8000.400948.00-5 -> 006480004009480005)
+ALTER TABLE carteirinhas
+ADD COLUMN IF NOT EXISTS carteirinha_digits TEXT
+GENERATED ALWAYS AS (regexp_replace(carteirinha, '[^0-9]', '', 'g')) STORED;
+
+-- Free-text (trigram)
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_paciente_trgm ON carteirinhas USING gin (paciente gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_carteirinha_trgm ON carteirinhas USING gin (carteirinha gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_patient_pei_codigo_terapia_trgm ON patient_pei USING gin (codigo_terapia gin_trgm_ops);
+
+-- Identifier prefix lookups
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_digits_prefix ON carteirinhas (carteirinha_digits text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_id_paciente_text ON carteirinhas ((id_paciente::TEXT) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_id_pagamento_text ON carteirinhas ((id_pagamento::TEXT) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_patient_pei_codigo_terapia_prefix ON patient_pei (codigo_terapia text_pattern_ops);
+
+
+-- MIGRATION: 0014_keyset_pagination_indexes.sql --
+
+-- Migration: Keyset Pagination Indexes
+-- Description: Composite indexes matching the sort orders of the list endpoints
+-- (services/pagination.py), so cursor pages are index range scans. NULLs sort first.
+
+-- /carteirinhas: paciente, id
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_paciente_id ON carteirinhas (paciente ASC NULLS FIRST, id ASC);
+
+-- /jobs: priority DESC, created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_jobs_priority_created_id ON jobs (priority DESC, created_at DESC, id DESC);
+
+-- /guias: created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_base_guias_created_id ON base_guias (created_at DESC, id DESC);
+
+-- /api/logs: created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_logs_created_id ON logs (created_at DESC, id DESC);
+
+-- /pei: status, updated_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_patient_pei_status_updated_id ON patient_pei (status ASC NULLS FIRST, updated_at DESC, id DESC);
+
+
+-- MIGRATION: 0015_job_claim_index.sql --
+
+-- Migration: Job Claim Index
+-- Description: Partial index for POST /jobs/claim, which picks pending jobs by
+-- priority DESC, created_at ASC with FOR UPDATE SKIP LOCKED.
+
+CREATE INDEX IF NOT EXISTS idx_jobs_claim_pending ON jobs (priority DESC, created_at ASC, id ASC) WHERE status = 'pending';
+
+
+-- MIGRATION: 0016_job_lease_backoff.sql --
+
+-- Migration: Job Lease Expiry and Retry Backoff
+-- Description: next_attempt_at schedules retries (exponential backoff); the reaper finds
+-- expired leases through the partial index on timeout.
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITH TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_processing_timeout ON jobs (timeout) WHERE status = 'processing';
+
+
+-- MIGRATION: 0017_unique_active_job.sql --
+
+-- Migration: One Active Job per Carteirinha
+-- Description: Removes duplicate pending/processing jobs (keeps the processing one, else
+-- the oldest) and enforces at most one active job per carteirinha with a partial unique index.
+
+DELETE FROM jobs
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id,
+               ROW_NUMBER() OVER (
+                   PARTITION BY carteirinha_id
+                   ORDER BY (status = 'processing') DESC, created_at ASC, id ASC
+               ) AS rn
+        FROM jobs
+        WHERE status IN ('pending', 'processing') AND carteirinha_id IS NOT NULL
+    ) ranked
+    WHERE ranked.rn > 1
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_one_active_per_carteirinha ON jobs (carteirinha_id) WHERE status IN ('pending', 'processing');
+
+
+-- MIGRATION: 0018_guia_ingestion.sql --
+
+-- Migration: Batched Guia Ingestion
+-- Description: Natural key on base_guias (carteirinha_id, guia) so worker results can be
+-- upserted in one statement, and a set-based recompute_patient_pei() that the row
+-- trigger delegates to.
+
+-- 1. PEI computed for a set of (carteirinha_id, codigo_terapia) pairs, same rules as the
+--    original trigger: latest guia by data_autorizacao DESC, id DESC; pei_temp override
+--    wins; otherwise qtde_solicitada / 16, validated when it is a whole number.
+CREATE OR REPLACE FUNCTION patient_pei_computed(p_carteirinha_ids INTEGER[], p_codigos TEXT[])
+RETURNS TABLE (
+    carteirinha_id INTEGER,
+    codigo_terapia TEXT,
+    base_guia_id INTEGER,
+    pei_semanal FLOAT,
+    validade DATE,
+    status TEXT
+) AS $$
+    WITH targets AS (
+        SELECT DISTINCT t.carteirinha_id, t.codigo_terapia
+        FROM unnest(p_carteirinha_ids, p_codigos) AS t(carteirinha_id, codigo_terapia)
+    ),
+    latest AS (
+        SELECT DISTINCT ON (g.carteirinha_id, g.codigo_terapia)
+               g.carteirinha_id, g.codigo_terapia, g.id, g.data_autorizacao, g.qtde_solicitada
+        FROM base_guias g
+        JOIN targets t ON t.carteirinha_id = g.carteirinha_id AND t.codigo_terapia = g.codigo_terapia
+        ORDER BY g.carteirinha_id, g.codigo_terapia, g.data_autorizacao DESC, g.id DESC
+    )
+    SELECT l.carteirinha_id,
+           l.codigo_terapia,
+           l.id,
+           CASE
+               WHEN o.pei_semanal IS NOT NULL THEN o.pei_semanal
+               WHEN l.qtde_solicitada > 0 THEN l.qtde_solicitada::FLOAT / 16.0
+               ELSE 0.0
+           END,
+           (l.data_autorizacao + INTERVAL '180 days')::DATE,
+           CASE
+               WHEN o.pei_semanal IS NOT NULL THEN 'Validado'
+               WHEN l.qtde_solicitada > 0 AND l.qtde_solicitada % 16 = 0 THEN 'Validado'
+               ELSE 'Pendente'
+           END
+    FROM latest l
+    LEFT JOIN pei_temp o ON o.base_guia_id = l.id;
+$$ LANGUAGE sql STABLE;
+
+-- 2. Set-based recompute: UPDATE existing patient_pei rows, INSERT the missing ones.
+--    Returns the number of rows written.
+CREATE OR REPLACE FUNCTION recompute_patient_pei(p_carteirinha_ids INTEGER[], p_codigos TEXT[])
+RETURNS INTEGER AS $$
+DECLARE
+    affected INTEGER;
+BEGIN
+    WITH computed AS (
+        SELECT * FROM patient_pei_computed(p_carteirinha_ids, p_codigos)
+    ),
+    updated AS (
+        UPDATE patient_pei p
+        SET base_guia_id = c.base_guia_id,
+            pei_semanal = c.pei_semanal,
+            validade = c.validade,
+            status = c.status,
+            updated_at = NOW()
+        FROM computed c
+        WHERE p.carteirinha_id = c.carteirinha_id AND p.codigo_terapia = c.codigo_terapia
+        RETURNING 1
+    ),
+    inserted AS (
+        INSERT INTO patient_pei (carteirinha_id, codigo_terapia, base_guia_id, pei_semanal, validade, status, updated_at)
+        SELECT c.carteirinha_id, c.codigo_terapia, c.base_guia_id, c.pei_semanal, c.validade, c.status, NOW()
+        FROM computed c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM patient_pei p
+            WHERE p.carteirinha_id = c.carteirinha_id AND p.codigo_terapia = c.codigo_terapia
+        )
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM updated) + (SELECT COUNT(*) FROM inserted) INTO affected;
+
+    RETURN affected;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 3. Row trigger now delegates to recompute_patient_pei.
+CREATE OR REPLACE FUNCTION calculate_patient_pei() RETURNS TRIGGER AS $$
+DECLARE
+    target_carteirinha_id INTEGER;
+    target_codigo_terapia TEXT;
+BEGIN
+    IF current_setting('app.defer_pei', true) = 'on' THEN
+        RETURN NEW;
+    END IF;
+
+    IF TG_TABLE_NAME = 'base_guias' THEN
+        target_carteirinha_id := NEW.carteirinha_id;
+        target_codigo_terapia := NEW.codigo_terapia;
+    ELSIF TG_TABLE_NAME = 'pei_temp' THEN
+        SELECT carteirinha_id, codigo_terapia INTO target_carteirinha_id, target_codigo_terapia
+        FROM base_guias WHERE id = NEW.base_guia_id;
+    END IF;
+
+    IF target_carteirinha_id IS NULL THEN
+        RETURN NEW;
+    END IF;
+
+    PERFORM recompute_patient_pei(ARRAY[target_carteirinha_id], ARRAY[target_codigo_terapia]);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 4. Remove duplicate guias (keep the most recently updated row). Overrides and PEI rows
+--    pointing at a duplicate are moved to the kept row first, since deleting a guia
+--    cascades to them.
+DROP TABLE IF EXISTS base_guias_dupes;
+CREATE TEMP TABLE base_guias_dupes AS
+SELECT id, keep_id
+FROM (
+    SELECT id,
+           FIRST_VALUE(id) OVER (
+               PARTITION BY carteirinha_id, guia
+               ORDER BY updated_at DESC NULLS LAST, id DESC
+           ) AS keep_id
+    FROM base_guias
+    WHERE guia IS NOT NULL
+) ranked
+WHERE id <> keep_id;
+
+-- pei_temp.base_guia_id is unique: keep the kept guia's own override, else the newest one
+DELETE FROM pei_temp t
+USING base_guias_dupes d
+WHERE t.base_guia_id = d.id
+  AND (
+      EXISTS (SELECT 1 FROM pei_temp k WHERE k.base_guia_id = d.keep_id)
+      OR EXISTS (
+          SELECT 1
+          FROM pei_temp o
+          JOIN base_guias_dupes od ON od.id = o.base_guia_id
+          WHERE od.keep_id = d.keep_id AND o.id > t.id
+      )
+  );
+
+UPDATE pei_temp t SET base_guia_id = d.keep_id
+FROM base_guias_dupes d
+WHERE t.base_guia_id = d.id;
+
+UPDATE patient_pei p SET base_guia_id = d.keep_id
+FROM base_guias_dupes d
+WHERE p.base_guia_id = d.id;
+
+DELETE FROM base_guias g
+USING base_guias_dupes d
+WHERE g.id = d.id;
+
+SELECT recompute_patient_pei(ARRAY_AGG(g.carteirinha_id), ARRAY_AGG(g.codigo_terapia))
+FROM base_guias g
+WHERE g.id IN (SELECT keep_id FROM base_guias_dupes);
+
+DROP TABLE base_guias_dupes;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_base_guias_carteirinha_guia ON base_guias (carteirinha_id, guia);
+
+
+-- MIGRATION: 0019_statement_pei_triggers.sql --
+
+-- Migration: Statement-level PEI Triggers
+-- Description: Replaces the FOR EACH ROW calculate_patient_pei triggers with FOR EACH
+-- STATEMENT triggers reading transition tables, so a statement that writes many guias
+-- recomputes each distinct (carteirinha_id, codigo_terapia) once via recompute_patient_pei().
+-- Skipped while app.defer_pei = 'on': a manual escape hatch for bulk fixes run by hand
+-- (SET LOCAL app.defer_pei = 'on', then POST /pei/rebuild); no application code sets it.
+
+CREATE OR REPLACE FUNCTION recompute_pei_from_guias() RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.defer_pei', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        PERFORM recompute_patient_pei(ARRAY_AGG(carteirinha_id), ARRAY_AGG(codigo_terapia))
+        FROM (
+            SELECT DISTINCT carteirinha_id, codigo_terapia
+            FROM new_rows
+            WHERE carteirinha_id IS NOT NULL AND codigo_terapia IS NOT NULL
+        ) pairs;
+    ELSE
+        -- Only rows whose PEI inputs changed; both the old and the new therapy are recomputed
+        PERFORM recompute_patient_pei(ARRAY_AGG(carteirinha_id), ARRAY_AGG(codigo_terapia))
+        FROM (
+            SELECT n.carteirinha_id, n.codigo_terapia
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.carteirinha_id, n.codigo_terapia, n.data_autorizacao, n.qtde_solicitada)
+                  IS DISTINCT FROM (o.carteirinha_id, o.codigo_terapia, o.data_autorizacao, o.qtde_solicitada)
+            UNION
+            SELECT o.carteirinha_id, o.codigo_terapia
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.carteirinha_id, n.codigo_terapia) IS DISTINCT FROM (o.carteirinha_id, o.codigo_terapia)
+        ) pairs
+        WHERE carteirinha_id IS NOT NULL AND codigo_terapia IS NOT NULL;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION recompute_pei_from_pei_temp() RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.defer_pei', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        PERFORM recompute_patient_pei(ARRAY_AGG(carteirinha_id), ARRAY_AGG(codigo_terapia))
+        FROM (
+            SELECT DISTINCT g.carteirinha_id, g.codigo_terapia
+            FROM new_rows t
+            JOIN base_guias g ON g.id = t.base_guia_id
+            WHERE g.carteirinha_id IS NOT NULL AND g.codigo_terapia IS NOT NULL
+        ) pairs;
+    ELSE
+        PERFORM recompute_patient_pei(ARRAY_AGG(carteirinha_id), ARRAY_AGG(codigo_terapia))
+        FROM (
+            SELECT DISTINCT g.carteirinha_id, g.codigo_terapia
+            FROM (SELECT base_guia_id FROM new_rows UNION SELECT base_guia_id FROM old_rows) t
+            JOIN base_guias g ON g.id = t.base_guia_id
+            WHERE g.carteirinha_id IS NOT NULL AND g.codigo_terapia IS NOT NULL
+        ) pairs;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Row-level triggers from 0006 are replaced
+DROP TRIGGER IF EXISTS trigger_calc_pei_guia ON base_guias;
+DROP TRIGGER IF EXISTS trigger_calc_pei_temp ON pei_temp;
+
+-- Transition tables allow a single event per trigger, hence one trigger per event
+DROP TRIGGER IF EXISTS trigger_pei_guias_insert ON base_guias;
+CREATE TRIGGER trigger_pei_guias_insert
+AFTER INSERT ON base_guias
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompute_pei_from_guias();
+
+DROP TRIGGER IF EXISTS trigger_pei_guias_update ON base_guias;
+CREATE TRIGGER trigger_pei_guias_update
+AFTER UPDATE ON base_guias
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompute_pei_from_guias();
+
+DROP TRIGGER IF EXISTS trigger_pei_temp_insert ON pei_temp;
+CREATE TRIGGER trigger_pei_temp_insert
+AFTER INSERT ON pei_temp
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompute_pei_from_pei_temp();
+
+DROP TRIGGER IF EXISTS trigger_pei_temp_update ON pei_temp;
+CREATE TRIGGER trigger_pei_temp_update
+AFTER UPDATE ON pei_temp
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompute_pei_from_pei_temp();
+
+
+-- MIGRATION: 0020_pei_rebuild_state.sql --
+
+-- Migration: PEI Rebuild State
+-- Description: Key/value table for maintenance watermarks (the incremental PEI rebuild
+-- stores the time of its last successful run) and updated_at indexes to find changed rows.
+
+CREATE TABLE IF NOT EXISTS maintenance_state (
+    key TEXT PRIMARY KEY,
+    value TIMESTAMP WITH TIME ZONE,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_base_guias_updated_at ON base_guias (updated_at);
+CREATE INDEX IF NOT EXISTS idx_pei_temp_updated_at ON pei_temp (updated_at);
+
+
+-- MIGRATION: 0021_pei_changed_notify.sql --
+
+-- Migration: PEI Change Notification
+-- Description: recompute_patient_pei() sends NOTIFY pei_changed when it writes, so API
+-- processes can drop cached PEI dashboard aggregates. Identical notifications are
+-- collapsed by Postgres within a transaction, so a bulk write sends one.
+
+CREATE OR REPLACE FUNCTION recompute_patient_pei(p_carteirinha_ids INTEGER[], p_codigos TEXT[])
+RETURNS INTEGER AS $$
+DECLARE
+    affected INTEGER;
+BEGIN
+    WITH computed AS (
+        SELECT * FROM patient_pei_computed(p_carteirinha_ids, p_codigos)
+    ),
+    updated AS (
+        UPDATE patient_pei p
+        SET base_guia_id = c.base_guia_id,
+            pei_semanal = c.pei_semanal,
+            validade = c.validade,
+            status = c.status,
+            updated_at = NOW()
+        FROM computed c
+        WHERE p.carteirinha_id = c.carteirinha_id AND p.codigo_terapia = c.codigo_terapia
+        RETURNING 1
+    ),
+    inserted AS (
+        INSERT INTO patient_pei (carteirinha_id, codigo_terapia, base_guia_id, pei_semanal, validade, status, updated_at)
+        SELECT c.carteirinha_id, c.codigo_terapia, c.base_guia_id, c.pei_semanal, c.validade, c.status, NOW()
+        FROM computed c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM patient_pei p
+            WHERE p.carteirinha_id = c.carteirinha_id AND p.codigo_terapia = c.codigo_terapia
+        )
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM updated) + (SELECT COUNT(*) FROM inserted) INTO affected;
+
+    IF affected > 0 THEN
+        PERFORM pg_notify('pei_changed', '{}');
+    END IF;
+
+    RETURN affected;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- MIGRATION: 0022_patient_pei_unique_key.sql --
+
+-- migrate: no-transaction
+-- Migration: patient_pei Unique Key and PEI Lookup Indexes
+-- Description: Indexes are built CONCURRENTLY so writes are not blocked, which Postgres only
+-- allows outside a transaction block: migrate_runner.py runs this file statement by
+-- statement in autocommit (see the marker on the first line). A concurrent build that fails
+-- leaves an INVALID index behind, which IF NOT EXISTS would then skip; step 2 drops it first
+-- so re-running the migration rebuilds it.
+
+-- 1. Remove duplicate PEI rows (keep the most recently updated one per carteirinha + therapy)
+DELETE FROM patient_pei p
+USING (
+    SELECT id,
+           ROW_NUMBER() OVER (
+               PARTITION BY carteirinha_id, codigo_terapia
+               ORDER BY updated_at DESC NULLS LAST, id DESC
+           ) AS rn
+    FROM patient_pei
+) ranked
+WHERE p.id = ranked.id AND ranked.rn > 1;
+
+-- 2. Drop an INVALID leftover of a failed build (plain DROP INDEX: CONCURRENTLY is not allowed
+-- inside a DO block; an invalid index is never used by queries, so the brief lock is harmless)
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indexrelid = to_regclass('idx_patient_pei_carteirinha_terapia') AND NOT i.indisvalid
+    ) THEN
+        DROP INDEX idx_patient_pei_carteirinha_terapia;
+    END IF;
+    IF EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indexrelid = to_regclass('idx_base_guias_latest') AND NOT i.indisvalid
+    ) THEN
+        DROP INDEX idx_base_guias_latest;
+    END IF;
+END;
+$$;
+
+-- 3. Natural key used by recompute_patient_pei's INSERT ... ON CONFLICT (migration 0023)
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_patient_pei_carteirinha_terapia ON patient_pei (carteirinha_id, codigo_terapia);
+
+-- 4. "Latest guia" lookup: WHERE carteirinha_id = ? AND codigo_terapia = ? ORDER BY data_autorizacao DESC, id DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_base_guias_latest ON base_guias (carteirinha_id, codigo_terapia, data_autorizacao DESC, id DESC);
+
+-- list_pei's ORDER BY status, updated_at DESC, id DESC is served by idx_patient_pei_status_updated_id (0014).
+-- scripts/check_query_plans.py verifies the hot queries use these indexes.
+
+
+-- MIGRATION: 0023_patient_pei_on_conflict.sql --
+
+-- Migration: Race-free PEI Upsert
+-- Description: recompute_patient_pei() becomes a single INSERT ... ON CONFLICT on the
+-- (carteirinha_id, codigo_terapia) key from 0022, so concurrent recomputes of the same
+-- pair cannot insert duplicates. Rows whose values did not change are not rewritten.
+
+-- ON CONFLICT needs a valid unique index on the key; fail loudly if 0022 did not build it
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indrelid = 'patient_pei'::regclass
+          AND i.indisunique AND i.indisvalid
+          AND i.indpred IS NULL AND i.indexprs IS NULL AND i.indnatts = 2
+          AND (
+              SELECT array_agg(a.attname::TEXT ORDER BY a.attname)
+              FROM pg_attribute a
+              WHERE a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+          ) = ARRAY['carteirinha_id', 'codigo_terapia']
+    ) THEN
+        RAISE EXCEPTION 'patient_pei has no valid unique index on (carteirinha_id, codigo_terapia); re-run 0022_patient_pei_unique_key.sql';
+    END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION recompute_patient_pei(p_carteirinha_ids INTEGER[], p_codigos TEXT[])
+RETURNS INTEGER AS $$
+DECLARE
+    affected INTEGER;
+BEGIN
+    INSERT INTO patient_pei AS p (carteirinha_id, codigo_terapia, base_guia_id, pei_semanal, validade, status, updated_at)
+    SELECT c.carteirinha_id, c.codigo_terapia, c.base_guia_id, c.pei_semanal, c.validade, c.status, NOW()
+    FROM patient_pei_computed(p_carteirinha_ids, p_codigos) c
+    ON CONFLICT (carteirinha_id, codigo_terapia) DO UPDATE
+    SET base_guia_id = EXCLUDED.base_guia_id,
+        pei_semanal = EXCLUDED.pei_semanal,
+        validade = EXCLUDED.validade,
+        status = EXCLUDED.status,
+        updated_at = NOW()
+    WHERE (p.base_guia_id, p.pei_semanal, p.validade, p.status)
+          IS DISTINCT FROM (EXCLUDED.base_guia_id, EXCLUDED.pei_semanal, EXCLUDED.validade, EXCLUDED.status);
+
+    GET DIAGNOSTICS affected = ROW_COUNT;
+
+    IF affected > 0 THEN
+        PERFORM pg_notify('pei_changed', '{}');
+    END IF;
+
+    RETURN affected;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- MIGRATION: 0024_export_table_versions.sql --
+
+-- Migration: Export Cache Table Versions
+-- Description: The export cache (services/export_cache.py) keys cached files by a version
+-- number per table. Statement triggers bump it on every INSERT/UPDATE/DELETE that changed at
+-- least one row (and on TRUNCATE), in the writing transaction, so the new version becomes
+-- visible exactly when the change commits. The counter is striped over 16 rows per table
+-- (one picked by backend pid) so concurrent writers do not queue on a single row lock; the
+-- version of a table is the SUM over its slots. Runs as one transaction, so either every
+-- table gets its trigger or none does.
+
+-- 1. Counters
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (table_name, slot)
+);
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS TRIGGER AS $$
+BEGIN
+    -- Statement triggers also fire for statements that matched no rows (e.g. the PEI upsert
+    -- skipping unchanged rows); those must not invalidate cached exports
+    IF TG_OP <> 'TRUNCATE' AND NOT EXISTS (SELECT 1 FROM changed_rows) THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO table_versions AS v (table_name, slot, version)
+    VALUES (TG_TABLE_NAME, pg_backend_pid() % 16, 1)
+    ON CONFLICT (table_name, slot) DO UPDATE SET version = v.version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 2. Triggers (transition tables need one trigger per event)
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['carteirinhas', 'base_guias', 'patient_pei'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS trigger_%s_version_insert ON %I', t, t);
+        EXECUTE format('CREATE TRIGGER trigger_%s_version_insert AFTER INSERT ON %I
+            REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS trigger_%s_version_update ON %I', t, t);
+        EXECUTE format('CREATE TRIGGER trigger_%s_version_update AFTER UPDATE ON %I
+            REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS trigger_%s_version_delete ON %I', t, t);
+        EXECUTE format('CREATE TRIGGER trigger_%s_version_delete AFTER DELETE ON %I
+            REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS trigger_%s_version_truncate ON %I', t, t);
+        EXECUTE format('CREATE TRIGGER trigger_%s_version_truncate AFTER TRUNCATE ON %I
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t, t);
+    END LOOP;
+END;
+$$;
@@ -3,6 +3,7 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from database import engine, Base
 from routes import auth, carteirinhas, jobs, guias, logs, dashboard, debug_optimization
+from services.admission import AdmissionMiddleware
 
 # Create tables
 Base.metadata.create_all(bind=engine)
@@ -17,12 +18,17 @@ origins = [
     "https://clmf-hub-unimed-frontend.vercel.app"
 ]
 
+# Concurrency limits for exports, uploads and job fan-out (429 + Retry-After when saturated).
+# Added before CORS so rejections still carry the CORS headers.
+app.add_middleware(AdmissionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
 @app.get("/")
@@ -32,6 +38,11 @@ def read_root():
 import asyncio
 from database import SessionLocal
 from services.cleanup_service import delete_expired_patients
+from services.job_service import reap_expired_jobs
+from services import notifier
+import os
+
+JOB_REAPER_INTERVAL = int(os.getenv("JOB_REAPER_INTERVAL", "60"))
 
 async def run_cleanup_loop():
     while True:
@@ -44,9 +55,32 @@ async def run_cleanup_loop():
         
         await asyncio.sleep(600) # Run every 10 minutes
 
+def reap_once():
+    db = SessionLocal()
+    try:
+        reap_expired_jobs(db)
+    finally:
+        db.close()
+
+async def run_reaper_loop():
+    while True:
+        try:
+            # Blocking DB work runs off the event loop
+            await asyncio.to_thread(reap_once)
+        except Exception as e:
+            print(f"Reaper Loop Error: {e}")
+
+        await asyncio.sleep(JOB_REAPER_INTERVAL) # Return expired job leases to the pool
+
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(run_cleanup_loop())
+    asyncio.create_task(run_reaper_loop())
+    notifier.start_listener()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    notifier.stop_listener()
 
 # Include routers
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
@@ -57,4 +91,6 @@ app.include_router(logs.router, prefix="/api/logs")
 app.include_router(dashboard.router)
 from routes import pei
 app.include_router(pei.router)
+from routes import exports
+app.include_router(exports.router)
 app.include_router(debug_optimization.router)
@@ -3,6 +3,36 @@ import sys
 from sqlalchemy import text
 from database import engine
 
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+
+def split_statements(sql):
+    """
+    Splits a SQL file on semicolons at the end of a line, keeping $$ ... $$ bodies intact.
+    Used for no-transaction migrations (e.g. CREATE INDEX CONCURRENTLY), which Postgres
+    only accepts one statement at a time outside a transaction block.
+    """
+    statements = []
+    current = []
+    in_dollar_quote = False
+    for line in sql.splitlines():
+        if line.count("$$") % 2 == 1:
+            in_dollar_quote = not in_dollar_quote
+        current.append(line)
+        if not in_dollar_quote and line.rstrip().endswith(";"):
+            statement = "\n".join(current).strip()
+            current = []
+            if any(l.strip() and not l.strip().startswith("--") for l in statement.splitlines()):
+                statements.append(statement)
+    rest = "\n".join(current).strip()
+    if any(l.strip() and not l.strip().startswith("--") for l in rest.splitlines()):
+        statements.append(rest)
+    return statements
+
+def run_without_transaction(sql):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for statement in split_statements(sql):
+            connection.execute(text(statement))
+
 def run_migrations():
     print("Running migrations...")
     migrations_dir = os.path.join(os.path.dirname(__file__), "migrations")
@@ -20,8 +50,11 @@ def run_migrations():
                 # but SQLAlchemy text() might prefer single statements or BEGIN/COMMIT blocks.
                 # Let's try executing the whole file content.
                 try:
-                    connection.execute(text(sql))
-                    connection.commit()
+                    if sql.lstrip().startswith(NO_TRANSACTION_MARKER):
+                        run_without_transaction(sql)
+                    else:
+                        connection.execute(text(sql))
+                        connection.commit()
                     print(f"Finished {file}")
                 except Exception as e:
                     print(f"Error executing {file}: {e}")
@@ -0,0 +1,35 @@
+-- Migration: Carteirinha Fingerprint
+-- Description: Stores a hash of paciente, id_paciente, id_pagamento and status so that
+-- re-imports can compare one value per row and skip the rows that did not change.
+-- Keep carteirinha_fingerprint() in sync with services/carteirinha_service.compute_fingerprint.
+
+CREATE OR REPLACE FUNCTION carteirinha_fingerprint(p_paciente TEXT, p_id_paciente INTEGER, p_id_pagamento INTEGER, p_status TEXT)
+RETURNS TEXT AS $$
+    SELECT md5(concat_ws('|',
+        coalesce(p_paciente, ''),
+        coalesce(p_id_paciente::TEXT, ''),
+        coalesce(p_id_pagamento::TEXT, ''),
+        coalesce(p_status, '')
+    ));
+$$ LANGUAGE sql IMMUTABLE;
+
+ALTER TABLE carteirinhas ADD COLUMN IF NOT EXISTS fingerprint TEXT;
+
+-- Every write path (upload, CRUD routes, temp patients) goes through this trigger
+CREATE OR REPLACE FUNCTION set_carteirinha_fingerprint() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.fingerprint := carteirinha_fingerprint(NEW.paciente, NEW.id_paciente, NEW.id_pagamento, NEW.status);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_carteirinha_fingerprint ON carteirinhas;
+CREATE TRIGGER trigger_carteirinha_fingerprint
+BEFORE INSERT OR UPDATE OF paciente, id_paciente, id_pagamento, status ON carteirinhas
+FOR EACH ROW
+EXECUTE FUNCTION set_carteirinha_fingerprint();
+
+-- Backfill existing rows (only the ones still missing or stale)
+UPDATE carteirinhas
+SET fingerprint = carteirinha_fingerprint(paciente, id_paciente, id_pagamento, status)
+WHERE fingerprint IS DISTINCT FROM carteirinha_fingerprint(paciente, id_paciente, id_pagamento, status);
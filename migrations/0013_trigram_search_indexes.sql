@@ -0,0 +1,22 @@
+-- Migration: Trigram Search Indexes
+-- Description: Indexes for the search boxes of /carteirinhas and /pei (services/search_service.py).
+-- Free text uses ILIKE '%term%' (pg_trgm GIN); numeric / carteirinha-shaped input uses a
+-- digit-only prefix LIKE 'digits%' (B-tree text_pattern_ops).
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Digit-only normalized carteirinha (0064.8000.400948.00-5 -> 006480004009480005)
+ALTER TABLE carteirinhas
+ADD COLUMN IF NOT EXISTS carteirinha_digits TEXT
+GENERATED ALWAYS AS (regexp_replace(carteirinha, '[^0-9]', '', 'g')) STORED;
+
+-- Free-text (trigram)
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_paciente_trgm ON carteirinhas USING gin (paciente gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_carteirinha_trgm ON carteirinhas USING gin (carteirinha gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_patient_pei_codigo_terapia_trgm ON patient_pei USING gin (codigo_terapia gin_trgm_ops);
+
+-- Identifier prefix lookups
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_digits_prefix ON carteirinhas (carteirinha_digits text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_id_paciente_text ON carteirinhas ((id_paciente::TEXT) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_id_pagamento_text ON carteirinhas ((id_pagamento::TEXT) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_patient_pei_codigo_terapia_prefix ON patient_pei (codigo_terapia text_pattern_ops);
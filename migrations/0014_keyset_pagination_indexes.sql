@@ -0,0 +1,18 @@
+-- Migration: Keyset Pagination Indexes
+-- Description: Composite indexes matching the sort orders of the list endpoints
+-- (services/pagination.py), so cursor pages are index range scans. NULLs sort first.
+
+-- /carteirinhas: paciente, id
+CREATE INDEX IF NOT EXISTS idx_carteirinhas_paciente_id ON carteirinhas (paciente ASC NULLS FIRST, id ASC);
+
+-- /jobs: priority DESC, created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_jobs_priority_created_id ON jobs (priority DESC, created_at DESC, id DESC);
+
+-- /guias: created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_base_guias_created_id ON base_guias (created_at DESC, id DESC);
+
+-- /api/logs: created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_logs_created_id ON logs (created_at DESC, id DESC);
+
+-- /pei: status, updated_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_patient_pei_status_updated_id ON patient_pei (status ASC NULLS FIRST, updated_at DESC, id DESC);
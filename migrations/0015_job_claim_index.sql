@@ -0,0 +1,5 @@
+-- Migration: Job Claim Index
+-- Description: Partial index for POST /jobs/claim, which picks pending jobs by
+-- priority DESC, created_at ASC with FOR UPDATE SKIP LOCKED.
+
+CREATE INDEX IF NOT EXISTS idx_jobs_claim_pending ON jobs (priority DESC, created_at ASC, id ASC) WHERE status = 'pending';
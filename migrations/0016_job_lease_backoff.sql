@@ -0,0 +1,7 @@
+-- Migration: Job Lease Expiry and Retry Backoff
+-- Description: next_attempt_at schedules retries (exponential backoff); the reaper finds
+-- expired leases through the partial index on timeout.
+
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP WITH TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS idx_jobs_processing_timeout ON jobs (timeout) WHERE status = 'processing';
@@ -0,0 +1,19 @@
+-- Migration: One Active Job per Carteirinha
+-- Description: Removes duplicate pending/processing jobs (keeps the processing one, else
+-- the oldest) and enforces at most one active job per carteirinha with a partial unique index.
+
+DELETE FROM jobs
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id,
+               ROW_NUMBER() OVER (
+                   PARTITION BY carteirinha_id
+                   ORDER BY (status = 'processing') DESC, created_at ASC, id ASC
+               ) AS rn
+        FROM jobs
+        WHERE status IN ('pending', 'processing') AND carteirinha_id IS NOT NULL
+    ) ranked
+    WHERE ranked.rn > 1
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_one_active_per_carteirinha ON jobs (carteirinha_id) WHERE status IN ('pending', 'processing');
@@ -0,0 +1,160 @@
+-- Migration: Batched Guia Ingestion
+-- Description: Natural key on base_guias (carteirinha_id, guia) so worker results can be
+-- upserted in one statement, and a set-based recompute_patient_pei() that the row
+-- trigger delegates to.
+
+-- 1. PEI computed for a set of (carteirinha_id, codigo_terapia) pairs, same rules as the
+--    original trigger: latest guia by data_autorizacao DESC, id DESC; pei_temp override
+--    wins; otherwise qtde_solicitada / 16, validated when it is a whole number.
+CREATE OR REPLACE FUNCTION patient_pei_computed(p_carteirinha_ids INTEGER[], p_codigos TEXT[])
+RETURNS TABLE (
+    carteirinha_id INTEGER,
+    codigo_terapia TEXT,
+    base_guia_id INTEGER,
+    pei_semanal FLOAT,
+    validade DATE,
+    status TEXT
+) AS $$
+    WITH targets AS (
+        SELECT DISTINCT t.carteirinha_id, t.codigo_terapia
+        FROM unnest(p_carteirinha_ids, p_codigos) AS t(carteirinha_id, codigo_terapia)
+    ),
+    latest AS (
+        SELECT DISTINCT ON (g.carteirinha_id, g.codigo_terapia)
+               g.carteirinha_id, g.codigo_terapia, g.id, g.data_autorizacao, g.qtde_solicitada
+        FROM base_guias g
+        JOIN targets t ON t.carteirinha_id = g.carteirinha_id AND t.codigo_terapia = g.codigo_terapia
+        ORDER BY g.carteirinha_id, g.codigo_terapia, g.data_autorizacao DESC, g.id DESC
+    )
+    SELECT l.carteirinha_id,
+           l.codigo_terapia,
+           l.id,
+           CASE
+               WHEN o.pei_semanal IS NOT NULL THEN o.pei_semanal
+               WHEN l.qtde_solicitada > 0 THEN l.qtde_solicitada::FLOAT / 16.0
+               ELSE 0.0
+           END,
+           (l.data_autorizacao + INTERVAL '180 days')::DATE,
+           CASE
+               WHEN o.pei_semanal IS NOT NULL THEN 'Validado'
+               WHEN l.qtde_solicitada > 0 AND l.qtde_solicitada % 16 = 0 THEN 'Validado'
+               ELSE 'Pendente'
+           END
+    FROM latest l
+    LEFT JOIN pei_temp o ON o.base_guia_id = l.id;
+$$ LANGUAGE sql STABLE;
+
+-- 2. Set-based recompute: UPDATE existing patient_pei rows, INSERT the missing ones.
+--    Returns the number of rows written.
+CREATE OR REPLACE FUNCTION recompute_patient_pei(p_carteirinha_ids INTEGER[], p_codigos TEXT[])
+RETURNS INTEGER AS $$
+DECLARE
+    affected INTEGER;
+BEGIN
+    WITH computed AS (
+        SELECT * FROM patient_pei_computed(p_carteirinha_ids, p_codigos)
+    ),
+    updated AS (
+        UPDATE patient_pei p
+        SET base_guia_id = c.base_guia_id,
+            pei_semanal = c.pei_semanal,
+            validade = c.validade,
+            status = c.status,
+            updated_at = NOW()
+        FROM computed c
+        WHERE p.carteirinha_id = c.carteirinha_id AND p.codigo_terapia = c.codigo_terapia
+        RETURNING 1
+    ),
+    inserted AS (
+        INSERT INTO patient_pei (carteirinha_id, codigo_terapia, base_guia_id, pei_semanal, validade, status, updated_at)
+        SELECT c.carteirinha_id, c.codigo_terapia, c.base_guia_id, c.pei_semanal, c.validade, c.status, NOW()
+        FROM computed c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM patient_pei p
+            WHERE p.carteirinha_id = c.carteirinha_id AND p.codigo_terapia = c.codigo_terapia
+        )
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM updated) + (SELECT COUNT(*) FROM inserted) INTO affected;
+
+    RETURN affected;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 3. Row trigger now delegates to recompute_patient_pei.
+CREATE OR REPLACE FUNCTION calculate_patient_pei() RETURNS TRIGGER AS $$
+DECLARE
+    target_carteirinha_id INTEGER;
+    target_codigo_terapia TEXT;
+BEGIN
+    IF current_setting('app.defer_pei', true) = 'on' THEN
+        RETURN NEW;
+    END IF;
+
+    IF TG_TABLE_NAME = 'base_guias' THEN
+        target_carteirinha_id := NEW.carteirinha_id;
+        target_codigo_terapia := NEW.codigo_terapia;
+    ELSIF TG_TABLE_NAME = 'pei_temp' THEN
+        SELECT carteirinha_id, codigo_terapia INTO target_carteirinha_id, target_codigo_terapia
+        FROM base_guias WHERE id = NEW.base_guia_id;
+    END IF;
+
+    IF target_carteirinha_id IS NULL THEN
+        RETURN NEW;
+    END IF;
+
+    PERFORM recompute_patient_pei(ARRAY[target_carteirinha_id], ARRAY[target_codigo_terapia]);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 4. Remove duplicate guias (keep the most recently updated row). Overrides and PEI rows
+--    pointing at a duplicate are moved to the kept row first, since deleting a guia
+--    cascades to them.
+DROP TABLE IF EXISTS base_guias_dupes;
+CREATE TEMP TABLE base_guias_dupes AS
+SELECT id, keep_id
+FROM (
+    SELECT id,
+           FIRST_VALUE(id) OVER (
+               PARTITION BY carteirinha_id, guia
+               ORDER BY updated_at DESC NULLS LAST, id DESC
+           ) AS keep_id
+    FROM base_guias
+    WHERE guia IS NOT NULL
+) ranked
+WHERE id <> keep_id;
+
+-- pei_temp.base_guia_id is unique: keep the kept guia's own override, else the newest one
+DELETE FROM pei_temp t
+USING base_guias_dupes d
+WHERE t.base_guia_id = d.id
+  AND (
+      EXISTS (SELECT 1 FROM pei_temp k WHERE k.base_guia_id = d.keep_id)
+      OR EXISTS (
+          SELECT 1
+          FROM pei_temp o
+          JOIN base_guias_dupes od ON od.id = o.base_guia_id
+          WHERE od.keep_id = d.keep_id AND o.id > t.id
+      )
+  );
+
+UPDATE pei_temp t SET base_guia_id = d.keep_id
+FROM base_guias_dupes d
+WHERE t.base_guia_id = d.id;
+
+UPDATE patient_pei p SET base_guia_id = d.keep_id
+FROM base_guias_dupes d
+WHERE p.base_guia_id = d.id;
+
+DELETE FROM base_guias g
+USING base_guias_dupes d
+WHERE g.id = d.id;
+
+SELECT recompute_patient_pei(ARRAY_AGG(g.carteirinha_id), ARRAY_AGG(g.codigo_terapia))
+FROM base_guias g
+WHERE g.id IN (SELECT keep_id FROM base_guias_dupes);
+
+DROP TABLE base_guias_dupes;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_base_guias_carteirinha_guia ON base_guias (carteirinha_id, guia);
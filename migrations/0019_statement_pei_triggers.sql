@@ -0,0 +1,100 @@
+-- Migration: Statement-level PEI Triggers
+-- Description: Replaces the FOR EACH ROW calculate_patient_pei triggers with FOR EACH
+-- STATEMENT triggers reading transition tables, so a statement that writes many guias
+-- recomputes each distinct (carteirinha_id, codigo_terapia) once via recompute_patient_pei().
+-- Skipped while app.defer_pei = 'on': a manual escape hatch for bulk fixes run by hand
+-- (SET LOCAL app.defer_pei = 'on', then POST /pei/rebuild); no application code sets it.
+
+CREATE OR REPLACE FUNCTION recompute_pei_from_guias() RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.defer_pei', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        PERFORM recompute_patient_pei(ARRAY_AGG(carteirinha_id), ARRAY_AGG(codigo_terapia))
+        FROM (
+            SELECT DISTINCT carteirinha_id, codigo_terapia
+            FROM new_rows
+            WHERE carteirinha_id IS NOT NULL AND codigo_terapia IS NOT NULL
+        ) pairs;
+    ELSE
+        -- Only rows whose PEI inputs changed; both the old and the new therapy are recomputed
+        PERFORM recompute_patient_pei(ARRAY_AGG(carteirinha_id), ARRAY_AGG(codigo_terapia))
+        FROM (
+            SELECT n.carteirinha_id, n.codigo_terapia
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.carteirinha_id, n.codigo_terapia, n.data_autorizacao, n.qtde_solicitada)
+                  IS DISTINCT FROM (o.carteirinha_id, o.codigo_terapia, o.data_autorizacao, o.qtde_solicitada)
+            UNION
+            SELECT o.carteirinha_id, o.codigo_terapia
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.carteirinha_id, n.codigo_terapia) IS DISTINCT FROM (o.carteirinha_id, o.codigo_terapia)
+        ) pairs
+        WHERE carteirinha_id IS NOT NULL AND codigo_terapia IS NOT NULL;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION recompute_pei_from_pei_temp() RETURNS TRIGGER AS $$
+BEGIN
+    IF current_setting('app.defer_pei', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        PERFORM recompute_patient_pei(ARRAY_AGG(carteirinha_id), ARRAY_AGG(codigo_terapia))
+        FROM (
+            SELECT DISTINCT g.carteirinha_id, g.codigo_terapia
+            FROM new_rows t
+            JOIN base_guias g ON g.id = t.base_guia_id
+            WHERE g.carteirinha_id IS NOT NULL AND g.codigo_terapia IS NOT NULL
+        ) pairs;
+    ELSE
+        PERFORM recompute_patient_pei(ARRAY_AGG(carteirinha_id), ARRAY_AGG(codigo_terapia))
+        FROM (
+            SELECT DISTINCT g.carteirinha_id, g.codigo_terapia
+            FROM (SELECT base_guia_id FROM new_rows UNION SELECT base_guia_id FROM old_rows) t
+            JOIN base_guias g ON g.id = t.base_guia_id
+            WHERE g.carteirinha_id IS NOT NULL AND g.codigo_terapia IS NOT NULL
+        ) pairs;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Row-level triggers from 0006 are replaced
+DROP TRIGGER IF EXISTS trigger_calc_pei_guia ON base_guias;
+DROP TRIGGER IF EXISTS trigger_calc_pei_temp ON pei_temp;
+
+-- Transition tables allow a single event per trigger, hence one trigger per event
+DROP TRIGGER IF EXISTS trigger_pei_guias_insert ON base_guias;
+CREATE TRIGGER trigger_pei_guias_insert
+AFTER INSERT ON base_guias
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompute_pei_from_guias();
+
+DROP TRIGGER IF EXISTS trigger_pei_guias_update ON base_guias;
+CREATE TRIGGER trigger_pei_guias_update
+AFTER UPDATE ON base_guias
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompute_pei_from_guias();
+
+DROP TRIGGER IF EXISTS trigger_pei_temp_insert ON pei_temp;
+CREATE TRIGGER trigger_pei_temp_insert
+AFTER INSERT ON pei_temp
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompute_pei_from_pei_temp();
+
+DROP TRIGGER IF EXISTS trigger_pei_temp_update ON pei_temp;
+CREATE TRIGGER trigger_pei_temp_update
+AFTER UPDATE ON pei_temp
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION recompute_pei_from_pei_temp();
@@ -0,0 +1,12 @@
+-- Migration: PEI Rebuild State
+-- Description: Key/value table for maintenance watermarks (the incremental PEI rebuild
+-- stores the time of its last successful run) and updated_at indexes to find changed rows.
+
+CREATE TABLE IF NOT EXISTS maintenance_state (
+    key TEXT PRIMARY KEY,
+    value TIMESTAMP WITH TIME ZONE,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_base_guias_updated_at ON base_guias (updated_at);
+CREATE INDEX IF NOT EXISTS idx_pei_temp_updated_at ON pei_temp (updated_at);
@@ -0,0 +1,43 @@
+-- Migration: PEI Change Notification
+-- Description: recompute_patient_pei() sends NOTIFY pei_changed when it writes, so API
+-- processes can drop cached PEI dashboard aggregates. Identical notifications are
+-- collapsed by Postgres within a transaction, so a bulk write sends one.
+
+CREATE OR REPLACE FUNCTION recompute_patient_pei(p_carteirinha_ids INTEGER[], p_codigos TEXT[])
+RETURNS INTEGER AS $$
+DECLARE
+    affected INTEGER;
+BEGIN
+    WITH computed AS (
+        SELECT * FROM patient_pei_computed(p_carteirinha_ids, p_codigos)
+    ),
+    updated AS (
+        UPDATE patient_pei p
+        SET base_guia_id = c.base_guia_id,
+            pei_semanal = c.pei_semanal,
+            validade = c.validade,
+            status = c.status,
+            updated_at = NOW()
+        FROM computed c
+        WHERE p.carteirinha_id = c.carteirinha_id AND p.codigo_terapia = c.codigo_terapia
+        RETURNING 1
+    ),
+    inserted AS (
+        INSERT INTO patient_pei (carteirinha_id, codigo_terapia, base_guia_id, pei_semanal, validade, status, updated_at)
+        SELECT c.carteirinha_id, c.codigo_terapia, c.base_guia_id, c.pei_semanal, c.validade, c.status, NOW()
+        FROM computed c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM patient_pei p
+            WHERE p.carteirinha_id = c.carteirinha_id AND p.codigo_terapia = c.codigo_terapia
+        )
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM updated) + (SELECT COUNT(*) FROM inserted) INTO affected;
+
+    IF affected > 0 THEN
+        PERFORM pg_notify('pei_changed', '{}');
+    END IF;
+
+    RETURN affected;
+END;
+$$ LANGUAGE plpgsql;
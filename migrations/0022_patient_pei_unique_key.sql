@@ -0,0 +1,47 @@
+-- migrate: no-transaction
+-- Migration: patient_pei Unique Key and PEI Lookup Indexes
+-- Description: Indexes are built CONCURRENTLY so writes are not blocked, which Postgres only
+-- allows outside a transaction block: migrate_runner.py runs this file statement by
+-- statement in autocommit (see the marker on the first line). A concurrent build that fails
+-- leaves an INVALID index behind, which IF NOT EXISTS would then skip; step 2 drops it first
+-- so re-running the migration rebuilds it.
+
+-- 1. Remove duplicate PEI rows (keep the most recently updated one per carteirinha + therapy)
+DELETE FROM patient_pei p
+USING (
+    SELECT id,
+           ROW_NUMBER() OVER (
+               PARTITION BY carteirinha_id, codigo_terapia
+               ORDER BY updated_at DESC NULLS LAST, id DESC
+           ) AS rn
+    FROM patient_pei
+) ranked
+WHERE p.id = ranked.id AND ranked.rn > 1;
+
+-- 2. Drop an INVALID leftover of a failed build (plain DROP INDEX: CONCURRENTLY is not allowed
+-- inside a DO block; an invalid index is never used by queries, so the brief lock is harmless)
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indexrelid = to_regclass('idx_patient_pei_carteirinha_terapia') AND NOT i.indisvalid
+    ) THEN
+        DROP INDEX idx_patient_pei_carteirinha_terapia;
+    END IF;
+    IF EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indexrelid = to_regclass('idx_base_guias_latest') AND NOT i.indisvalid
+    ) THEN
+        DROP INDEX idx_base_guias_latest;
+    END IF;
+END;
+$$;
+
+-- 3. Natural key used by recompute_patient_pei's INSERT ... ON CONFLICT (migration 0023)
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_patient_pei_carteirinha_terapia ON patient_pei (carteirinha_id, codigo_terapia);
+
+-- 4. "Latest guia" lookup: WHERE carteirinha_id = ? AND codigo_terapia = ? ORDER BY data_autorizacao DESC, id DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_base_guias_latest ON base_guias (carteirinha_id, codigo_terapia, data_autorizacao DESC, id DESC);
+
+-- list_pei's ORDER BY status, updated_at DESC, id DESC is served by idx_patient_pei_status_updated_id (0014).
+-- scripts/check_query_plans.py verifies the hot queries use these indexes.
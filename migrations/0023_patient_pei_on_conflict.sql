@@ -0,0 +1,50 @@
+-- Migration: Race-free PEI Upsert
+-- Description: recompute_patient_pei() becomes a single INSERT ... ON CONFLICT on the
+-- (carteirinha_id, codigo_terapia) key from 0022, so concurrent recomputes of the same
+-- pair cannot insert duplicates. Rows whose values did not change are not rewritten.
+
+-- ON CONFLICT needs a valid unique index on the key; fail loudly if 0022 did not build it
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_index i
+        WHERE i.indrelid = 'patient_pei'::regclass
+          AND i.indisunique AND i.indisvalid
+          AND i.indpred IS NULL AND i.indexprs IS NULL AND i.indnatts = 2
+          AND (
+              SELECT array_agg(a.attname::TEXT ORDER BY a.attname)
+              FROM pg_attribute a
+              WHERE a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+          ) = ARRAY['carteirinha_id', 'codigo_terapia']
+    ) THEN
+        RAISE EXCEPTION 'patient_pei has no valid unique index on (carteirinha_id, codigo_terapia); re-run 0022_patient_pei_unique_key.sql';
+    END IF;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION recompute_patient_pei(p_carteirinha_ids INTEGER[], p_codigos TEXT[])
+RETURNS INTEGER AS $$
+DECLARE
+    affected INTEGER;
+BEGIN
+    INSERT INTO patient_pei AS p (carteirinha_id, codigo_terapia, base_guia_id, pei_semanal, validade, status, updated_at)
+    SELECT c.carteirinha_id, c.codigo_terapia, c.base_guia_id, c.pei_semanal, c.validade, c.status, NOW()
+    FROM patient_pei_computed(p_carteirinha_ids, p_codigos) c
+    ON CONFLICT (carteirinha_id, codigo_terapia) DO UPDATE
+    SET base_guia_id = EXCLUDED.base_guia_id,
+        pei_semanal = EXCLUDED.pei_semanal,
+        validade = EXCLUDED.validade,
+        status = EXCLUDED.status,
+        updated_at = NOW()
+    WHERE (p.base_guia_id, p.pei_semanal, p.validade, p.status)
+          IS DISTINCT FROM (EXCLUDED.base_guia_id, EXCLUDED.pei_semanal, EXCLUDED.validade, EXCLUDED.status);
+
+    GET DIAGNOSTICS affected = ROW_COUNT;
+
+    IF affected > 0 THEN
+        PERFORM pg_notify('pei_changed', '{}');
+    END IF;
+
+    RETURN affected;
+END;
+$$ LANGUAGE plpgsql;
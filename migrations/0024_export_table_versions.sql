@@ -0,0 +1,53 @@
+-- Migration: Export Cache Table Versions
+-- Description: The export cache (services/export_cache.py) keys cached files by a version
+-- number per table. Statement triggers bump it on every INSERT/UPDATE/DELETE that changed at
+-- least one row (and on TRUNCATE), in the writing transaction, so the new version becomes
+-- visible exactly when the change commits. The counter is striped over 16 rows per table
+-- (one picked by backend pid) so concurrent writers do not queue on a single row lock; the
+-- version of a table is the SUM over its slots. Runs as one transaction, so either every
+-- table gets its trigger or none does.
+
+-- 1. Counters
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (table_name, slot)
+);
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS TRIGGER AS $$
+BEGIN
+    -- Statement triggers also fire for statements that matched no rows (e.g. the PEI upsert
+    -- skipping unchanged rows); those must not invalidate cached exports
+    IF TG_OP <> 'TRUNCATE' AND NOT EXISTS (SELECT 1 FROM changed_rows) THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO table_versions AS v (table_name, slot, version)
+    VALUES (TG_TABLE_NAME, pg_backend_pid() % 16, 1)
+    ON CONFLICT (table_name, slot) DO UPDATE SET version = v.version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 2. Triggers (transition tables need one trigger per event)
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['carteirinhas', 'base_guias', 'patient_pei'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS trigger_%s_version_insert ON %I', t, t);
+        EXECUTE format('CREATE TRIGGER trigger_%s_version_insert AFTER INSERT ON %I
+            REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS trigger_%s_version_update ON %I', t, t);
+        EXECUTE format('CREATE TRIGGER trigger_%s_version_update AFTER UPDATE ON %I
+            REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS trigger_%s_version_delete ON %I', t, t);
+        EXECUTE format('CREATE TRIGGER trigger_%s_version_delete AFTER DELETE ON %I
+            REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t, t);
+        EXECUTE format('DROP TRIGGER IF EXISTS trigger_%s_version_truncate ON %I', t, t);
+        EXECUTE format('CREATE TRIGGER trigger_%s_version_truncate AFTER TRUNCATE ON %I
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t, t);
+    END LOOP;
+END;
+$$;
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Text, Float, Boolean
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Text, Float, Boolean, Computed
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -29,6 +29,12 @@ class Carteirinha(Base):
     is_temporary = Column(Boolean, default=False)
     expires_at = Column(DateTime(timezone=True), nullable=True)
 
+    # md5 of paciente|id_paciente|id_pagamento|status, maintained by trigger (migrations/0012)
+    fingerprint = Column(Text)
+
+    # Digit-only carteirinha for prefix search (migrations/0013)
+    carteirinha_digits = Column(Text, Computed("regexp_replace(carteirinha, '[^0-9]', '', 'g')", persisted=True))
+
     jobs = relationship("Job", back_populates="carteirinha_rel", cascade="all, delete-orphan")
     guias = relationship("BaseGuia", back_populates="carteirinha_rel", cascade="all, delete-orphan")
     logs = relationship("Log", back_populates="carteirinha_rel", cascade="all, delete-orphan")
@@ -43,6 +49,7 @@ class Job(Base):
     priority = Column(Integer, default=0)
     locked_by = Column(Text) # Server URL
     timeout = Column(DateTime(timezone=True))
+    next_attempt_at = Column(DateTime(timezone=True)) # Retry backoff: not claimable before this
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -0,0 +1,27 @@
+import sys
+import time
+import argparse
+from services.pei_rebuild_service import rebuild_pei, REBUILD_MODES, PEI_REBUILD_WORKERS, PEI_REBUILD_CHUNK_SIZE
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute patient_pei from base_guias and pei_temp.")
+    parser.add_argument("--mode", choices=REBUILD_MODES, default="full",
+                        help="full: every carteirinha; incremental: only rows changed since the last run")
+    parser.add_argument("--workers", type=int, default=PEI_REBUILD_WORKERS, help="parallel chunks")
+    parser.add_argument("--chunk-size", type=int, default=PEI_REBUILD_CHUNK_SIZE,
+                        help="carteirinha ids (full) or pairs (incremental) per chunk")
+    args = parser.parse_args()
+
+    print(f"Rebuilding PEI ({args.mode}, {args.workers} workers, chunk size {args.chunk_size})...")
+    start = time.monotonic()
+    try:
+        result = rebuild_pei(args.mode, workers=args.workers, chunk_size=args.chunk_size)
+    except Exception as e:
+        print(f"Error rebuilding PEI: {e}")
+        sys.exit(1)
+
+    print(f"Finished in {time.monotonic() - start:.1f}s: {result['chunks']} chunks, {result['pairs']} pairs, "
+          f"{result['updated']} updated, {result['inserted']} inserted, {result['deleted']} deleted.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+import gzip
+import os
+import orjson
+from fastapi import Request, Response
+
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+GZIP_LEVEL = 5
+
+def fast_json(request: Request, content) -> Response:
+    """
+    Serializes content with orjson (dates/datetimes handled natively) and gzips it
+    when the client accepts gzip and the body is big enough to be worth it.
+    """
+    body = orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    headers = {"Vary": "Accept-Encoding"}
+    if len(body) >= GZIP_MIN_SIZE and "gzip" in request.headers.get("accept-encoding", ""):
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def rows_to_dicts(rows) -> list:
+    """Column-tuple rows (query(Model.col, ...)) to plain dicts, no ORM objects involved."""
+    return [row._asdict() for row in rows]
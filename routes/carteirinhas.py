@@ -1,239 +1,85 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Body
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Body, Request
+from fastapi.responses import JSONResponse, FileResponse
 from sqlalchemy.orm import Session
 from database import get_db
 from models import Carteirinha, Job, BaseGuia, User
 from typing import List, Optional
-import io
-import csv
-from openpyxl import load_workbook
-from sqlalchemy import or_, String, cast
+from datetime import datetime
+import os
 from dependencies import get_current_user
+from services import carteirinha_service, import_service, state_files, search_service, export_stream, export_cache, xlsx_stream
+from services.carteirinha_service import validate_carteirinha_format, normalize_header
+from services.pagination import paginate
+from services.count_service import count_total
+from schemas import CarteirinhaPage
+from responses import fast_json, rows_to_dicts
 
 router = APIRouter(
     prefix="/carteirinhas",
     tags=["Carteirinhas"]
 )
 
-def validate_carteirinha_format(code: str):
-    # Format: 0064.8000.400948.00-5
-    # Length: 21
-    # Check simple length first
-    if len(code) != 21:
-        raise HTTPException(status_code=400, detail=f"Carteirinha inválida: {code}. Deve conter exatamente 21 caracteres.")
-    
-    # Check punctuation positions
-    # Indices: 4, 9, 16 are '.', 19 is '-'
-    if code[4] != '.' or code[9] != '.' or code[16] != '.' or code[19] != '-':
-        raise HTTPException(status_code=400, detail=f"Carteirinha inválida: {code}. Formato incorreto de pontos e traços. Esperado: 0000.0000.000000.00-0")
-
-def normalize_header(header):
-    header = str(header).strip()
-    mapping = {
-        'carteiras': 'Carteirinha',
-        'Carteiras': 'Carteirinha',
-        'carteirinha': 'Carteirinha',
-        'Carteirinha': 'Carteirinha',
-        'PACIENTE': 'Paciente',
-        'paciente': 'Paciente',
-        'Paciente': 'Paciente',
-        'ID': 'IdPaciente',
-        'id': 'IdPaciente',
-        'IdPaciente': 'IdPaciente',
-        'id_paciente': 'IdPaciente',
-        'IdPagamento': 'IdPagamento',
-        'id_pagamento': 'IdPagamento',
-        'IDPAGAMENTO': 'IdPagamento',
-        'status': 'status',
-        'Status': 'status',
-        'STATUS': 'status'
-    }
-    return mapping.get(header, header)
-
 @router.post("/upload")
-async def upload_carteirinhas(
+def upload_carteirinhas(
     file: UploadFile = File(...),
     overwrite: bool = Form(False),
+    async_import: bool = Form(False),
+    method: str = Form("upsert"),
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user)
 ):
+    if method not in import_service.IMPORT_METHODS:
+        raise HTTPException(status_code=400, detail=f"Método de importação inválido: {method}. Use 'upsert' ou 'copy'.")
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="Nome do arquivo não informado.")
+
     try:
-        contents = await file.read()
-        rows = []
-        
-        # 1. Parse File into List of Dicts
-        if file.filename.endswith('.csv'):
-            # Try decoding with utf-8-sig (handles BOM) then latin1
-            text_content = ""
-            try:
-                text_content = contents.decode('utf-8-sig')
-            except UnicodeDecodeError:
-                text_content = contents.decode('latin1')
-            
-            # Detect separator
-            dialect = 'excel' # default comma
-            if ';' in text_content and text_content.count(';') > text_content.count(','):
-                class SemiColonDialect(csv.Dialect):
-                    delimiter = ';'
-                    quotechar = '"'
-                    doublequote = True
-                    skipinitialspace = False
-                    lineterminator = '\r\n'
-                    quoting = csv.QUOTE_MINIMAL
-                dialect = SemiColonDialect
-            
-            f = io.StringIO(text_content)
-            reader = csv.DictReader(f, dialect=dialect)
-            
-            # Normalize Headers
-            # DictReader uses fieldnames from first row. We need to remap them.
-            if reader.fieldnames:
-                original_headers = reader.fieldnames
-                normalized_fieldnames = [normalize_header(h) for h in original_headers]
-                reader.fieldnames = normalized_fieldnames # Override fieldnames
-            
-            for row in reader:
-                rows.append(row)
-                
-        else:
-            # Excel (.xlsx)
-            wb = load_workbook(filename=io.BytesIO(contents), read_only=True, data_only=True)
-            ws = wb.active
-            
-            header_map = {} # col_index -> normalized_name
-            is_header = True
-            
-            for row in ws.iter_rows(values_only=True):
-                if not row: continue
-                
-                # Check for empty row
-                if all(cell is None for cell in row): continue
+        if async_import:
+            # Large files: store the upload and process it in the import worker pool
+            import_id = import_service.start_import(file.file, file.filename, method)
+            return JSONResponse(status_code=202, content={
+                "message": "Upload queued for import",
+                "import_id": import_id,
+                "status_url": f"/carteirinhas/imports/{import_id}"
+            })
 
-                if is_header:
-                    for i, cell_value in enumerate(row):
-                        if cell_value:
-                            header_map[i] = normalize_header(cell_value)
-                    is_header = False
-                    continue
-                
-                # Data Row
-                row_data = {}
-                for i, cell_value in enumerate(row):
-                    if i in header_map:
-                        row_data[header_map[i]] = cell_value
-                
-                rows.append(row_data)
-            
-            wb.close()
-        
-        # 2. Process Rows
-        carteirinhas_data = []
-        errors = []
-        
-        # Check required columns
-        if rows:
-             first_row_keys = rows[0].keys()
-             if 'Carteirinha' not in first_row_keys:
-                  raise HTTPException(status_code=400, detail=f"Arquivo inválido. Coluna 'Carteirinha' não encontrada. Colunas encontradas: {list(first_row_keys)}")
-        else:
-             # Empty file logic
-             pass 
+        file.file.seek(0)
+
+        if method == "copy":
+            # COPY into a staging table + one set-based merge; invalid rows go to a rejection report
+            import_id = import_service.new_import_id()
+            result = carteirinha_service.copy_import_carteirinhas(
+                db, file.file, file.filename, import_service.rejection_report_path(import_id)
+            )
+            db.commit()
+            return {
+                "message": "Upload processed successfully",
+                **result,
+                "total_processed": result["added"] + result["updated"] + result["unchanged"],
+                "rejections_url": f"/carteirinhas/imports/{import_id}/rejections"
+            }
 
-        for index, row in enumerate(rows):
-            cart_raw = row.get('Carteirinha')
-            cart = str(cart_raw).strip() if cart_raw is not None else ""
-            
-            paciente_raw = row.get('Paciente')
-            paciente = str(paciente_raw).strip() if paciente_raw is not None else ""
-            
-            # Convert IDs to integers
-            id_paciente = None
-            id_pagamento = None
-            
-            if 'IdPaciente' in row and row['IdPaciente']:
-                try:
-                    val = str(row['IdPaciente']).strip()
-                    if val and val.lower() != 'nan' and val.lower() != 'none':
-                        id_paciente = int(float(val))
-                except (ValueError, TypeError):
-                    pass
-            
-            if 'IdPagamento' in row and row['IdPagamento']:
-                try:
-                    val = str(row['IdPagamento']).strip()
-                    if val and val.lower() != 'nan' and val.lower() != 'none':
-                        id_pagamento = int(float(val))
-                except (ValueError, TypeError):
-                    pass
-            
-            status_val = row.get('status', 'ativo')
-            if not status_val or str(status_val).lower() == 'nan':
-                status_val = 'ativo'
+        # The upload is already spooled to disk by Starlette: parse it as a stream
+        # and hand fixed-size batches to the writer instead of loading everything in memory.
+        errors = []
+        stats = {"rows_parsed": 0, "rows_valid": 0}
+        batches = carteirinha_service.iter_carteirinha_batches(file.file, file.filename, errors, stats=stats)
 
-            if cart and cart.lower() != 'nan' and cart.lower() != 'none':
-                try:
-                    validate_carteirinha_format(cart)
-                    carteirinhas_data.append({
-                        "carteirinha": cart,
-                        "paciente": paciente,
-                        "id_paciente": id_paciente,
-                        "id_pagamento": id_pagamento,
-                        "status": status_val
-                    })
-                except HTTPException as e:
-                    errors.append(f"Linha {index+2}: {e.detail}")
+        count_added, count_updated, _ = carteirinha_service.upsert_carteirinha_batches(db, batches)
 
         if errors:
+            # Nothing is committed if any row is invalid
+            db.rollback()
             raise HTTPException(status_code=400, detail="Erros de validação encontrados:\n" + "\n".join(errors[:10]) + ("..." if len(errors) > 10 else ""))
 
-        count_added = 0
-        count_updated = 0
-        
-        for item in carteirinhas_data:
-            existing = db.query(Carteirinha).filter(Carteirinha.carteirinha == item['carteirinha']).first()
-            if existing:
-                # Update existing record
-                changed = False
-                if existing.paciente != item['paciente']:
-                    existing.paciente = item['paciente']
-                    changed = True
-                if existing.id_paciente != item['id_paciente']:
-                    existing.id_paciente = item['id_paciente']
-                    changed = True
-                if existing.id_pagamento != item['id_pagamento']:
-                   existing.id_pagamento = item['id_pagamento']
-                   changed = True
-                
-                # Update status if provided in CSV (it defaults to 'ativo' in parsing if missing, 
-                # but if CSV has a column 'status', we want to use it).
-                # The parsing logic above sets 'status' to 'ativo' if missing/nan.
-                # So we effectively overwrite status with CSV or 'ativo'. 
-                # If we want to PRESERVE existing status if CSV is empty, we need to change parsing logic.
-                # User requirement: "ignore ou apenas atualize se tive algo diferente, staus, id,.."
-                # Assuming CSV is the source of truth for status too.
-                if existing.status != item['status']:
-                    existing.status = item['status']
-                    changed = True
-                
-                if changed:
-                    count_updated += 1
-            else:
-                 new_cart = Carteirinha(
-                     carteirinha=item['carteirinha'],
-                     paciente=item['paciente'],
-                     id_paciente=item.get('id_paciente'),
-                     id_pagamento=item.get('id_pagamento'),
-                     status=item.get('status', 'ativo')
-                 )
-                 db.add(new_cart)
-                 count_added += 1
-        
         db.commit()
         
         return {
             "message": "Upload processed successfully",
             "added": count_added,
             "updated": count_updated,
-            "total_processed": len(carteirinhas_data)
+            **carteirinha_service.upsert_summary(stats, count_added, count_updated),
+            "total_processed": stats["rows_valid"]
         }
 
     except HTTPException:
@@ -243,54 +89,130 @@ async def upload_carteirinhas(
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-@router.get("/")
+@router.get("/imports/{import_id}")
+def get_import_status(import_id: str, user: User = Depends(get_current_user)):
+    """Progress of an async upload: rows parsed/validated/written, errors and throughput."""
+    state = import_service.get_import(import_id)
+    if not state:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return state
+
+@router.get("/imports/{import_id}/rejections")
+def download_rejections(import_id: str, user: User = Depends(get_current_user)):
+    """Per-row rejection report (CSV) of an import made with method=copy."""
+    path = import_service.rejection_report_path(import_id)
+    if not state_files.valid_id(import_id) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Relatório de rejeições não encontrado")
+    return FileResponse(path, media_type="text/csv", filename=f"rejeicoes_{import_id}.csv")
+
+# Columns returned by the listing (projection instead of ORM objects)
+LIST_COLUMNS = (
+    Carteirinha.id, Carteirinha.carteirinha, Carteirinha.paciente, Carteirinha.id_paciente,
+    Carteirinha.id_pagamento, Carteirinha.status, Carteirinha.is_temporary, Carteirinha.expires_at,
+    Carteirinha.created_at, Carteirinha.updated_at
+)
+
+def apply_carteirinha_filters(query, search, status, id_pagamento, paciente):
+    # Text Search (General): prefix lookup for ids/carteirinhas, trigram ILIKE otherwise
+    if search and search.strip():
+        query = query.filter(search_service.carteirinha_search(search))
+        
+    # Specific Filters
+    if status:
+        query = query.filter(Carteirinha.status == status)
+        
+    if id_pagamento and id_pagamento.strip():
+        query = query.filter(search_service.id_prefix_filter(Carteirinha.id_pagamento, id_pagamento))
+        
+    if paciente:
+        query = query.filter(Carteirinha.paciente.ilike(f"%{paciente}%"))
+    return query
+
+@router.get("/", response_model=CarteirinhaPage)
 def list_carteirinhas(
+    request: Request,
     skip: int = 0, 
     limit: int = 100, 
     search: Optional[str] = None, 
     status: Optional[str] = None,
     id_pagamento: Optional[str] = None,
     paciente: Optional[str] = None,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     user: User = Depends(get_current_user)
 ):
-    query = db.query(Carteirinha)
+    query = apply_carteirinha_filters(db.query(*LIST_COLUMNS), search, status, id_pagamento, paciente)
     
-    # Text Search (General)
-    if search:
-        search_filter = f"%{search}%"
-        # Cast integer columns to string for LIKE search
-        query = query.filter(
-            or_(
-                Carteirinha.paciente.ilike(search_filter), 
-                Carteirinha.carteirinha.ilike(search_filter),
-                Carteirinha.id_paciente.cast(String).ilike(search_filter),
-                Carteirinha.id_pagamento.cast(String).ilike(search_filter)
-            )
-        )
-        
-    # Specific Filters
-    if status:
-        query = query.filter(Carteirinha.status == status)
-        
-    if id_pagamento:
-        query = query.filter(Carteirinha.id_pagamento.cast(String).ilike(f"%{id_pagamento}%"))
-        
-    if paciente:
-        query = query.filter(Carteirinha.paciente.ilike(f"%{paciente}%"))
-    
-    # Sort alphabetically by patient name
-    query = query.order_by(Carteirinha.paciente.asc())
-    
-    total = query.count()
-    carteirinhas = query.offset(skip).limit(limit).all()
+    total, total_exact = count_total(db, query, "carteirinhas", "carteirinhas", {
+        "search": search, "status": status, "id_pagamento": id_pagamento, "paciente": paciente
+    })
+
+    # Sort alphabetically by patient name (id as tie-breaker for the cursor)
+    carteirinhas, next_cursor = paginate(
+        query, [(Carteirinha.paciente, False), (Carteirinha.id, False)],
+        limit, skip=skip, cursor=cursor, key="carteirinhas"
+    )
     
-    return {
-        "data": carteirinhas,
+    return fast_json(request, {
+        "data": rows_to_dicts(carteirinhas),
         "total": total,
+        "total_exact": total_exact,
         "skip": skip,
-        "limit": limit
-    }
+        "limit": limit,
+        "next_cursor": next_cursor
+    })
+
+CARTEIRINHAS_EXPORT_HEADER = [
+    "ID", "Carteirinha", "Paciente", "ID Paciente", "ID Pagamento", "Status",
+    "Temporária", "Expira Em", "Criado Em", "Atualizado Em"
+]
+
+def carteirinha_xlsx_row(row) -> list:
+    def fmt(d): return d.strftime("%d/%m/%Y %H:%M:%S") if d else ""
+
+    return [
+        row.id,
+        row.carteirinha,
+        row.paciente or "",
+        row.id_paciente or "",
+        row.id_pagamento or "",
+        row.status or "",
+        "Sim" if row.is_temporary else "Não",
+        fmt(row.expires_at),
+        fmt(row.created_at),
+        fmt(row.updated_at)
+    ]
+
+# Tables whose changes invalidate cached exports (services/export_cache.py)
+EXPORT_TABLES = ("carteirinhas",)
+
+def build_export(fmt: str, progress: Optional[dict] = None, search=None, status=None, id_pagamento=None, paciente=None):
+    """Export body in the given format, streamed from a server-side cursor as rows arrive."""
+    def build_query(db):
+        return apply_carteirinha_filters(db.query(*LIST_COLUMNS), search, status, id_pagamento, paciente)
+
+    rows = export_stream.iter_query(build_query, progress)
+    if fmt == "xlsx":
+        return xlsx_stream.stream_xlsx((carteirinha_xlsx_row(row) for row in rows), "Carteirinhas", CARTEIRINHAS_EXPORT_HEADER)
+    return export_stream.stream_flat(rows, LIST_COLUMNS, fmt)
+
+@router.get("/export")
+def export_carteirinhas(
+    search: Optional[str] = None,
+    status: Optional[str] = None,
+    id_pagamento: Optional[str] = None,
+    paciente: Optional[str] = None,
+    format: str = "xlsx", # xlsx, csv, ndjson
+    user: User = Depends(get_current_user)
+):
+    export_stream.validate_format(format)
+
+    filters = {"search": search, "status": status, "id_pagamento": id_pagamento, "paciente": paciente}
+    return export_cache.cached_export(
+        "carteirinhas", filters, EXPORT_TABLES, format,
+        f"carteirinhas_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+        lambda: build_export(format, **filters)
+    )
 
 @router.post("/")
 def create_carteirinha(item: dict = Body(...), db: Session = Depends(get_db), user: User = Depends(get_current_user)):
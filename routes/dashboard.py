@@ -1,6 +1,11 @@
+import os
+import json
+import asyncio
 from fastapi import APIRouter, Depends
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
-from database import get_db
+from database import get_db, SessionLocal
 from models import Job, Carteirinha, BaseGuia
 from sqlalchemy import func, case
 
@@ -9,13 +14,19 @@ router = APIRouter(
     tags=["Dashboard"]
 )
 
-from dependencies import get_current_user
+from dependencies import get_current_user, get_current_user_or_sse_token, create_sse_token, SSE_TOKEN_TTL
+from services import notifier
+
+SSE_KEEPALIVE_SECONDS = int(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
 
 @router.get("/stats")
 def get_dashboard_stats(
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
+    return collect_stats(db)
+
+def collect_stats(db: Session) -> dict:
     # Simple counts
     total_carteirinhas = db.query(Carteirinha).count()
     total_guias = db.query(BaseGuia).count()
@@ -46,3 +57,56 @@ def get_dashboard_stats(
             "pending": jobs_pending
         }
     }
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def _stats_snapshot() -> dict:
+    db = SessionLocal()
+    try:
+        return collect_stats(db)
+    finally:
+        db.close()
+
+@router.post("/events/token")
+def create_events_token(
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """Short-lived token for GET /dashboard/events?token=..., requested before each (re)connect."""
+    return {"token": create_sse_token(current_user.id, db), "expires_in": SSE_TOKEN_TTL}
+
+@router.get("/events")
+async def dashboard_events(current_user = Depends(get_current_user_or_sse_token)):
+    """
+    Server-Sent Events for the dashboard: one `stats` snapshot on connect, then `jobs`
+    events with status transitions and counter deltas (pending/processing/success/error/
+    total) as they happen. A `resync` event means events were lost and the client should
+    reload the snapshot. EventSource cannot send headers, so it passes a token from
+    POST /dashboard/events/token as ?token= (the API key is not accepted there).
+    """
+    async def stream():
+        # Subscribe before taking the snapshot so no transition falls in between
+        with notifier.broadcaster.subscribe(notifier.JOB_EVENTS_CHANNEL, maxsize=1000) as subscription:
+            snapshot = await run_in_threadpool(_stats_snapshot)
+            yield "retry: 5000\n\n" + _sse("stats", snapshot)
+
+            dropped = 0
+            while True:
+                try:
+                    _, payload = await asyncio.wait_for(subscription.get(), SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                if subscription.dropped != dropped or (payload or {}).get("reconnected"):
+                    dropped = subscription.dropped
+                    yield _sse("resync", {})
+                else:
+                    yield _sse("jobs", payload)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
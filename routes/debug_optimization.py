@@ -2,6 +2,8 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy import text
 from database import get_db, engine
 from sqlalchemy.orm import Session
+from dependencies import get_current_user
+from models import User
 
 router = APIRouter(
     prefix="/debug",
@@ -76,3 +78,37 @@ def force_db_indexes(db: Session = Depends(get_db)):
         "message": "Optimization complete",
         "log": web_log
     }
+
+@router.get("/auth-cache")
+def auth_cache_stats(user: User = Depends(get_current_user)):
+    """Hit/miss counters of the in-process API key cache."""
+    from dependencies import auth_cache
+    return auth_cache.stats()
+
+@router.post("/auth-cache/clear")
+def clear_auth_cache(user: User = Depends(get_current_user)):
+    """
+    Empties the auth cache of the worker process that serves this request only; other
+    workers keep their entries until AUTH_CACHE_TTL runs out.
+    """
+    from dependencies import auth_cache
+    auth_cache.clear()
+    return {"status": "success", "message": "Auth cache cleared"}
+
+@router.get("/notifications")
+def notification_stats(user: User = Depends(get_current_user)):
+    """State of the LISTEN/NOTIFY listener and number of in-process subscribers."""
+    from services import notifier
+    return notifier.stats()
+
+@router.get("/export-cache")
+def export_cache_stats(user: User = Depends(get_current_user)):
+    """Size of the on-disk export cache and its hit/miss/eviction counters."""
+    from services import export_cache
+    return export_cache.stats()
+
+@router.get("/admission")
+def admission_stats(user: User = Depends(get_current_user)):
+    """Per route class (export, upload, fan-out): permits in use, queue depth, waits and rejections."""
+    from services import admission
+    return admission.stats()
@@ -0,0 +1,92 @@
+import os
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from typing import Optional
+from datetime import date, datetime
+from dependencies import get_current_user
+from models import User
+from services import export_service, export_stream, export_cache
+from routes import pei, guias, carteirinhas
+
+router = APIRouter(
+    prefix="/exports",
+    tags=["Exports"]
+)
+
+EXPORT_TYPES = ("pei", "guias", "carteirinhas")
+
+class ExportRequest(BaseModel):
+    """Same filters as GET /pei/export, /guias/export and /carteirinhas/export; only those of `type` are used."""
+    type: str # pei, guias, carteirinhas
+    format: str = "xlsx" # xlsx, csv, ndjson
+    # pei, carteirinhas
+    search: Optional[str] = None
+    status: Optional[str] = None
+    # pei
+    validade_start: Optional[date] = None
+    validade_end: Optional[date] = None
+    vencimento_filter: Optional[str] = None
+    # guias
+    created_at_start: Optional[date] = None
+    created_at_end: Optional[date] = None
+    carteirinha_id: Optional[int] = None
+    # carteirinhas
+    id_pagamento: Optional[str] = None
+    paciente: Optional[str] = None
+
+@router.post("/", status_code=202)
+def create_export(req: ExportRequest, user: User = Depends(get_current_user)):
+    """
+    Runs the export in the background export worker pool instead of inside the request.
+    Poll GET /exports/{id} until status is completed, then download from download_url.
+    """
+    if req.type not in EXPORT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Tipo de exportação inválido. Use: {', '.join(EXPORT_TYPES)}.")
+    export_stream.validate_format(req.format)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    # Same cache keys as the synchronous endpoints, so either one can reuse the other's file
+    if req.type == "pei":
+        filters = {
+            "search": req.search, "status": req.status, "validade_start": req.validade_start,
+            "validade_end": req.validade_end, "vencimento_filter": req.vencimento_filter
+        }
+        params, tables, filename, build = pei.export_cache_params(filters), pei.EXPORT_TABLES, f"export_pei_{timestamp}", pei.build_export
+    elif req.type == "guias":
+        filters = {"start_date": req.created_at_start, "end_date": req.created_at_end, "carteirinha_id": req.carteirinha_id}
+        params, tables, filename, build = filters, guias.EXPORT_TABLES, "guias_exportadas", guias.build_export
+    else:
+        filters = {"search": req.search, "status": req.status, "id_pagamento": req.id_pagamento, "paciente": req.paciente}
+        params, tables, filename, build = filters, carteirinhas.EXPORT_TABLES, f"carteirinhas_{timestamp}", carteirinhas.build_export
+
+    export_id = export_service.start_export(
+        req.type, req.format, params, tables, filename,
+        lambda progress: build(req.format, progress, **filters)
+    )
+    return {
+        "export_id": export_id,
+        "status_url": f"/exports/{export_id}"
+    }
+
+@router.get("/{export_id}")
+def get_export_status(export_id: str, user: User = Depends(get_current_user)):
+    """Progress of a background export: rows written so far and, once completed, the download URL."""
+    state = export_service.get_export(export_id)
+    if not state:
+        raise HTTPException(status_code=404, detail="Exportação não encontrada.")
+    return state
+
+@router.get("/{export_id}/download")
+def download_export(export_id: str, user: User = Depends(get_current_user)):
+    state = export_service.get_export(export_id)
+    if not state:
+        raise HTTPException(status_code=404, detail="Exportação não encontrada.")
+    if state["status"] != "completed":
+        raise HTTPException(status_code=409, detail="Exportação ainda não concluída.")
+
+    exported = export_service.open_export_file(state)
+    if exported is None:
+        raise HTTPException(status_code=410, detail="Arquivo de exportação expirado. Solicite a exportação novamente.")
+    response = export_stream.export_response(export_cache.read_file(exported), state["format"], state["filename"])
+    response.headers["Content-Length"] = str(os.fstat(exported.fileno()).st_size)
+    return response
@@ -1,21 +1,41 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.orm import Session
 from database import get_db
 from dependencies import get_current_user
 from models import BaseGuia, Carteirinha
 from typing import Optional
 from datetime import date, datetime, timedelta
-from openpyxl import Workbook
-import io
+from services import xlsx_stream, export_stream, export_cache
+from services.pagination import paginate
+from services.count_service import count_total
+from schemas import GuiaPage
+from responses import fast_json, rows_to_dicts
 
 router = APIRouter(
     prefix="/guias",
     tags=["Guias"]
 )
 
-@router.get("/")
+LIST_COLUMNS = (
+    BaseGuia.id, BaseGuia.carteirinha_id, BaseGuia.guia, BaseGuia.data_autorizacao, BaseGuia.senha,
+    BaseGuia.validade, BaseGuia.codigo_terapia, BaseGuia.qtde_solicitada, BaseGuia.sessoes_autorizadas,
+    BaseGuia.created_at, BaseGuia.updated_at
+)
+
+def apply_guia_filters(query, created_at_start: Optional[date], created_at_end: Optional[date], carteirinha_id: Optional[int]):
+    if created_at_start:
+        query = query.filter(BaseGuia.updated_at >= created_at_start)
+    if created_at_end:
+        # Inclusive end date (until end of day)
+        end_dt = datetime.combine(created_at_end, datetime.min.time()) + timedelta(days=1)
+        query = query.filter(BaseGuia.updated_at < end_dt)
+    if carteirinha_id:
+        query = query.filter(BaseGuia.carteirinha_id == carteirinha_id)
+    return query
+
+@router.get("/", response_model=GuiaPage)
 def list_guias(
+    request: Request,
     start_date: Optional[date] = None,
     end_date: Optional[date] = None,
     created_at_start: Optional[date] = None, 
@@ -23,100 +43,94 @@ def list_guias(
     carteirinha_id: Optional[int] = None,
     limit: int = 25,
     skip: int = 0,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    query = db.query(BaseGuia)
-    
-    if created_at_start:
-        query = query.filter(BaseGuia.updated_at >= created_at_start)
-    if created_at_end:
-        # Inclusive end date (until end of day)
-        end_dt = datetime.combine(created_at_end, datetime.min.time()) + timedelta(days=1)
-        query = query.filter(BaseGuia.updated_at < end_dt)
-    if carteirinha_id:
-        query = query.filter(BaseGuia.carteirinha_id == carteirinha_id)
+    query = apply_guia_filters(db.query(*LIST_COLUMNS), created_at_start, created_at_end, carteirinha_id)
 
-    total = query.count()
-    guias = query.order_by(BaseGuia.created_at.desc()).limit(limit).offset(skip).all()
+    total, total_exact = count_total(db, query, "base_guias", "guias", {
+        "created_at_start": created_at_start, "created_at_end": created_at_end, "carteirinha_id": carteirinha_id
+    })
+    guias, next_cursor = paginate(
+        query, [(BaseGuia.created_at, True), (BaseGuia.id, True)],
+        limit, skip=skip, cursor=cursor, key="guias"
+    )
     
-    return {"data": guias, "total": total, "skip": skip, "limit": limit}
+    return fast_json(request, {
+        "data": rows_to_dicts(guias), "total": total, "total_exact": total_exact,
+        "skip": skip, "limit": limit, "next_cursor": next_cursor
+    })
+
+# Columns of every export format (also the csv/ndjson field names)
+EXPORT_COLUMNS = (
+    Carteirinha.carteirinha,
+    Carteirinha.paciente,
+    BaseGuia.guia,
+    BaseGuia.data_autorizacao,
+    BaseGuia.senha,
+    BaseGuia.validade,
+    BaseGuia.codigo_terapia,
+    BaseGuia.qtde_solicitada,
+    BaseGuia.sessoes_autorizadas,
+    BaseGuia.created_at
+)
+
+GUIAS_EXPORT_HEADER = [
+    "Carteirinha", "Paciente", "Guia", "Data_Autorização", "Senha",
+    "Validade", "Código_Terapia", "Qtde_Solicitada", "Sessões Autorizadas", "Importado_Em"
+]
+
+def guias_xlsx_row(row) -> list:
+    def fmt_date(d):
+        return d.strftime("%d/%m/%Y") if d else ""
+
+    return [
+        row.carteirinha or "",
+        row.paciente or "",
+        row.guia,
+        fmt_date(row.data_autorizacao),
+        row.senha,
+        fmt_date(row.validade),
+        row.codigo_terapia,
+        row.qtde_solicitada,
+        row.sessoes_autorizadas,
+        row.created_at.strftime("%d/%m/%Y %H:%M:%S") if row.created_at else ""
+    ]
+
+# Tables whose changes invalidate cached exports (services/export_cache.py)
+EXPORT_TABLES = ("base_guias", "carteirinhas")
+
+def build_export(fmt: str, progress: Optional[dict] = None, start_date=None, end_date=None, carteirinha_id=None):
+    """Export body in the given format, streamed from a server-side cursor as rows arrive."""
+    def build_query(db):
+        # Column tuples avoid N+1 and lazy loading
+        query = db.query(*EXPORT_COLUMNS).select_from(BaseGuia).join(Carteirinha, BaseGuia.carteirinha_id == Carteirinha.id)
+        return apply_guia_filters(query, start_date, end_date, carteirinha_id)
+
+    rows = export_stream.iter_query(build_query, progress)
+    if fmt == "xlsx":
+        return xlsx_stream.stream_xlsx((guias_xlsx_row(row) for row in rows), "Guias", GUIAS_EXPORT_HEADER)
+    return export_stream.stream_flat(rows, EXPORT_COLUMNS, fmt)
 
 @router.get("/export")
 def export_guias(
     created_at_start: Optional[str] = Query(None, description="Start Date (YYYY-MM-DD)"),
     created_at_end: Optional[str] = Query(None, description="End Date (YYYY-MM-DD)"),
     carteirinha_id: Optional[int] = Query(None, description="Filter by Carteirinha ID"),
-    db: Session = Depends(get_db),
+    format: str = Query("xlsx", description="xlsx, csv or ndjson"),
     current_user = Depends(get_current_user)
 ):
-    # Optimized Excel Generation
+    export_stream.validate_format(format)
+    # Validated before streaming starts: once bytes are sent the status can no longer change
     try:
-        wb = Workbook(write_only=True)
-        ws = wb.create_sheet("Guias")
-        
-        headers = ["Carteirinha", "Paciente", "Guia", "Data_Autorização", "Senha", 
-                   "Validade", "Código_Terapia", "Qtde_Solicitada", "Sessões Autorizadas", "Importado_Em"]
-        ws.append(headers)
-        
-        # Helper to format date
-        def fmt_date(d):
-            return d.strftime("%d/%m/%Y") if d else ""
-
-        
-        print("DEBUG: Executing Query with raw tuples...")
-        # Use yield_per to reduce memory overhead and tuple selection to avoid N+1 and lazy loading issues
-        query = db.query(
-            Carteirinha.carteirinha,         # 0
-            Carteirinha.paciente,            # 1
-            BaseGuia.guia,                   # 2
-            BaseGuia.data_autorizacao,       # 3
-            BaseGuia.senha,                  # 4
-            BaseGuia.validade,               # 5
-            BaseGuia.codigo_terapia,         # 6
-            BaseGuia.qtde_solicitada,        # 7
-            BaseGuia.sessoes_autorizadas,    # 8
-            BaseGuia.created_at              # 9
-        ).select_from(BaseGuia).join(Carteirinha, BaseGuia.carteirinha_id == Carteirinha.id)
-
-        if created_at_start:
-            query = query.filter(BaseGuia.updated_at >= created_at_start)
-        if created_at_end:
-            # Add one day to include full end date
-            end_dt = datetime.strptime(created_at_end, '%Y-%m-%d').date() + timedelta(days=1)
-            query = query.filter(BaseGuia.updated_at <= str(end_dt))
-        if carteirinha_id:
-            query = query.filter(BaseGuia.carteirinha_id == carteirinha_id)
-        
-        results = query.yield_per(1000)
-        
-        count = 0
-        for row in results:
-            count += 1
-            ws.append([
-                row.carteirinha or "",
-                row.paciente or "",
-                row.guia,
-                fmt_date(row.data_autorizacao),
-                row.senha,
-                fmt_date(row.validade),
-                row.codigo_terapia,
-                row.qtde_solicitada,
-                row.sessoes_autorizadas,
-                row.created_at.strftime("%d/%m/%Y %H:%M:%S") if row.created_at else ""
-            ])
+        start_date = datetime.strptime(created_at_start, '%Y-%m-%d').date() if created_at_start else None
+        end_date = datetime.strptime(created_at_end, '%Y-%m-%d').date() if created_at_end else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Data inválida: {str(e)}")
 
-        print(f"DEBUG: Processed {count} rows. Saving Workbook...")
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        
-        headers = {
-            'Content-Disposition': 'attachment; filename="guias_exportadas.xlsx"'
-        }
-        return StreamingResponse(output, headers=headers, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    except Exception as e:
-        print(f"Export Error: {e}")
-        # Return the actual error details for debugging instead of generic 500
-        # In production this might be bad, but for debugging now it's essential
-        raise HTTPException(status_code=500, detail=f"Erro ao gerar arquivo: {str(e)}")
+    filters = {"start_date": start_date, "end_date": end_date, "carteirinha_id": carteirinha_id}
+    return export_cache.cached_export(
+        "guias", filters, EXPORT_TABLES, format, "guias_exportadas",
+        lambda: build_export(format, **filters)
+    )
@@ -1,11 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, Body, Query
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Body, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from dependencies import get_current_user
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from database import get_db
-from models import Job, Carteirinha
+from models import Job, Carteirinha, Log
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import date, datetime, timedelta
+from services import job_service, notifier
+from services.pagination import paginate
+from services.count_service import count_total
+from schemas import JobPage
+from responses import fast_json, rows_to_dicts
 
 router = APIRouter(
     prefix="/jobs",
@@ -21,47 +29,120 @@ class CreateJobRequest(BaseModel):
     carteirinha_ids: Optional[List[int]] = None
     temp_patient: Optional[TemporaryPatientData] = None
 
+class ClaimJobsRequest(BaseModel):
+    worker_id: str # Stored in Job.locked_by (server URL / worker name)
+    limit: int = Field(1, ge=1, le=100)
+    lease_seconds: int = Field(600, ge=30, le=86400)
+
+class GuiaResult(BaseModel):
+    guia: str
+    data_autorizacao: Optional[date] = None
+    senha: Optional[str] = None
+    validade: Optional[date] = None
+    codigo_terapia: Optional[str] = None
+    qtde_solicitada: Optional[int] = None
+    sessoes_autorizadas: Optional[int] = None
+
+class CompleteJobRequest(BaseModel):
+    worker_id: Optional[str] = None
+    guias: List[GuiaResult] = []
+    message: Optional[str] = None
+
+class FailJobRequest(BaseModel):
+    worker_id: Optional[str] = None
+    message: Optional[str] = None
+
 @router.post("/")
 def create_jobs(
     request: CreateJobRequest, 
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    created_count = 0
-    from services import job_service
     
     if request.type == 'all':
-        created_count = job_service.create_all_jobs(db)
+        created_count, skipped_count = job_service.create_all_jobs(db)
             
     elif request.type in ['single', 'multiple']:
         if not request.carteirinha_ids:
              raise HTTPException(status_code=400, detail="carteirinha_ids required for single/multiple")
         
-        created_count = job_service.create_jobs_bulk(db, request.carteirinha_ids)
+        created_count, skipped_count = job_service.create_jobs_bulk(db, request.carteirinha_ids)
     
     elif request.type == 'temp':
         if not request.temp_patient:
              raise HTTPException(status_code=400, detail="temp_patient data required for temp job")
              
-        created_count = job_service.create_temp_job(db, request.temp_patient.carteirinha, request.temp_patient.paciente)
+        created_count, skipped_count = job_service.create_temp_job(db, request.temp_patient.carteirinha, request.temp_patient.paciente)
                 
     else:
         raise HTTPException(status_code=400, detail="Invalid job type")
 
     db.commit()
-    return {"message": f"Created/Queued jobs", "count": created_count}
+    return {"message": f"Created/Queued jobs", "count": created_count, "created": created_count, "skipped": skipped_count}
+
+LIST_COLUMNS = (
+    Job.id, Job.carteirinha_id, Job.status, Job.attempts, Job.priority, Job.locked_by,
+    Job.timeout, Job.next_attempt_at, Job.created_at, Job.updated_at
+)
+
+@router.post("/claim")
+def claim_jobs(
+    request: ClaimJobsRequest,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """
+    Leases up to `limit` pending jobs to a worker (status -> processing, locked_by, timeout)
+    and returns them with the carteirinha data, in a single round trip.
+    """
+
+    jobs = job_service.claim_jobs(db, request.worker_id, request.limit, request.lease_seconds)
+    db.commit()
+    return {"data": jobs, "count": len(jobs)}
+
+@router.get("/wait")
+async def wait_for_jobs(
+    timeout: float = Query(30, ge=0, le=60),
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """
+    Long poll for workers: returns as soon as a job can be claimed (immediately if one
+    already can), or {"available": false} after `timeout` seconds. Woken by NOTIFY on
+    job creation and by the earliest scheduled retry, so workers do not poll the table.
+    """
 
-@router.get("/")
+    deadline = asyncio.get_running_loop().time() + timeout
+    # Subscribe before checking so a job created in between is not missed
+    with notifier.broadcaster.subscribe(notifier.JOBS_CHANNEL) as subscription:
+        while True:
+            wait_for = await run_in_threadpool(job_service.next_claimable_in, db)
+            # Release the pooled connection while idle
+            await run_in_threadpool(db.close)
+            if wait_for == 0:
+                return {"available": True}
+
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return {"available": False}
+            try:
+                await asyncio.wait_for(subscription.get(), min(remaining, wait_for or remaining))
+            except asyncio.TimeoutError:
+                pass
+
+@router.get("/", response_model=JobPage)
 def list_jobs(
+    request: Request,
     status: Optional[str] = None,
     created_at_start: Optional[date] = None,
     created_at_end: Optional[date] = None,
     limit: int = 25, 
     skip: int = 0,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    query = db.query(Job)
+    query = db.query(*LIST_COLUMNS)
     
     if status:
         query = query.filter(Job.status == status)
@@ -72,12 +153,19 @@ def list_jobs(
         end_dt = datetime.combine(created_at_end, datetime.min.time()) + timedelta(days=1)
         query = query.filter(Job.created_at < end_dt)
     
-    # Order by priority desc, created_at asc
-    total = query.count()
-    jobs = query.order_by(Job.priority.desc(), Job.created_at.desc()).limit(limit).offset(skip).all()
-    # Note: Changed order to desc created_at to show newest first
+    total, total_exact = count_total(db, query, "jobs", "jobs", {
+        "status": status, "created_at_start": created_at_start, "created_at_end": created_at_end
+    })
+    # Order by priority desc, created_at desc (newest first), id as tie-breaker for the cursor
+    jobs, next_cursor = paginate(
+        query, [(Job.priority, True), (Job.created_at, True), (Job.id, True)],
+        limit, skip=skip, cursor=cursor, key="jobs"
+    )
     
-    return {"data": jobs, "total": total, "skip": skip, "limit": limit}
+    return fast_json(request, {
+        "data": rows_to_dicts(jobs), "total": total, "total_exact": total_exact,
+        "skip": skip, "limit": limit, "next_cursor": next_cursor
+    })
 
 @router.delete("/{id}")
 def delete_job(id: int, db: Session = Depends(get_db)):
@@ -96,6 +184,7 @@ def delete_job(id: int, db: Session = Depends(get_db)):
          raise HTTPException(status_code=400, detail="Exclusão permitida apenas para Jobs com erro e mais de 3 tentativas.")
          
     db.delete(job)
+    job_service.notify_job_events(db, {"error": -1, "total": -1}, [{"id": id, "status": "deleted"}])
     db.commit()
     return {"message": "Job deleted"}
 
@@ -119,7 +208,54 @@ def retry_job(id: int, db: Session = Depends(get_db)):
     job.status = 'pending'
     job.attempts = 0
     job.locked_by = None
+    job.timeout = None
+    job.next_attempt_at = None
     job.updated_at = datetime.utcnow()
     
-    db.commit()
+    job_service.wake_workers(db, 1)
+    job_service.notify_job_events(db, {"error": -1, "pending": 1}, [{"id": job.id, "status": "pending"}])
+    try:
+        db.commit()
+    except IntegrityError:
+        # Partial unique index: only one pending/processing job per carteirinha
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Já existe um Job ativo para esta carteirinha.")
     return {"message": "Job queued for retry", "status": job.status}
+
+@router.post("/{id}/fail")
+def fail_job(
+    id: int,
+    request: Optional[FailJobRequest] = None,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """
+    Called by a worker when processing a leased job failed. The job goes back to 'pending'
+    with an exponential backoff (next_attempt_at), or to 'error' once attempts are exhausted.
+    """
+
+    request = request or FailJobRequest()
+    job = job_service.fail_job(db, id, request.worker_id)
+    if request.message:
+        db.add(Log(job_id=id, carteirinha_id=job["carteirinha_id"], level="ERROR", message=request.message))
+    db.commit()
+    return job
+
+@router.post("/{id}/complete")
+def complete_job(
+    id: int,
+    request: CompleteJobRequest,
+    db: Session = Depends(get_db),
+    current_user = Depends(get_current_user)
+):
+    """
+    Called by a worker with every guia scraped for the job's carteirinha. Guias are upserted
+    on (carteirinha_id, guia), the job is marked 'success', a Log entry is added and the
+    affected PEI rows are recomputed once, all in a single transaction.
+    """
+
+    result = job_service.complete_job(
+        db, id, [guia.model_dump() for guia in request.guias], request.worker_id, request.message
+    )
+    db.commit()
+    return result
@@ -3,6 +3,8 @@ from sqlalchemy.orm import Session
 from database import get_db
 from models import Log, Carteirinha, Job
 from typing import List, Optional
+from services.pagination import paginate
+from services.count_service import count_total
 
 router = APIRouter(
     tags=["Logs"]
@@ -14,6 +16,7 @@ def list_logs(
     limit: int = 50, 
     level: Optional[str] = None, 
     job_id: Optional[int] = None,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
     query = db.query(Log).join(Job, isouter=True).join(Carteirinha, isouter=True)
@@ -23,8 +26,11 @@ def list_logs(
     if job_id:
         query = query.filter(Log.job_id == job_id)
     
-    total = query.count()
-    logs = query.order_by(Log.created_at.desc()).offset(skip).limit(limit).all()
+    total, total_exact = count_total(db, query, "logs", "logs", {"level": level, "job_id": job_id})
+    logs, next_cursor = paginate(
+        query, [(Log.created_at, True), (Log.id, True)],
+        limit, skip=skip, cursor=cursor, key="logs"
+    )
     
     # Return enriched data
     data = []
@@ -42,6 +48,8 @@ def list_logs(
     return {
         "data": data,
         "total": total,
+        "total_exact": total_exact,
         "skip": skip,
-        "limit": limit
+        "limit": limit,
+        "next_cursor": next_cursor
     }
@@ -1,16 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, Body, Query
+from fastapi import APIRouter, Depends, HTTPException, Body, Query, Request
 from fastapi.responses import Response
 from sqlalchemy.orm import Session
 from database import get_db
 from dependencies import get_current_user
 from models import PatientPei, PeiTemp, BaseGuia, Carteirinha
 from services.pei_service import update_patient_pei
+from services.search_service import pei_search
+from services.pagination import paginate
+from services.count_service import count_total
+from services import pei_stats_service, pei_rebuild_service, xlsx_stream, export_stream, export_cache
+from responses import fast_json
 from pydantic import BaseModel
 from typing import Optional, List
 from datetime import date, timedelta, datetime
 from sqlalchemy import func, or_, text
-import io
-import openpyxl
 
 router = APIRouter(
     prefix="/pei",
@@ -22,16 +25,9 @@ class PeiOverrideRequest(BaseModel):
     pei_semanal: float
 
 def apply_filters(query, search, status, validade_start, validade_end, vencimento_filter):
-    # Text Search (Patient, Carteirinha, Therapy)
-    if search:
-        search_term = f"%{search}%"
-        query = query.filter(
-            or_(
-                Carteirinha.paciente.ilike(search_term),
-                Carteirinha.carteirinha.ilike(search_term),
-                PatientPei.codigo_terapia.ilike(search_term)
-            )
-        )
+    # Text Search (Patient, Carteirinha, Therapy) - see services/search_service.py
+    if search and search.strip():
+        query = query.filter(pei_search(search))
     
     # Status Enum
     if status:
@@ -62,43 +58,13 @@ def get_dashboard_stats(
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
-    today = date.today()
-    
-    # Base query for active patients? Or just all?
-    # Stats: Vencidos, Vence D+7, Vence D+30
-    
-    # Vencidos
-    vencidos = db.query(func.count(PatientPei.id)).filter(PatientPei.validade < today).scalar()
-    
-    # Vence D+7
-    d7_end = today + timedelta(days=7)
-    vence_d7 = db.query(func.count(PatientPei.id)).filter(
-        PatientPei.validade >= today, 
-        PatientPei.validade <= d7_end
-    ).scalar()
-    
-    # Vence D+30
-    d30_end = today + timedelta(days=30)
-    vence_d30 = db.query(func.count(PatientPei.id)).filter(
-        PatientPei.validade >= today, 
-        PatientPei.validade <= d30_end
-    ).scalar()
-    
-    total = db.query(func.count(PatientPei.id)).scalar()
-    pendentes = db.query(func.count(PatientPei.id)).filter(PatientPei.status == 'Pendente').scalar()
-    validados = db.query(func.count(PatientPei.id)).filter(PatientPei.status == 'Validado').scalar()
-
-    return {
-        "total": total,
-        "vencidos": vencidos or 0,
-        "vence_d7": vence_d7 or 0,
-        "vence_d30": vence_d30 or 0,
-        "pendentes": pendentes or 0,
-        "validados": validados or 0
-    }
+    # Vencidos, Vence D+7, Vence D+30, pendentes and validados (overall and per therapy)
+    # in a single cached query - see services/pei_stats_service.py
+    return pei_stats_service.get_pei_stats(db)
 
 @router.get("/")
 def list_pei(
+    request: Request,
     page: int = 1,
     pageSize: int = 50,
     search: Optional[str] = None,
@@ -106,6 +72,7 @@ def list_pei(
     validade_start: Optional[date] = None,
     validade_end: Optional[date] = None,
     vencimento_filter: Optional[str] = None, # vencidos, vence_d7, vence_d30
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user = Depends(get_current_user)
 ):
@@ -129,11 +96,17 @@ def list_pei(
     
     query = apply_filters(query, search, status, validade_start, validade_end, vencimento_filter)
     
-    total_items = query.count()
+    total_items, total_exact = count_total(db, query, "patient_pei", "pei", {
+        "search": search, "status": status, "validade_start": validade_start,
+        "validade_end": validade_end, "vencimento_filter": vencimento_filter
+    })
     
-    # Pagination
+    # Pagination (page/pageSize, or keyset when a cursor is sent)
     skip = (page - 1) * pageSize
-    results = query.order_by(PatientPei.status.asc(), PatientPei.updated_at.desc()).offset(skip).limit(pageSize).all()
+    results, next_cursor = paginate(
+        query, [(PatientPei.status, False), (PatientPei.updated_at, True), (PatientPei.id, True)],
+        pageSize, skip=skip, cursor=cursor, key="pei"
+    )
     
     data = []
     for row in results:
@@ -152,12 +125,78 @@ def list_pei(
             "updated_at": row.updated_at
         })
 
-    return {
+    return fast_json(request, {
         "data": data,
         "total": total_items,
+        "total_exact": total_exact,
         "page": page,
-        "pageSize": pageSize
-    }
+        "pageSize": pageSize,
+        "next_cursor": next_cursor
+    })
+
+# Columns of every export format (also the csv/ndjson field names)
+EXPORT_COLUMNS = (
+    Carteirinha.id_paciente,
+    Carteirinha.paciente,
+    Carteirinha.carteirinha,
+    Carteirinha.id_pagamento,
+    PatientPei.codigo_terapia,
+    BaseGuia.guia,
+    BaseGuia.data_autorizacao,
+    BaseGuia.senha,
+    BaseGuia.sessoes_autorizadas,
+    PatientPei.pei_semanal,
+    PatientPei.validade,
+    PatientPei.status,
+    PatientPei.updated_at
+)
+
+PEI_EXPORT_HEADER = [
+    "ID Paciente", "Paciente", "Carteirinha", "ID Pagamento", "Código Terapia",
+    "Guia Vinculada", "Data Autorização", "Senha", "Qtd Autorizada",
+    "PEI Semanal", "Validade", "Status", "Atualizado Em"
+]
+
+def pei_xlsx_row(row) -> list:
+    def fmt(d): return d.strftime("%d/%m/%Y") if d else ""
+
+    return [
+        row.id_paciente or "",
+        row.paciente or "",
+        row.carteirinha or "",
+        row.id_pagamento or "",
+        row.codigo_terapia,
+        row.guia or "-",
+        fmt(row.data_autorizacao),
+        row.senha or "-",
+        row.sessoes_autorizadas or 0,
+        row.pei_semanal,
+        fmt(row.validade),
+        row.status if row.status else "Pendente",
+        fmt(row.updated_at)
+    ]
+
+# Tables whose changes invalidate cached exports (services/export_cache.py)
+EXPORT_TABLES = ("patient_pei", "carteirinhas", "base_guias")
+
+def export_cache_params(filters: dict) -> dict:
+    # Vencimento filters are relative to today, so the date is part of the cache key
+    return {**filters, "today": date.today()}
+
+def build_export(fmt: str, progress: Optional[dict] = None, search=None, status=None,
+                 validade_start=None, validade_end=None, vencimento_filter=None):
+    """Export body in the given format, streamed from a server-side cursor as rows arrive."""
+    def build_query(db):
+        # Column tuples only: no ORM objects, no N+1 loads
+        query = db.query(*EXPORT_COLUMNS).select_from(PatientPei)\
+            .join(Carteirinha, PatientPei.carteirinha_id == Carteirinha.id)\
+            .outerjoin(BaseGuia, PatientPei.base_guia_id == BaseGuia.id)
+        return apply_filters(query, search, status, validade_start, validade_end, vencimento_filter)
+
+    rows = export_stream.iter_query(build_query, progress)
+    if fmt == "xlsx":
+        return xlsx_stream.stream_xlsx((pei_xlsx_row(row) for row in rows), "PEI Export", PEI_EXPORT_HEADER)
+    return export_stream.stream_flat(rows, EXPORT_COLUMNS, fmt)
 
 @router.get("/export")
 def export_pei(
@@ -166,187 +205,19 @@ def export_pei(
     validade_start: Optional[date] = None,
     validade_end: Optional[date] = None,
     vencimento_filter: Optional[str] = None,
-    db: Session = Depends(get_db),
+    format: str = "xlsx", # xlsx, csv, ndjson
     current_user = Depends(get_current_user)
 ):
-    print("DEBUG: Starting PEI Export...")
-    print("DEBUG: Starting PEI Export (Optimized)...")
-    try:
-        # Generate Excel (Write Only Mode for Performance)
-        wb = openpyxl.Workbook(write_only=True)
-        ws = wb.create_sheet("PEI Export")
-        
-        # Header
-        ws.append([
-            "ID Paciente", "Paciente", "Carteirinha", "ID Pagamento", "Código Terapia", 
-            "Guia Vinculada", "Data Autorização", "Senha", "Qtd Autorizada",
-            "PEI Semanal", "Validade", "Status", "Atualizado Em"
-        ])
-        
-        # Generator function for streaming rows
-        def generate_rows():
-            print("DEBUG: Executing Query...")
-            # Use yield_per to stream results from DB instead of loading all into memory
-            query = db.query(PatientPei).join(Carteirinha).outerjoin(BaseGuia, PatientPei.base_guia_id == BaseGuia.id)
-            query = apply_filters(query, search, status, validade_start, validade_end, vencimento_filter)
-            
-            # Fetch in chunks to reduce memory usage
-            # Note: SQLite might not support yield_per strictly, but it's good practice. 
-            # In sync mode with small datasets it's fine.
-            # For strict speed we could fetch raw tuples but ORM is cleaner.
-            
-            results = query.yield_per(500)
-            
-            count = 0
-            for row in results:
-                count += 1
-                # Handle timezone naive
-                updated_at_val = row.updated_at
-                if updated_at_val and updated_at_val.tzinfo:
-                    updated_at_val = updated_at_val.replace(tzinfo=None)
-                
-                # Base Guia Helpers
-                guia_num = row.base_guia_rel.guia if row.base_guia_rel else "-"
-                data_auth = row.base_guia_rel.data_autorizacao if row.base_guia_rel else None
-                senha = row.base_guia_rel.senha if row.base_guia_rel else "-"
-                qtd_aut = row.base_guia_rel.sessoes_autorizadas if row.base_guia_rel else 0
-                
-                # ID Paciente
-                id_paciente_real = row.carteirinha_rel.id_paciente if row.carteirinha_rel else ""
-                id_pagamento_val = row.carteirinha_rel.id_pagamento if row.carteirinha_rel and row.carteirinha_rel.id_pagamento else ""
-
-                ws.append([
-                    id_paciente_real,
-                    row.carteirinha_rel.paciente if row.carteirinha_rel else "",
-                    row.carteirinha_rel.carteirinha if row.carteirinha_rel else "",
-                    id_pagamento_val,
-                    row.codigo_terapia,
-                    guia_num,
-                    data_auth.strftime("%d/%m/%Y") if data_auth else "",
-                    senha,
-                    qtd_aut,
-                    row.pei_semanal,
-                    row.validade.strftime("%d/%m/%Y") if row.validade else "",
-                    row.status if row.status else "Pendente",
-                    updated_at_val.strftime("%d/%m/%Y") if updated_at_val else ""
-                ])
-            print(f"DEBUG: Processed {count} rows.")
-            
-            # After adding all rows to worksheet, save to stream
-            output = io.BytesIO()
-            wb.save(output)
-            output.seek(0)
-            yield output.getvalue()
-
-        filename = f"export_pei_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        
-        headers = {
-            'Content-Disposition': f'attachment; filename="{filename}"'
-        }
-        
-        from fastapi.responses import StreamingResponse
-        # Note: StreamingResponse with yield is tricky for zip/xlsx because headers are at the end.
-        # Ideally we buffer the whole xlsx. 
-        # But 'generate_rows' here yields ONE big chunk. 
-        # To truly stream xlsx we need to yield chunks of bytes which openpyxl doesn't support easily.
-        # So we just optimize the building part.
-        
-        # We can't yield parts of a zip file easily. So we just call the generator to get the bytes.
-        # But wait, StreamingResponse expects an iterator of bytes.
-        
-        # Reverting to direct save but kept write_only=True which is faster.
-        
-        output = io.BytesIO()
-        wb.save(output) # This will fail if no rows added yet? No.
-        
-        # Re-implementing correctly: iterate query, write to wb, then save.
-        pass
-
-    except Exception as e:
-        print(f"DEBUG: Export Error: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Erro ao exportar: {str(e)}")
-    
-    try:
-        # Generate Excel (Write Only Mode for Performance)
-        wb = openpyxl.Workbook(write_only=True)
-        ws = wb.create_sheet("PEI Export")
-        
-        # Header
-        ws.append([
-            "ID Paciente", "Paciente", "Carteirinha", "ID Pagamento", "Código Terapia", 
-            "Guia Vinculada", "Data Autorização", "Senha", "Qtd Autorizada",
-            "PEI Semanal", "Validade", "Status", "Atualizado Em"
-        ])
-        
-        print("DEBUG: Executing Query (Raw Tuples)...")
-        # Optimization: Select ONLY the columns we need as a tuple
-        # This prevents SQLAlchemy from creating thousands of objects and doing N+1 loads
-        query = db.query(
-            Carteirinha.id_paciente,          # 0
-            Carteirinha.paciente,             # 1
-            Carteirinha.carteirinha,          # 2
-            Carteirinha.id_pagamento,         # 3 - REQUESTED FIELD
-            PatientPei.codigo_terapia,        # 4
-            BaseGuia.guia,                    # 5
-            BaseGuia.data_autorizacao,        # 6
-            BaseGuia.senha,                   # 7
-            BaseGuia.sessoes_autorizadas,     # 8
-            PatientPei.pei_semanal,           # 9
-            PatientPei.validade,              # 10
-            PatientPei.status,                # 11
-            PatientPei.updated_at             # 12
-        ).select_from(PatientPei)\
-         .join(Carteirinha, PatientPei.carteirinha_id == Carteirinha.id)\
-         .outerjoin(BaseGuia, PatientPei.base_guia_id == BaseGuia.id)
-        
-        query = apply_filters(query, search, status, validade_start, validade_end, vencimento_filter)
-        
-        # Use yield_per to stream results from DB
-        results = query.yield_per(1000)
-        
-        count = 0
-        for row in results:
-            count += 1
-            # Row is now a tuple, access by index or name
-            
-            # Handle timezone naive
-            updated_at_val = row.updated_at
-            if updated_at_val and updated_at_val.tzinfo:
-                updated_at_val = updated_at_val.replace(tzinfo=None)
-            
-            # Helper for dates
-            def fmt(d): return d.strftime("%d/%m/%Y") if d else ""
-
-            ws.append([
-                row.id_paciente or "",                  # ID Paciente
-                row.paciente or "",                     # Paciente
-                row.carteirinha or "",                  # Carteirinha
-                row.id_pagamento or "",                 # ID Pagamento (Direct from select)
-                row.codigo_terapia,                     # Codigo Terapia
-                row.guia or "-",                        # Guia
-                fmt(row.data_autorizacao),              # Data Auth
-                row.senha or "-",                       # Senha
-                row.sessoes_autorizadas or 0,           # Qtd Aut
-                row.pei_semanal,                        # PEI
-                fmt(row.validade),                      # Validade
-                row.status if row.status else "Pendente", # Status
-                fmt(updated_at_val)                     # Atualizado Em
-            ])
-        
-        print(f"DEBUG: Processed {count} rows. Saving...")
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        
-        filename = f"export_pei_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
-        
-        from fastapi.responses import StreamingResponse
-        return StreamingResponse(output, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", headers=headers)
-
-    except Exception as e:
-        print(f"DEBUG: Export Error: {str(e)}")
-        raise HTTPException(status_code=400, detail=f"Erro ao exportar: {str(e)}")
+    export_stream.validate_format(format)
+    filters = {
+        "search": search, "status": status, "validade_start": validade_start,
+        "validade_end": validade_end, "vencimento_filter": vencimento_filter
+    }
+    return export_cache.cached_export(
+        "pei", export_cache_params(filters), EXPORT_TABLES, format,
+        f"export_pei_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+        lambda: build_export(format, **filters)
+    )
 
 @router.post("/override")
 def override_pei(
@@ -361,6 +232,7 @@ def override_pei(
         db.add(temp)
     else:
         temp.pei_semanal = req.pei_semanal
+    pei_stats_service.notify_pei_changed(db)
     db.commit()
     
 
@@ -379,3 +251,25 @@ def override_pei(
 
 # Note: update_patient_pei_backend removed as it is now in services/pei_service.py
 
+@router.post("/rebuild", status_code=202)
+def rebuild_pei(
+    mode: str = "full",
+    current_user = Depends(get_current_user)
+):
+    """
+    Recomputes patient_pei in the background (use after changing the PEI rules).
+    mode=full rebuilds everything and removes orphan rows; mode=incremental only
+    recomputes guias/overrides changed since the last rebuild.
+    """
+    rebuild_id = pei_rebuild_service.start_rebuild(mode)
+    return {"rebuild_id": rebuild_id, "status_url": f"/pei/rebuild/{rebuild_id}"}
+
+@router.get("/rebuild/{rebuild_id}")
+def get_rebuild_status(
+    rebuild_id: str,
+    current_user = Depends(get_current_user)
+):
+    state = pei_rebuild_service.get_rebuild(rebuild_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Reconstrução não encontrada.")
+    return state
@@ -0,0 +1,60 @@
+from pydantic import BaseModel
+from typing import List, Optional
+from datetime import date, datetime
+
+# Response models of the list endpoints. The routes build these rows from column
+# projections and serialize them with orjson (responses.fast_json), so the models
+# document the payload in OpenAPI without a per-object validation pass.
+
+class CarteirinhaOut(BaseModel):
+    id: int
+    carteirinha: str
+    paciente: Optional[str] = None
+    id_paciente: Optional[int] = None
+    id_pagamento: Optional[int] = None
+    status: Optional[str] = None
+    is_temporary: Optional[bool] = None
+    expires_at: Optional[datetime] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+class JobOut(BaseModel):
+    id: int
+    carteirinha_id: Optional[int] = None
+    status: str
+    attempts: Optional[int] = None
+    priority: Optional[int] = None
+    locked_by: Optional[str] = None
+    timeout: Optional[datetime] = None
+    next_attempt_at: Optional[datetime] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+class GuiaOut(BaseModel):
+    id: int
+    carteirinha_id: Optional[int] = None
+    guia: Optional[str] = None
+    data_autorizacao: Optional[date] = None
+    senha: Optional[str] = None
+    validade: Optional[date] = None
+    codigo_terapia: Optional[str] = None
+    qtde_solicitada: Optional[int] = None
+    sessoes_autorizadas: Optional[int] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+class Page(BaseModel):
+    total: int
+    total_exact: bool = True
+    skip: int
+    limit: int
+    next_cursor: Optional[str] = None
+
+class CarteirinhaPage(Page):
+    data: List[CarteirinhaOut]
+
+class JobPage(Page):
+    data: List[JobOut]
+
+class GuiaPage(Page):
+    data: List[GuiaOut]
@@ -0,0 +1,97 @@
+"""
+Benchmark bulk guia inserts with the per-row PEI trigger (migration 0006 behaviour)
+against the statement-level triggers (migration 0019).
+
+The "row" mode runs the original calculate_patient_pei() body, loaded from migration 0006
+(0018 later rewrote the function to delegate to recompute_patient_pei). Every run happens
+inside a transaction that is rolled back, but it swaps triggers on
+base_guias (ACCESS EXCLUSIVE lock), so run it against a local/staging database only.
+
+Usage: python scripts/benchmark_pei_trigger.py [--guias 40] [--therapies 2] [--patients 50] [--repeat 3]
+"""
+
+import sys
+import os
+import time
+import argparse
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+from database import engine
+
+STATEMENT_TRIGGERS = ("trigger_pei_guias_insert", "trigger_pei_guias_update")
+
+MIGRATION_0006 = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "migrations", "0006_create_pei_triggers.sql")
+
+ROW_TRIGGER_SQL = """
+CREATE TRIGGER benchmark_calc_pei_guia
+AFTER INSERT OR UPDATE ON base_guias
+FOR EACH ROW
+EXECUTE FUNCTION benchmark_calculate_patient_pei_0006()
+"""
+
+def original_row_function_sql() -> str:
+    """The CREATE FUNCTION calculate_patient_pei() statement of migration 0006, renamed."""
+    with open(MIGRATION_0006, encoding="utf-8") as f:
+        sql = f.read()
+    start = sql.index("CREATE OR REPLACE FUNCTION calculate_patient_pei()")
+    end = sql.index("$$ LANGUAGE plpgsql;", start) + len("$$ LANGUAGE plpgsql")
+    return sql[start:end].replace("calculate_patient_pei()", "benchmark_calculate_patient_pei_0006()", 1)
+
+def insert_batch(connection, patients: int, guias: int, therapies: int) -> float:
+    """Creates temporary patients and inserts all their guias in one INSERT ... SELECT."""
+    patient_ids = connection.execute(text("""
+        INSERT INTO carteirinhas (carteirinha, paciente, is_temporary)
+        SELECT 'BENCH-' || g || '-' || md5(random()::text), 'Benchmark ' || g, TRUE
+        FROM generate_series(1, :patients) g
+        RETURNING id
+    """), {"patients": patients}).scalars().all()
+
+    start = time.perf_counter()
+    connection.execute(text("""
+        INSERT INTO base_guias (carteirinha_id, guia, data_autorizacao, codigo_terapia, qtde_solicitada)
+        SELECT p.id,
+               'BENCH-' || p.id || '-' || g,
+               CURRENT_DATE - g,
+               'BENCH-T' || (g % :therapies),
+               16 + g
+        FROM unnest(CAST(:ids AS INTEGER[])) AS p(id)
+        CROSS JOIN generate_series(1, :guias) g
+    """), {"ids": patient_ids, "guias": guias, "therapies": therapies})
+    return time.perf_counter() - start
+
+def run(mode: str, args) -> float:
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            if mode == "row":
+                for trigger in STATEMENT_TRIGGERS:
+                    connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger} ON base_guias"))
+                connection.exec_driver_sql(original_row_function_sql())
+                connection.execute(text(ROW_TRIGGER_SQL))
+            return insert_batch(connection, args.patients, args.guias, args.therapies)
+        finally:
+            transaction.rollback()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guias", type=int, default=40, help="guias per patient")
+    parser.add_argument("--therapies", type=int, default=2, help="distinct codigo_terapia per patient")
+    parser.add_argument("--patients", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = args.patients * args.guias
+    print(f"Inserting {rows} guias ({args.patients} patients x {args.guias} guias, {args.therapies} therapies)")
+    results = {}
+    for mode in ("row", "statement"):
+        timings = [run(mode, args) for _ in range(args.repeat)]
+        best = min(timings)
+        results[mode] = best
+        print(f"  {mode:<9} best {best * 1000:8.1f} ms  ({rows / best:10.0f} guias/s)")
+
+    print(f"Speedup: {results['row'] / results['statement']:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Checks the admission controller under a burst: with limit=1 and queue=1, of 6 requests
+arriving in the same tick only 2 may be admitted, and the rest must get 429 + Retry-After
+(both at the controller level and through AdmissionMiddleware on POST /jobs/ type=all).
+No database is needed: the app behind the middleware is a stub that holds the permit briefly.
+
+Usage: python scripts/check_admission.py
+Exits with status 1 if any check fails.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import asyncio
+from services import admission
+from services.admission import AdmissionController, AdmissionMiddleware
+
+BURST = 6
+
+async def check_controller() -> list:
+    controller = AdmissionController("burst", limit=1, max_queue=1, timeout=5)
+
+    async def request():
+        if not await controller.acquire():
+            return False
+        await asyncio.sleep(0.05)
+        controller.release(0.05)
+        return True
+
+    results = await asyncio.gather(*(request() for _ in range(BURST)))
+    admitted = sum(results)
+    return [("controller admits limit + queue of a same-tick burst", admitted == 2, f"admitted {admitted}/{BURST}")]
+
+async def check_middleware() -> list:
+    admission.controllers["fan-out"] = AdmissionController("fan-out", limit=1, max_queue=1, timeout=5)
+
+    async def app(scope, receive, send):
+        await receive()
+        await asyncio.sleep(0.05)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    middleware = AdmissionMiddleware(app)
+
+    async def post_fan_out():
+        body = json.dumps({"type": "all"}).encode()
+        sent = []
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "POST", "path": "/jobs/", "headers": []}
+        await middleware(scope, receive, send)
+        start = sent[0]
+        return start["status"], dict(start["headers"]).get(b"retry-after")
+
+    responses = await asyncio.gather(*(post_fan_out() for _ in range(BURST)))
+    ok = sum(1 for status, _ in responses if status == 200)
+    rejected = [retry for status, retry in responses if status == 429]
+    return [
+        ("middleware admits limit + queue", ok == 2, f"{ok} x 200"),
+        ("middleware rejects the rest with 429", len(rejected) == BURST - 2, f"{len(rejected)} x 429"),
+        ("429 responses carry Retry-After", all(r and int(r) >= 1 for r in rejected), f"Retry-After {rejected}"),
+    ]
+
+def main():
+    checks = asyncio.run(check_controller()) + asyncio.run(check_middleware())
+    failures = 0
+    for description, ok, detail in checks:
+        failures += 0 if ok else 1
+        print(f"[{'OK' if ok else 'FAIL'}] {description}: {detail}")
+
+    if failures:
+        print(f"{failures} admission check(s) failed.")
+        sys.exit(1)
+    print("All admission checks passed.")
+
+if __name__ == "__main__":
+    main()
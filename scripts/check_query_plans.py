@@ -0,0 +1,93 @@
+"""
+Checks with EXPLAIN that the PEI hot queries can use their indexes (migrations 0014 and 0022).
+Sequential scans are disabled for the session so the result does not depend on how many
+rows the database has (on a small table Postgres would rightly prefer a seq scan).
+
+Usage: python scripts/check_query_plans.py
+Exits with status 1 if any query does not use its expected index.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+from sqlalchemy import text
+from database import engine
+
+CHECKS = [
+    (
+        "Latest guia per carteirinha + therapy (patient_pei_computed)",
+        "idx_base_guias_latest",
+        """
+        SELECT id FROM base_guias
+        WHERE carteirinha_id = 1 AND codigo_terapia = '50001'
+        ORDER BY data_autorizacao DESC, id DESC
+        LIMIT 1
+        """
+    ),
+    (
+        "patient_pei natural key lookup (ON CONFLICT target)",
+        "idx_patient_pei_carteirinha_terapia",
+        """
+        SELECT id FROM patient_pei
+        WHERE carteirinha_id = 1 AND codigo_terapia = '50001'
+        """
+    ),
+    (
+        "recompute_patient_pei upsert",
+        "idx_patient_pei_carteirinha_terapia",
+        """
+        INSERT INTO patient_pei AS p (carteirinha_id, codigo_terapia, base_guia_id, pei_semanal, validade, status)
+        SELECT c.carteirinha_id, c.codigo_terapia, c.base_guia_id, c.pei_semanal, c.validade, c.status
+        FROM patient_pei_computed(ARRAY[1], ARRAY['50001']) c
+        ON CONFLICT (carteirinha_id, codigo_terapia) DO UPDATE SET pei_semanal = EXCLUDED.pei_semanal
+        """
+    ),
+    (
+        "list_pei first page (ORDER BY status, updated_at DESC, id DESC)",
+        "idx_patient_pei_status_updated_id",
+        """
+        SELECT id FROM patient_pei
+        ORDER BY status ASC NULLS FIRST, updated_at DESC, id DESC
+        LIMIT 50
+        """
+    ),
+]
+
+def plan_indexes(node) -> set:
+    """Every index name referenced anywhere in an EXPLAIN (FORMAT JSON) plan tree."""
+    names = set()
+    if "Index Name" in node:
+        names.add(node["Index Name"])
+    if "Conflict Arbiter Indexes" in node:
+        names.update(node["Conflict Arbiter Indexes"])
+    for child in node.get("Plans", []):
+        names |= plan_indexes(child)
+    return names
+
+def main():
+    failures = 0
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            connection.execute(text("SET LOCAL enable_seqscan = off"))
+            for description, index, sql in CHECKS:
+                # EXPLAIN without ANALYZE: the INSERT is planned, not executed
+                plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                used = plan_indexes(plan[0]["Plan"])
+                ok = index in used
+                failures += 0 if ok else 1
+                print(f"[{'OK' if ok else 'FAIL'}] {description}: expected {index}, plan uses {sorted(used) or 'no index'}")
+        finally:
+            transaction.rollback()
+
+    if failures:
+        print(f"{failures} query plan check(s) failed.")
+        sys.exit(1)
+    print("All query plan checks passed.")
+
+if __name__ == "__main__":
+    main()
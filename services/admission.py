@@ -0,0 +1,205 @@
+import os
+import re
+import json
+import math
+import time
+import asyncio
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# Bodies of POST /jobs/ larger than this are not inspected (a type=all request is tiny)
+MAX_INSPECTED_BODY = 64 * 1024
+
+
+class AdmissionController:
+    """
+    Bounds how many requests of one route class run at once. Up to `limit` run, up to
+    `max_queue` more wait (at most `timeout` seconds) for a permit, anything beyond that is
+    rejected straight away so the connection pool stays free for cheap endpoints.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.max_wait_seconds = 0.0
+        self._total_wait = 0.0
+        self._avg_hold = 1.0 # seconds, moving average of how long a permit is held
+
+    async def acquire(self) -> bool:
+        # Checked and reserved before any await: requests arriving in the same tick (repeated
+        # clicks) each see the slots taken by the ones before them. semaphore.locked() would not,
+        # because wait_for only acquires it once its inner task runs.
+        if self.active + self.waiting >= self.limit + self.max_queue:
+            self.rejected_queue_full += 1
+            return False
+
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            return False
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - started
+        self.active += 1
+        self.admitted += 1
+        self._total_wait += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        return True
+
+    def release(self, held_seconds: float):
+        self.active -= 1
+        self._avg_hold = 0.8 * self._avg_hold + 0.2 * held_seconds
+        self._semaphore.release()
+
+    def retry_after(self) -> int:
+        """Seconds until the queue ahead of a new request should have drained."""
+        return max(1, math.ceil(self._avg_hold * (self.waiting + 1) / self.limit))
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "timeout_seconds": self.timeout,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_wait_seconds": round(self._total_wait / self.admitted, 3) if self.admitted else 0.0,
+            "max_wait_seconds": round(self.max_wait_seconds, 3),
+            "avg_hold_seconds": round(self._avg_hold, 3)
+        }
+
+
+def _controller(name: str, limit: str, max_queue: str, timeout: str) -> AdmissionController:
+    prefix = f"ADMISSION_{name.upper().replace('-', '_')}"
+    return AdmissionController(
+        name,
+        int(os.getenv(f"{prefix}_LIMIT", limit)),
+        int(os.getenv(f"{prefix}_QUEUE", max_queue)),
+        float(os.getenv(f"{prefix}_TIMEOUT", timeout))
+    )
+
+# Defaults keep heavy routes well under the SQLAlchemy pool (5 + 10 overflow connections)
+controllers = {
+    "export": _controller("export", "2", "4", "10"),
+    "upload": _controller("upload", "2", "2", "10"),
+    "fan-out": _controller("fan-out", "1", "1", "5"),
+}
+
+EXPORT_PATH = re.compile(r"^/(pei|guias|carteirinhas)/export/?$")
+UPLOAD_PATH = re.compile(r"^/carteirinhas/upload/?$")
+JOBS_PATH = re.compile(r"^/jobs/?$")
+
+REJECTED_DETAIL = {
+    "export": "Muitas exportações em andamento. Tente novamente em instantes ou use POST /exports.",
+    "upload": "Muitos uploads em andamento. Tente novamente em instantes.",
+    "fan-out": "Já existe uma criação de jobs para todas as carteirinhas em andamento. Tente novamente em instantes.",
+}
+
+
+def classify(method: str, path: str) -> Optional[str]:
+    """Route class by method + path; POST /jobs/ needs its body, see AdmissionMiddleware."""
+    if method == "GET" and EXPORT_PATH.match(path):
+        return "export"
+    if method == "POST" and UPLOAD_PATH.match(path):
+        return "upload"
+    return None
+
+def _is_fan_out(body: bytes) -> bool:
+    try:
+        return json.loads(body).get("type") == "all"
+    except (ValueError, AttributeError):
+        return False
+
+
+class AdmissionMiddleware:
+    """
+    Pure ASGI middleware (no BaseHTTPMiddleware, so streamed exports are not buffered).
+    The permit is held until the response, including a streamed body, has been sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_ENABLED:
+            return await self.app(scope, receive, send)
+
+        route_class = classify(scope["method"], scope["path"])
+        if route_class is None and scope["method"] == "POST" and JOBS_PATH.match(scope["path"]):
+            receive, body = await self._buffer_body(receive)
+            if body is not None and _is_fan_out(body):
+                route_class = "fan-out"
+        if route_class is None:
+            return await self.app(scope, receive, send)
+
+        controller = controllers[route_class]
+        if not await controller.acquire():
+            logger.warning(f"Admission: rejected {scope['method']} {scope['path']} ({route_class} saturated)")
+            return await self._reject(send, route_class, controller.retry_after())
+
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(time.monotonic() - started)
+
+    async def _buffer_body(self, receive):
+        """Reads the request body and returns a receive() that replays it, plus the body (None if too large)."""
+        messages = []
+        size = 0
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            size += len(message.get("body", b""))
+            if not message.get("more_body", False) or size > MAX_INSPECTED_BODY:
+                break
+
+        body = None
+        if messages[-1]["type"] == "http.request" and not messages[-1].get("more_body", False):
+            body = b"".join(m.get("body", b"") for m in messages)
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        return replay, body
+
+    async def _reject(self, send, route_class: str, retry_after: int):
+        body = json.dumps({"detail": REJECTED_DETAIL[route_class]}).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(retry_after).encode()),
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def stats() -> dict:
+    return {
+        "enabled": ADMISSION_ENABLED,
+        "classes": {name: controller.stats() for name, controller in controllers.items()}
+    }
@@ -0,0 +1,530 @@
+import os
+import csv
+import codecs
+import hashlib
+import itertools
+from typing import Iterable, Iterator, List, Tuple
+from fastapi import HTTPException
+from openpyxl import load_workbook
+from sqlalchemy import or_, func, literal_column, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from models import Carteirinha
+
+UPSERT_CHUNK_SIZE = int(os.getenv("CARTEIRINHA_UPSERT_CHUNK_SIZE", "1000"))
+PARSE_BATCH_SIZE = int(os.getenv("CARTEIRINHA_PARSE_BATCH_SIZE", "1000"))
+READ_CHUNK_SIZE = 64 * 1024
+
+def validate_carteirinha_format(code: str):
+    # Format: 0064.8000.400948.00-5
+    # Length: 21
+    # Check simple length first
+    if len(code) != 21:
+        raise HTTPException(status_code=400, detail=f"Carteirinha inválida: {code}. Deve conter exatamente 21 caracteres.")
+    
+    # Check punctuation positions
+    # Indices: 4, 9, 16 are '.', 19 is '-'
+    if code[4] != '.' or code[9] != '.' or code[16] != '.' or code[19] != '-':
+        raise HTTPException(status_code=400, detail=f"Carteirinha inválida: {code}. Formato incorreto de pontos e traços. Esperado: 0000.0000.000000.00-0")
+
+def normalize_header(header):
+    header = str(header).strip()
+    mapping = {
+        'carteiras': 'Carteirinha',
+        'Carteiras': 'Carteirinha',
+        'carteirinha': 'Carteirinha',
+        'Carteirinha': 'Carteirinha',
+        'PACIENTE': 'Paciente',
+        'paciente': 'Paciente',
+        'Paciente': 'Paciente',
+        'ID': 'IdPaciente',
+        'id': 'IdPaciente',
+        'IdPaciente': 'IdPaciente',
+        'id_paciente': 'IdPaciente',
+        'IdPagamento': 'IdPagamento',
+        'id_pagamento': 'IdPagamento',
+        'IDPAGAMENTO': 'IdPagamento',
+        'status': 'status',
+        'Status': 'status',
+        'STATUS': 'status'
+    }
+    return mapping.get(header, header)
+
+class SemiColonDialect(csv.Dialect):
+    delimiter = ';'
+    quotechar = '"'
+    doublequote = True
+    skipinitialspace = False
+    lineterminator = '\r\n'
+    quoting = csv.QUOTE_MINIMAL
+
+def _iter_decoded_chunks(fileobj, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[str]:
+    """
+    Reads the binary upload in chunks and decodes it as UTF-8 (BOM aware).
+    If a chunk is not valid UTF-8 the rest of the file is decoded as latin1.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    use_latin1 = False
+    while True:
+        chunk = fileobj.read(chunk_size)
+        final = not chunk
+        if use_latin1:
+            text = chunk.decode("latin1")
+        else:
+            try:
+                text = decoder.decode(chunk, final)
+            except UnicodeDecodeError:
+                # Bytes still buffered by the decoder belong to this chunk too
+                pending = decoder.getstate()[0]
+                text = (pending + chunk).decode("latin1")
+                use_latin1 = True
+        if text:
+            yield text
+        if final:
+            break
+
+def _iter_lines(chunks: Iterable[str]) -> Iterator[str]:
+    # Split on '\n' only (keeping it) so csv can still handle quoted multi-line fields
+    pending = ""
+    for text in chunks:
+        parts = (pending + text).split("\n")
+        pending = parts.pop()
+        for part in parts:
+            yield part + "\n"
+    if pending:
+        yield pending
+
+def _iter_csv_rows(fileobj) -> Iterator[Tuple[int, dict]]:
+    chunks = _iter_decoded_chunks(fileobj)
+    sample = next(chunks, "")
+
+    # Detect separator from the first chunk
+    dialect = 'excel' # default comma
+    if ';' in sample and sample.count(';') > sample.count(','):
+        dialect = SemiColonDialect
+
+    reader = csv.DictReader(_iter_lines(itertools.chain([sample], chunks)), dialect=dialect)
+
+    # DictReader uses fieldnames from first row. We need to remap them.
+    if reader.fieldnames:
+        reader.fieldnames = [normalize_header(h) for h in reader.fieldnames]
+
+    for row in reader:
+        yield reader.line_num, row
+
+def _iter_xlsx_rows(fileobj) -> Iterator[Tuple[int, dict]]:
+    # read_only mode parses the sheet XML lazily instead of building the whole workbook
+    wb = load_workbook(filename=fileobj, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        header_map = {} # col_index -> normalized_name
+        is_header = True
+
+        for line_no, row in enumerate(ws.iter_rows(values_only=True), start=1):
+            if not row: continue
+
+            # Check for empty row
+            if all(cell is None for cell in row): continue
+
+            if is_header:
+                for i, cell_value in enumerate(row):
+                    if cell_value:
+                        header_map[i] = normalize_header(cell_value)
+                is_header = False
+                continue
+
+            # Data Row
+            row_data = {}
+            for i, cell_value in enumerate(row):
+                if i in header_map:
+                    row_data[header_map[i]] = cell_value
+
+            yield line_no, row_data
+    finally:
+        wb.close()
+
+def iter_upload_rows(fileobj, filename: str) -> Iterator[Tuple[int, dict]]:
+    """
+    Yields (line_number, row) for a CSV or XLSX upload, with headers passed through
+    normalize_header. Reads fileobj incrementally, so memory does not grow with file size.
+    """
+    if filename.lower().endswith('.csv'):
+        rows = _iter_csv_rows(fileobj)
+    else:
+        rows = _iter_xlsx_rows(fileobj)
+
+    first = True
+    for line_no, row in rows:
+        if first:
+            if 'Carteirinha' not in row:
+                raise HTTPException(status_code=400, detail=f"Arquivo inválido. Coluna 'Carteirinha' não encontrada. Colunas encontradas: {list(row.keys())}")
+            first = False
+        yield line_no, row
+
+def _parse_id(value):
+    if not value:
+        return None
+    try:
+        val = str(value).strip()
+        if val and val.lower() != 'nan' and val.lower() != 'none':
+            return int(float(val))
+    except (ValueError, TypeError):
+        pass
+    return None
+
+def parse_carteirinha_row(row: dict):
+    """
+    Converts a normalized upload row into carteirinha fields.
+    Returns None for rows without a carteirinha; raises HTTPException if the format is invalid.
+    """
+    cart_raw = row.get('Carteirinha')
+    cart = str(cart_raw).strip() if cart_raw is not None else ""
+    if not cart or cart.lower() == 'nan' or cart.lower() == 'none':
+        return None
+
+    validate_carteirinha_format(cart)
+
+    paciente_raw = row.get('Paciente')
+    paciente = str(paciente_raw).strip() if paciente_raw is not None else ""
+
+    status_val = row.get('status', 'ativo')
+    if not status_val or str(status_val).lower() == 'nan':
+        status_val = 'ativo'
+
+    return {
+        "carteirinha": cart,
+        "paciente": paciente,
+        "id_paciente": _parse_id(row.get('IdPaciente')),
+        "id_pagamento": _parse_id(row.get('IdPagamento')),
+        "status": status_val
+    }
+
+def iter_carteirinha_batches(fileobj, filename: str, errors: List[str], batch_size: int = None, stats: dict = None) -> Iterator[List[dict]]:
+    """
+    Streams an upload and yields validated rows in lists of batch_size.
+    Validation messages are appended to errors; once there is an error no more batches
+    are yielded (the import will be rolled back) but the rest of the file is still validated.
+    stats, if given, gets "rows_parsed" and "rows_valid" counters updated as rows are read,
+    and "rows_distinct" (valid rows counting each carteirinha once).
+    """
+    batch_size = batch_size or PARSE_BATCH_SIZE
+    batch = []
+    seen = set()
+
+    for line_no, row in iter_upload_rows(fileobj, filename):
+        if stats is not None:
+            stats["rows_parsed"] = stats.get("rows_parsed", 0) + 1
+
+        try:
+            item = parse_carteirinha_row(row)
+        except HTTPException as e:
+            errors.append(f"Linha {line_no}: {e.detail}")
+            continue
+
+        if item is None:
+            continue
+
+        if stats is not None:
+            stats["rows_valid"] = stats.get("rows_valid", 0) + 1
+            seen.add(item["carteirinha"])
+            stats["rows_distinct"] = len(seen)
+
+        if errors:
+            continue
+
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch and not errors:
+        yield batch
+
+UPSERT_FIELDS = ("paciente", "id_paciente", "id_pagamento", "status")
+
+def compute_fingerprint(item: dict) -> str:
+    """Same hash as the carteirinha_fingerprint() SQL function (migrations/0012)."""
+    parts = []
+    for field in UPSERT_FIELDS:
+        value = item.get(field)
+        parts.append("" if value is None else str(value))
+    return hashlib.md5("|".join(parts).encode("utf-8")).hexdigest()
+
+def _upsert_chunk(db: Session, chunk: List[dict]) -> Tuple[int, int]:
+    # One indexed lookup per chunk: skip rows whose stored fingerprint already matches
+    stored = dict(
+        db.query(Carteirinha.carteirinha, Carteirinha.fingerprint)
+        .filter(Carteirinha.carteirinha.in_([item["carteirinha"] for item in chunk]))
+        .all()
+    )
+    chunk = [item for item in chunk if stored.get(item["carteirinha"]) != compute_fingerprint(item)]
+    if not chunk:
+        return 0, 0
+
+    table = Carteirinha.__table__
+    stmt = insert(table).values(chunk)
+    excluded = stmt.excluded
+
+    # Only touch rows where at least one field really changed (keeps updated_at stable)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.carteirinha],
+        set_={
+            **{field: excluded[field] for field in UPSERT_FIELDS},
+            "updated_at": func.now()
+        },
+        where=or_(*[table.c[field].is_distinct_from(excluded[field]) for field in UPSERT_FIELDS])
+    ).returning(literal_column("(xmax = 0)").label("inserted"))
+
+    added = 0
+    updated = 0
+    for row in db.execute(stmt):
+        if row.inserted:
+            added += 1
+        else:
+            updated += 1
+    return added, updated
+
+def upsert_carteirinhas(db: Session, items: Iterable[dict], chunk_size: int = None) -> Tuple[int, int]:
+    """
+    Inserts or updates carteirinhas with INSERT ... ON CONFLICT (carteirinha) DO UPDATE,
+    sending chunk_size rows per statement. Rows whose fingerprint is unchanged are not sent.
+    Returns (added, updated). The caller owns the transaction.
+    """
+    chunk_size = chunk_size or UPSERT_CHUNK_SIZE
+    count_added = 0
+    count_updated = 0
+
+    chunk = {}
+    for item in items:
+        # ON CONFLICT cannot touch the same row twice in one statement: the last occurrence wins
+        if item["carteirinha"] in chunk:
+            del chunk[item["carteirinha"]]
+        chunk[item["carteirinha"]] = {
+            "carteirinha": item["carteirinha"],
+            "paciente": item.get("paciente"),
+            "id_paciente": item.get("id_paciente"),
+            "id_pagamento": item.get("id_pagamento"),
+            "status": str(item.get("status") or "ativo")
+        }
+        if len(chunk) >= chunk_size:
+            added, updated = _upsert_chunk(db, list(chunk.values()))
+            count_added += added
+            count_updated += updated
+            chunk = {}
+
+    if chunk:
+        added, updated = _upsert_chunk(db, list(chunk.values()))
+        count_added += added
+        count_updated += updated
+
+    return count_added, count_updated
+
+def upsert_summary(stats: dict, added: int, updated: int) -> dict:
+    """
+    unchanged/duplicates of a batched upsert. A carteirinha repeated in the file is written
+    once per occurrence but counted once here, its repeats are reported as duplicates.
+    """
+    distinct = stats.get("rows_distinct", 0)
+    return {
+        "unchanged": max(0, distinct - added - updated),
+        "duplicates": stats.get("rows_valid", 0) - distinct
+    }
+
+def upsert_carteirinha_batches(db: Session, batches: Iterable[List[dict]]) -> Tuple[int, int, int]:
+    """Writes every batch produced by iter_carteirinha_batches. Returns (added, updated, written)."""
+    count_added = 0
+    count_updated = 0
+    count_written = 0
+    for batch in batches:
+        added, updated = upsert_carteirinhas(db, batch)
+        count_added += added
+        count_updated += updated
+        count_written += len(batch)
+    return count_added, count_updated, count_written
+
+# --- COPY based staging import (very large reconciliation files) ---
+
+STAGING_COLUMNS = ("line_no", "carteirinha", "paciente", "id_paciente", "id_pagamento", "status", "reject_reason")
+
+CREATE_STAGING_SQL = """
+CREATE TEMP TABLE carteirinhas_staging (
+    line_no INTEGER NOT NULL,
+    carteirinha TEXT,
+    paciente TEXT,
+    id_paciente INTEGER,
+    id_pagamento INTEGER,
+    status TEXT,
+    reject_reason TEXT
+) ON COMMIT DROP
+"""
+
+# Earlier occurrences of a carteirinha repeated in the file are rejected; the last one wins
+REJECT_DUPLICATES_SQL = """
+UPDATE carteirinhas_staging s
+SET reject_reason = 'Carteirinha repetida no arquivo (mantida a linha ' || d.kept_line || ')'
+FROM (
+    SELECT line_no,
+           row_number() OVER (PARTITION BY carteirinha ORDER BY line_no DESC) AS rn,
+           max(line_no) OVER (PARTITION BY carteirinha) AS kept_line
+    FROM carteirinhas_staging
+    WHERE reject_reason IS NULL
+) d
+WHERE s.line_no = d.line_no AND d.rn > 1
+"""
+
+MERGE_STAGING_SQL = """
+WITH accepted AS (
+    SELECT carteirinha, paciente, id_paciente, id_pagamento, status
+    FROM carteirinhas_staging
+    WHERE reject_reason IS NULL
+),
+src AS (
+    -- Rows whose fingerprint already matches are never sent to the upsert
+    SELECT a.*
+    FROM accepted a
+    LEFT JOIN carteirinhas c ON c.carteirinha = a.carteirinha
+    WHERE c.fingerprint IS DISTINCT FROM carteirinha_fingerprint(a.paciente, a.id_paciente, a.id_pagamento, a.status)
+),
+merged AS (
+    -- is_temporary explicitly: the ORM default is Python-side only
+    INSERT INTO carteirinhas (carteirinha, paciente, id_paciente, id_pagamento, status, is_temporary)
+    SELECT carteirinha, paciente, id_paciente, id_pagamento, status, FALSE FROM src
+    ON CONFLICT (carteirinha) DO UPDATE SET
+        paciente = EXCLUDED.paciente,
+        id_paciente = EXCLUDED.id_paciente,
+        id_pagamento = EXCLUDED.id_pagamento,
+        status = EXCLUDED.status,
+        updated_at = NOW()
+    WHERE carteirinhas.paciente IS DISTINCT FROM EXCLUDED.paciente
+       OR carteirinhas.id_paciente IS DISTINCT FROM EXCLUDED.id_paciente
+       OR carteirinhas.id_pagamento IS DISTINCT FROM EXCLUDED.id_pagamento
+       OR carteirinhas.status IS DISTINCT FROM EXCLUDED.status
+    RETURNING (xmax = 0) AS inserted
+)
+SELECT
+    (SELECT count(*) FROM merged WHERE inserted) AS inserted,
+    (SELECT count(*) FROM merged WHERE NOT inserted) AS updated,
+    (SELECT count(*) FROM accepted) AS accepted
+"""
+
+REJECTIONS_SQL = """
+SELECT line_no, carteirinha, paciente, reject_reason
+FROM carteirinhas_staging
+WHERE reject_reason IS NOT NULL
+ORDER BY line_no
+"""
+
+def _copy_escape(value) -> str:
+    if value is None:
+        return "\\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+def _iter_copy_text(rows: Iterable[tuple], rows_per_chunk: int = 1000) -> Iterator[str]:
+    """Encodes rows in COPY text format, a few hundred KB per chunk."""
+    lines = []
+    for row in rows:
+        lines.append("\t".join(_copy_escape(v) for v in row) + "\n")
+        if len(lines) >= rows_per_chunk:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+class _ChunkReader:
+    """File-like adapter over a chunk iterator, for psycopg2's copy_expert."""
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, ""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    readline = read
+
+def copy_rows(db: Session, table: str, columns: Iterable[str], rows: Iterable[tuple]):
+    """
+    Streams rows into table with COPY ... FROM STDIN inside the session's transaction.
+    Works with both psycopg (3) and psycopg2 connections.
+    """
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    cursor = db.connection().connection.cursor()
+    try:
+        if hasattr(cursor, "copy_expert"):
+            cursor.copy_expert(sql, _ChunkReader(_iter_copy_text(rows)))
+        else:
+            with cursor.copy(sql) as copy:
+                for chunk in _iter_copy_text(rows):
+                    copy.write(chunk)
+    finally:
+        cursor.close()
+
+def _iter_staging_rows(rows: Iterable[Tuple[int, dict]], stats: dict = None) -> Iterator[tuple]:
+    for line_no, row in rows:
+        if stats is not None:
+            stats["rows_parsed"] = stats.get("rows_parsed", 0) + 1
+
+        try:
+            item = parse_carteirinha_row(row)
+        except HTTPException as e:
+            paciente_raw = row.get('Paciente')
+            yield (line_no, str(row.get('Carteirinha')).strip(),
+                   str(paciente_raw).strip() if paciente_raw is not None else None,
+                   None, None, None, str(e.detail))
+            continue
+
+        if item is None:
+            continue
+
+        if stats is not None:
+            stats["rows_valid"] = stats.get("rows_valid", 0) + 1
+
+        yield (line_no, item["carteirinha"], item["paciente"], item["id_paciente"],
+               item["id_pagamento"], str(item["status"]), None)
+
+def copy_import_carteirinhas(db: Session, fileobj, filename: str, report_path: str, stats: dict = None) -> dict:
+    """
+    Fast path for very large files: COPY every parsed row into a temporary staging table,
+    reject duplicates in SQL and merge the accepted rows into carteirinhas with a single
+    INSERT ... ON CONFLICT statement. Unlike the batched upsert, invalid rows do not abort
+    the import; they are written (with the reason) to a CSV rejection report at report_path.
+    The caller owns the transaction and must commit.
+    """
+    # Read the header row before COPY starts: an error raised inside the COPY data callback
+    # would be wrapped by the driver and reach the client as a 500 instead of the 400
+    rows = iter_upload_rows(fileobj, filename)
+    first = next(rows, None)
+    if first is not None:
+        rows = itertools.chain([first], rows)
+
+    db.execute(text(CREATE_STAGING_SQL))
+    copy_rows(db, "carteirinhas_staging", STAGING_COLUMNS, _iter_staging_rows(rows, stats))
+    db.execute(text(REJECT_DUPLICATES_SQL))
+
+    merged = db.execute(text(MERGE_STAGING_SQL)).one()
+
+    rejected = 0
+    with open(report_path, "w", newline="", encoding="utf-8-sig") as report:
+        writer = csv.writer(report, delimiter=';')
+        writer.writerow(["Linha", "Carteirinha", "Paciente", "Motivo"])
+        result = db.execute(text(REJECTIONS_SQL).execution_options(yield_per=1000))
+        for row in result:
+            writer.writerow([row.line_no, row.carteirinha, row.paciente, row.reject_reason])
+            rejected += 1
+
+    return {
+        "added": merged.inserted,
+        "updated": merged.updated,
+        "unchanged": merged.accepted - merged.inserted - merged.updated,
+        "rejected": rejected
+    }
@@ -0,0 +1,46 @@
+import os
+from typing import Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from services.cache import TTLCache
+
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "30"))
+COUNT_ESTIMATE_THRESHOLD = int(os.getenv("COUNT_ESTIMATE_THRESHOLD", "100000"))
+
+count_cache = TTLCache(maxsize=512, ttl=COUNT_CACHE_TTL)
+
+# Same extrapolation the planner does: tuples per page from the last ANALYZE
+# times the current number of pages of the table.
+ESTIMATE_SQL = text("""
+SELECT CASE
+    WHEN c.reltuples < 0 OR c.relpages = 0 THEN NULL
+    ELSE (c.reltuples / c.relpages) * (pg_relation_size(c.oid) / current_setting('block_size')::INTEGER)
+END AS estimate
+FROM pg_class c
+WHERE c.oid = to_regclass(:table_name)
+""")
+
+def estimate_table_rows(db: Session, table_name: str) -> Optional[int]:
+    """Planner row estimate for a whole table, or None if it was never analyzed."""
+    estimate = db.execute(ESTIMATE_SQL, {"table_name": table_name}).scalar()
+    return int(estimate) if estimate is not None else None
+
+def count_total(db: Session, query, table_name: str, endpoint: str, filters: dict) -> Tuple[int, bool]:
+    """
+    Total for a paginated listing. Returns (total, exact).
+    - No filters on a large table: planner estimate (exact=False), no COUNT(*) at all.
+    - Otherwise: exact COUNT(*), cached for COUNT_CACHE_TTL seconds per endpoint + filter set.
+    """
+    active = tuple(sorted((k, str(v)) for k, v in filters.items() if v not in (None, "")))
+
+    if not active:
+        estimate = estimate_table_rows(db, table_name)
+        if estimate is not None and estimate >= COUNT_ESTIMATE_THRESHOLD:
+            return estimate, False
+
+    key = (endpoint, active)
+    total = count_cache.get(key)
+    if total is None:
+        total = query.order_by(None).count()
+        count_cache.set(key, total)
+    return total, True
@@ -0,0 +1,223 @@
+import os
+import json
+import uuid
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Callable, Iterator, Sequence
+from sqlalchemy import text
+from database import SessionLocal
+from services import export_stream
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CACHE_ENABLED = os.getenv("EXPORT_CACHE_ENABLED", "true").lower() == "true"
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "export_cache"))
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_MB", "1024")) * 1024 * 1024
+# Partial files left behind by a crashed process are removed after this long
+STALE_TMP_SECONDS = 3600
+
+# Tables an export may depend on (the ones with table_versions triggers)
+VERSIONED_TABLES = ("carteirinhas", "base_guias", "patient_pei")
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+
+def data_version(tables: Sequence[str]) -> list:
+    """
+    Change token: the table_versions counter of each table, bumped by statement triggers in
+    the writing transaction (migration 0024), so it moves exactly when a change commits.
+    """
+    for table in tables:
+        if table not in VERSIONED_TABLES:
+            raise ValueError(f"Unknown export table: {table}")
+
+    db = SessionLocal()
+    try:
+        versions = dict(db.execute(
+            text("SELECT table_name, SUM(version) FROM table_versions WHERE table_name = ANY(:tables) GROUP BY table_name"),
+            {"tables": list(tables)}
+        ).all())
+    finally:
+        db.close()
+    return [[table, int(versions.get(table) or 0)] for table in tables]
+
+def cache_key(endpoint: str, params: dict, version: list) -> str:
+    # Unset and blank filters are dropped (the routes ignore them), so ?status= and no status share an entry
+    normalized = {k: str(v) for k, v in sorted(params.items()) if v is not None and str(v).strip()}
+    raw = json.dumps({"endpoint": endpoint, "params": normalized, "version": version}, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _path(key: str, fmt: str) -> str:
+    return os.path.join(EXPORT_CACHE_DIR, f"{key}.{fmt}")
+
+def _evict():
+    """Deletes least recently used files (by mtime, bumped on every hit) until the cache fits its cap."""
+    try:
+        entries = []
+        now = time.time()
+        for entry in os.scandir(EXPORT_CACHE_DIR):
+            info = entry.stat()
+            if entry.name.endswith(".tmp"):
+                if now - info.st_mtime > STALE_TMP_SECONDS:
+                    os.remove(entry.path)
+                continue
+            entries.append((info.st_mtime, info.st_size, entry.path))
+    except OSError as e:
+        logger.warning(f"Export cache scan failed: {e}")
+        return
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= EXPORT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            with _lock:
+                _stats["evictions"] += 1
+        except OSError:
+            pass # Removed by another worker process
+
+def tee(body: Iterator[bytes], path: str) -> Iterator[bytes]:
+    """
+    Streams body to the client while writing it to a temporary file that becomes the cache
+    entry only if the export completes. A failed disk write disables caching for this
+    export but never interrupts the download.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        out = open(tmp_path, "wb")
+    except OSError as e:
+        logger.warning(f"Export cache disabled for this export: {e}")
+        out = None
+
+    completed = False
+    try:
+        for chunk in body:
+            if out is not None:
+                try:
+                    out.write(chunk)
+                except OSError as e:
+                    logger.warning(f"Export cache write failed: {e}")
+                    out.close()
+                    out = None
+            yield chunk
+        completed = True
+    finally:
+        if out is not None:
+            out.close()
+            if completed:
+                try:
+                    os.replace(tmp_path, path)
+                    with _lock:
+                        _stats["stores"] += 1
+                    _evict()
+                except OSError as e:
+                    logger.warning(f"Export cache store failed: {e}")
+                    completed = False
+        if not completed or out is None:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def adopt(src_path: str, path: str):
+    """
+    Makes a finished file (a background export) a cache entry through a hard link, so the
+    cache evicting it later never deletes the original. Skipped when the directories are on
+    different filesystems.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+        os.link(src_path, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.info(f"Export not added to the cache: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return
+    with _lock:
+        _stats["stores"] += 1
+    _evict()
+
+def entry_path(endpoint: str, params: dict, tables: Sequence[str], fmt: str) -> str:
+    """Where this export is (or will be) cached for the current data version."""
+    key = cache_key(endpoint, {**params, "format": fmt}, data_version(tables))
+    return _path(key, fmt)
+
+def open_entry(path: str):
+    """
+    Opens a cached file for reading, or returns None on a miss. Callers read from the open
+    file, so another worker evicting the entry meanwhile does not break the send.
+    """
+    try:
+        cached = open(path, "rb")
+    except FileNotFoundError:
+        with _lock:
+            _stats["misses"] += 1
+        return None
+    try:
+        os.utime(path) # LRU: a hit makes the entry the most recently used
+    except OSError:
+        pass # Evicted right after being opened; the open file is still readable
+    with _lock:
+        _stats["hits"] += 1
+    return cached
+
+def read_file(cached) -> Iterator[bytes]:
+    try:
+        while chunk := cached.read(export_stream.CHUNK_SIZE):
+            yield chunk
+    finally:
+        cached.close()
+
+def cached_export(endpoint: str, params: dict, tables: Sequence[str], fmt: str, filename: str,
+                  build_body: Callable[[], Iterator[bytes]]):
+    """
+    Serves an export from the on-disk cache when the same endpoint + filters were exported
+    since the involved tables last changed; otherwise streams build_body() and stores it.
+    filename is given without extension.
+    """
+    if not EXPORT_CACHE_ENABLED:
+        return export_stream.export_response(build_body(), fmt, filename)
+
+    path = entry_path(endpoint, params, tables, fmt)
+    cached = open_entry(path)
+    if cached is not None:
+        response = export_stream.export_response(read_file(cached), fmt, filename)
+        response.headers["Content-Length"] = str(os.fstat(cached.fileno()).st_size)
+        response.headers["X-Export-Cache"] = "HIT"
+        return response
+
+    response = export_stream.export_response(tee(build_body(), path), fmt, filename)
+    response.headers["X-Export-Cache"] = "MISS"
+    return response
+
+def stats() -> dict:
+    files = 0
+    size = 0
+    try:
+        for entry in os.scandir(EXPORT_CACHE_DIR):
+            if not entry.name.endswith(".tmp"):
+                files += 1
+                size += entry.stat().st_size
+    except OSError:
+        pass
+    with _lock:
+        counters = dict(_stats)
+    return {
+        "enabled": EXPORT_CACHE_ENABLED,
+        "dir": EXPORT_CACHE_DIR,
+        "files": files,
+        "size_bytes": size,
+        "max_bytes": EXPORT_CACHE_MAX_BYTES,
+        **counters
+    }
@@ -0,0 +1,154 @@
+import os
+import uuid
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Sequence
+from services import export_cache, state_files
+
+logger = logging.getLogger(__name__)
+
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+# Finished files and their state (<id>.json) live here until EXPORT_TTL_HOURS after they
+# finished. Must be shared by every worker process that serves /exports.
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(tempfile.gettempdir(), "exports"))
+EXPORT_TTL_SECONDS = float(os.getenv("EXPORT_TTL_HOURS", "24")) * 3600
+# Progress is saved at most this often while an export runs
+SAVE_INTERVAL_SECONDS = 1.0
+
+_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+_exports = {} # export_id -> state dict, only while queued/running in this process
+_lock = threading.Lock()
+
+
+def _file_path(export_id: str, fmt: str) -> str:
+    return os.path.join(EXPORT_DIR, f"{export_id}.{fmt}")
+
+def start_export(kind: str, fmt: str, params: dict, tables: Sequence[str], filename: str,
+                 build_body: Callable[[dict], Iterator[bytes]]) -> str:
+    """
+    Queues an export on the export worker pool. build_body(progress) returns the streamed
+    file, which is written to EXPORT_DIR. When the export cache (services/export_cache.py)
+    already holds an identical export it is reused instead of running the query, and a new
+    file is handed to the cache when it is done. Returns the export id to poll with get_export().
+    """
+    state_files.cleanup_expired(EXPORT_DIR, EXPORT_TTL_SECONDS)
+
+    export_id = uuid.uuid4().hex
+    state = {
+        "id": export_id,
+        "type": kind,
+        "format": fmt,
+        "filename": filename,
+        "filters": {k: v for k, v in params.items() if v is not None},
+        "status": "queued", # queued, running, completed, failed
+        "rows_written": 0,
+        "size_bytes": None,
+        "cached": False,
+        "download_url": None,
+        "error": None,
+        "created_at": datetime.now(timezone.utc),
+        "started_at": None,
+        "finished_at": None
+    }
+    with _lock:
+        _exports[export_id] = state
+    state_files.save_state(EXPORT_DIR, state)
+
+    _executor.submit(_run_export, export_id, params, tables, build_body)
+    return export_id
+
+def get_export(export_id: str):
+    """Live state when the export runs in this process, else the state saved by whichever worker ran it."""
+    with _lock:
+        state = _exports.get(export_id)
+        snapshot = dict(state) if state else None
+
+    if snapshot is None:
+        saved = state_files.load_state(EXPORT_DIR, export_id)
+        if saved is None:
+            return None
+        snapshot = state_files.public_fields(saved)
+        if state_files.is_interrupted(EXPORT_DIR, saved):
+            snapshot["status"] = "failed"
+            snapshot["error"] = "Exportação interrompida. Solicite a exportação novamente."
+
+    elapsed = state_files.elapsed_seconds(snapshot)
+    snapshot["elapsed_seconds"] = round(elapsed, 2)
+    snapshot["rows_per_second"] = round(snapshot["rows_written"] / elapsed, 1) if elapsed > 0 else 0.0
+    return snapshot
+
+def open_export_file(state: dict):
+    """
+    The completed export's file, opened, or None once it expired. Opened before the response
+    starts so the TTL cleanup cannot remove it mid-download.
+    """
+    try:
+        return open(_file_path(state["id"], state["format"]), "rb")
+    except FileNotFoundError:
+        return None
+
+def _write_file(body: Iterator[bytes], path: str, state: dict):
+    """Writes body to path through a temporary file, saving progress while it runs."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    saved = time.monotonic()
+    try:
+        with open(tmp_path, "wb") as out:
+            for chunk in body:
+                out.write(chunk)
+                if time.monotonic() - saved >= SAVE_INTERVAL_SECONDS:
+                    state_files.save_state(EXPORT_DIR, state)
+                    saved = time.monotonic()
+        os.replace(tmp_path, path)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def _run_export(export_id: str, params: dict, tables: Sequence[str], build_body: Callable):
+    with _lock:
+        state = _exports[export_id]
+    state["status"] = "running"
+    state["started_at"] = datetime.now(timezone.utc)
+    state_files.save_state(EXPORT_DIR, state)
+
+    try:
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        path = _file_path(export_id, state["format"])
+        cache_path = None
+        cached = None
+        if export_cache.EXPORT_CACHE_ENABLED:
+            cache_path = export_cache.entry_path(state["type"], params, tables, state["format"])
+            cached = export_cache.open_entry(cache_path)
+
+        if cached is not None:
+            # Hard link when possible; copying from the open file also works if the entry was just evicted
+            with cached:
+                try:
+                    os.link(cache_path, path)
+                except OSError:
+                    with open(path, "wb") as out:
+                        shutil.copyfileobj(cached, out, length=1024 * 1024)
+            state["cached"] = True
+        else:
+            _write_file(build_body(state), path, state)
+            if cache_path is not None:
+                export_cache.adopt(path, cache_path)
+
+        state["size_bytes"] = os.path.getsize(path)
+        state["download_url"] = f"/exports/{export_id}/download"
+        state["status"] = "completed"
+    except Exception as e:
+        logger.exception(f"Export {export_id} failed")
+        state["error"] = str(e)
+        state["status"] = "failed"
+    finally:
+        state["finished_at"] = datetime.now(timezone.utc)
+        state_files.save_state(EXPORT_DIR, state)
+        with _lock:
+            del _exports[export_id]
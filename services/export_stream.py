@@ -0,0 +1,102 @@
+import csv
+import io
+import os
+from decimal import Decimal
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from database import SessionLocal
+from services import xlsx_stream
+
+EXPORT_FORMATS = ("xlsx", "csv", "ndjson")
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+
+MEDIA_TYPES = {
+    "xlsx": xlsx_stream.XLSX_MEDIA_TYPE,
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+# Same delimiter as the rejection reports, so files open in pt-BR Excel without an import wizard
+CSV_DELIMITER = ";"
+CHUNK_SIZE = xlsx_stream.CHUNK_SIZE
+
+
+def validate_format(fmt: str) -> str:
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato inválido. Use: {', '.join(EXPORT_FORMATS)}.")
+    return fmt
+
+def iter_query(build_query: Callable, progress: Optional[dict] = None) -> Iterator:
+    """
+    Yields the rows of build_query(db) through a server-side (named) cursor, EXPORT_BATCH_SIZE
+    rows per fetch. Runs after the route has returned, so it opens its own session (the
+    request's get_db session is already closed when a StreamingResponse body runs).
+    If progress is given, progress["rows_written"] counts the rows handed to the writer.
+    """
+    db = SessionLocal()
+    try:
+        if progress is None:
+            yield from build_query(db).yield_per(EXPORT_BATCH_SIZE)
+        else:
+            for row in build_query(db).yield_per(EXPORT_BATCH_SIZE):
+                progress["rows_written"] += 1
+                yield row
+    finally:
+        db.close()
+
+def stream_csv(rows: Iterable, columns: Sequence[str]) -> Iterator[bytes]:
+    """
+    CSV with a header row. Values are written as str() gives them (dates YYYY-MM-DD, timestamps
+    like Postgres prints them), with no per-value conversion. Starts with a UTF-8 BOM so Excel
+    detects the encoding.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=CSV_DELIMITER)
+    buffer.write("\ufeff")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError
+
+def stream_ndjson(rows: Iterable, columns: Sequence[str]) -> Iterator[bytes]:
+    """One JSON object per line, keyed by column name."""
+    pending = []
+    pending_size = 0
+    for row in rows:
+        line = orjson.dumps(dict(zip(columns, row)), default=_json_default)
+        pending.append(line)
+        pending_size += len(line) + 1
+        if pending_size >= CHUNK_SIZE:
+            yield b"\n".join(pending) + b"\n"
+            pending = []
+            pending_size = 0
+    if pending:
+        yield b"\n".join(pending) + b"\n"
+
+def export_response(body: Iterator[bytes], fmt: str, filename: str) -> StreamingResponse:
+    """Wraps a streamed export body; filename is given without extension."""
+    return StreamingResponse(
+        body,
+        media_type=MEDIA_TYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}.{fmt}"'}
+    )
+
+def column_names(columns) -> list:
+    """Output names of a tuple of selected columns (the attribute name, or the label when labeled)."""
+    return [column.key for column in columns]
+
+def stream_flat(rows: Iterable, columns, fmt: str) -> Iterator[bytes]:
+    """Body for the flat formats (csv, ndjson): raw column values, no presentation formatting."""
+    names = column_names(columns)
+    return stream_csv(rows, names) if fmt == "csv" else stream_ndjson(rows, names)
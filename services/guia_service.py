@@ -0,0 +1,43 @@
+from typing import List, Tuple
+from sqlalchemy import or_, func, literal_column
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from models import BaseGuia
+
+GUIA_FIELDS = ("data_autorizacao", "senha", "validade", "codigo_terapia", "qtde_solicitada", "sessoes_autorizadas")
+
+def upsert_guias(db: Session, carteirinha_id: int, guias: List[dict]) -> Tuple[int, int]:
+    """
+    Inserts or updates the guias of one carteirinha in a single statement keyed on
+    (carteirinha_id, guia). Unchanged rows are not touched. patient_pei is kept current by
+    the statement-level triggers (migration 0019). Returns (added, updated).
+    """
+    rows = {}
+    for guia in guias:
+        # ON CONFLICT cannot touch the same row twice in one statement: the last occurrence wins
+        rows.pop(guia["guia"], None)
+        rows[guia["guia"]] = {"carteirinha_id": carteirinha_id, "guia": guia["guia"],
+                              **{field: guia.get(field) for field in GUIA_FIELDS}}
+    if not rows:
+        return 0, 0
+
+    table = BaseGuia.__table__
+    stmt = insert(table).values(list(rows.values()))
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.carteirinha_id, table.c.guia],
+        set_={
+            **{field: excluded[field] for field in GUIA_FIELDS},
+            "updated_at": func.now()
+        },
+        where=or_(*[table.c[field].is_distinct_from(excluded[field]) for field in GUIA_FIELDS])
+    ).returning(literal_column("(xmax = 0)").label("inserted"))
+
+    added = 0
+    updated = 0
+    for row in db.execute(stmt):
+        if row.inserted:
+            added += 1
+        else:
+            updated += 1
+    return added, updated
@@ -0,0 +1,176 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from fastapi import HTTPException
+from database import SessionLocal
+from services import carteirinha_service, state_files
+
+logger = logging.getLogger(__name__)
+
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "2"))
+IMPORT_UPLOAD_DIR = os.getenv("IMPORT_UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "carteirinha_imports"))
+MAX_REPORTED_ERRORS = 100
+# State of each import is saved as <id>.json in IMPORT_UPLOAD_DIR (shared by the worker processes)
+SAVE_INTERVAL_SECONDS = 1.0
+# Saved state (and anything else left in IMPORT_UPLOAD_DIR) is deleted this long after the import finished
+IMPORT_TTL_SECONDS = float(os.getenv("IMPORT_TTL_HOURS", "24")) * 3600
+
+_executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix="carteirinha-import")
+_imports = {} # import_id -> state dict, only while queued/running in this process
+_lock = threading.Lock()
+
+IMPORT_METHODS = ("upsert", "copy")
+
+def rejection_report_path(import_id: str) -> str:
+    # Named <id>.* so the TTL cleanup deletes it together with the import's state
+    return os.path.join(IMPORT_UPLOAD_DIR, f"{import_id}.rejeicoes.csv")
+
+def new_import_id() -> str:
+    os.makedirs(IMPORT_UPLOAD_DIR, exist_ok=True)
+    state_files.cleanup_expired(IMPORT_UPLOAD_DIR, IMPORT_TTL_SECONDS)
+    return uuid.uuid4().hex
+
+def _register(import_id: str, filename: str, method: str) -> dict:
+    state = {
+        "id": import_id,
+        "filename": filename,
+        "method": method,
+        "status": "queued", # queued, running, completed, failed
+        "rows_parsed": 0,
+        "rows_valid": 0,
+        "rows_written": 0,
+        "added": 0,
+        "updated": 0,
+        "unchanged": None,
+        "duplicates": None,
+        "rejected": None,
+        "rejections_url": None,
+        "errors": [],
+        "created_at": datetime.now(timezone.utc),
+        "started_at": None,
+        "finished_at": None
+    }
+    with _lock:
+        _imports[import_id] = state
+    _save(state)
+    return state
+
+def _snapshot(state: dict) -> dict:
+    snapshot = {k: v for k, v in state.items() if not k.startswith("_")}
+    errors = snapshot.pop("errors")
+    snapshot["error_count"] = len(errors)
+    snapshot["errors"] = errors[:MAX_REPORTED_ERRORS]
+    return snapshot
+
+def _save(state: dict):
+    state_files.save_state(IMPORT_UPLOAD_DIR, _snapshot(state))
+
+def start_import(fileobj, filename: str, method: str = "upsert") -> str:
+    """
+    Copies the upload to IMPORT_UPLOAD_DIR and queues it on the import worker pool.
+    Returns the import id to poll with get_import().
+    """
+    import_id = new_import_id()
+    path = os.path.join(IMPORT_UPLOAD_DIR, import_id + os.path.splitext(filename)[1].lower())
+
+    fileobj.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(fileobj, out, length=1024 * 1024)
+
+    _register(import_id, filename, method)
+    _executor.submit(_run_import, import_id, path, filename, method)
+    return import_id
+
+def get_import(import_id: str):
+    """Live state when the import runs in this process, else the state saved by whichever worker ran it."""
+    with _lock:
+        state = _imports.get(import_id)
+        snapshot = _snapshot(state) if state else None
+
+    if snapshot is None:
+        saved = state_files.load_state(IMPORT_UPLOAD_DIR, import_id)
+        if saved is None:
+            return None
+        snapshot = state_files.public_fields(saved)
+        if state_files.is_interrupted(IMPORT_UPLOAD_DIR, saved):
+            snapshot["status"] = "failed"
+            snapshot["errors"].append("Importação interrompida. Envie o arquivo novamente.")
+            snapshot["error_count"] += 1
+
+    elapsed = state_files.elapsed_seconds(snapshot)
+    snapshot["elapsed_seconds"] = round(elapsed, 2)
+    snapshot["rows_per_second"] = round(snapshot["rows_parsed"] / elapsed, 1) if elapsed > 0 else 0.0
+    return snapshot
+
+def _run_import(import_id: str, path: str, filename: str, method: str):
+    with _lock:
+        state = _imports[import_id]
+    state["status"] = "running"
+    state["started_at"] = datetime.now(timezone.utc)
+    _save(state)
+
+    db = SessionLocal()
+    try:
+        if method == "copy":
+            with open(path, "rb") as f:
+                result = carteirinha_service.copy_import_carteirinhas(
+                    db, f, filename, rejection_report_path(import_id), stats=state
+                )
+            db.commit()
+            state.update(result)
+            state["rows_written"] = result["added"] + result["updated"]
+            state["rejections_url"] = f"/carteirinhas/imports/{import_id}/rejections"
+            state["status"] = "completed"
+            return
+
+        written = 0
+        saved = time.monotonic()
+        with open(path, "rb") as f:
+            batches = carteirinha_service.iter_carteirinha_batches(f, filename, state["errors"], stats=state)
+            for batch in batches:
+                added, updated = carteirinha_service.upsert_carteirinhas(db, batch)
+                state["added"] += added
+                state["updated"] += updated
+                written += len(batch)
+                if time.monotonic() - saved >= SAVE_INTERVAL_SECONDS:
+                    _save(state)
+                    saved = time.monotonic()
+
+        if state["errors"]:
+            # Same rule as the synchronous upload: any invalid row rolls back the import
+            db.rollback()
+            state["added"] = 0
+            state["updated"] = 0
+            state["status"] = "failed"
+        else:
+            db.commit()
+            # Only rows that are really in the database count as written
+            state["rows_written"] = written
+            state.update(carteirinha_service.upsert_summary(state, state["added"], state["updated"]))
+            state["status"] = "completed"
+
+    except HTTPException as e:
+        db.rollback()
+        state["errors"].append(str(e.detail))
+        state["status"] = "failed"
+    except Exception as e:
+        logger.exception(f"Import {import_id} failed")
+        db.rollback()
+        state["errors"].append(f"Internal Server Error: {str(e)}")
+        state["status"] = "failed"
+    finally:
+        db.close()
+        state["finished_at"] = datetime.now(timezone.utc)
+        _save(state)
+        with _lock:
+            del _imports[import_id]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,46 +1,137 @@
+import os
+import logging
+from sqlalchemy import text
 from sqlalchemy.orm import Session
-from models import Job, Carteirinha
-from typing import List, Optional
+from models import Job, Carteirinha, Log
+from typing import List, Optional, Tuple
 from datetime import datetime, timedelta
 from fastapi import HTTPException
+from services import notifier, guia_service, pei_stats_service
 import random
 
-def create_jobs_bulk(db: Session, carteirinha_ids: List[int]) -> int:
+logger = logging.getLogger(__name__)
+
+# Retry policy: a job is retried with exponential backoff (base * 2^attempts, capped,
+# with jitter) until it reaches JOB_MAX_ATTEMPTS, then it stays in 'error' for manual retry.
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "4"))
+JOB_BACKOFF_BASE_SECONDS = int(os.getenv("JOB_BACKOFF_BASE_SECONDS", "60"))
+JOB_BACKOFF_MAX_SECONDS = int(os.getenv("JOB_BACKOFF_MAX_SECONDS", "3600"))
+JOB_REAPER_BATCH_SIZE = int(os.getenv("JOB_REAPER_BATCH_SIZE", "500"))
+
+# pg_notify payloads are limited to 8000 bytes, so transitions carry at most this many jobs
+MAX_EVENT_JOBS = 100
+
+def notify_job_events(db: Session, deltas: dict, jobs: List[dict] = None):
     """
-    Creates multiple jobs for existing carteirinhas in a single bulk operation.
+    Publishes job status transitions ({"id", "status"}) and counter deltas per status
+    (e.g. {"pending": -3, "processing": 3}) to dashboards once the transaction commits.
     """
-    if not carteirinha_ids:
-        return 0
-        
-    # Optimize: Fetch valid IDs in one query to avoid N+1
-    valid_ids = db.query(Carteirinha.id).filter(Carteirinha.id.in_(carteirinha_ids)).all()
-    # valid_ids is list of tuples [(1,), (2,)]
-    valid_ids = [vid[0] for vid in valid_ids]
-    
-    if valid_ids:
-        new_jobs = [Job(carteirinha_id=cid, status="pending") for cid in valid_ids]
-        db.bulk_save_objects(new_jobs)
-        return len(new_jobs)
-    
-    return 0
+    deltas = {status: delta for status, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    jobs = jobs or []
+    notifier.notify(db, notifier.JOB_EVENTS_CHANNEL, {
+        "deltas": deltas,
+        "jobs": jobs[:MAX_EVENT_JOBS],
+        "truncated": len(jobs) > MAX_EVENT_JOBS
+    })
+
+def wake_workers(db: Session, count: int):
+    """Wakes workers waiting on GET /jobs/wait once the transaction commits."""
+    if count:
+        notifier.notify(db, notifier.JOBS_CHANNEL, {"count": count})
 
-def create_all_jobs(db: Session) -> int:
+def notify_jobs_created(db: Session, count: int):
+    wake_workers(db, count)
+    notify_job_events(db, {"pending": count, "total": count})
+
+NEXT_CLAIMABLE_SQL = text("""
+SELECT
+    EXISTS (
+        SELECT 1 FROM jobs
+        WHERE status = 'pending' AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())
+    ) AS available,
+    (
+        SELECT EXTRACT(EPOCH FROM MIN(next_attempt_at) - NOW())
+        FROM jobs
+        WHERE status = 'pending' AND next_attempt_at > NOW()
+    ) AS next_retry_in
+""")
+
+def next_claimable_in(db: Session) -> Optional[float]:
     """
-    Creates jobs for ALL non-temporary carteirinhas.
+    Seconds until a job can be claimed: 0 if one is claimable now, the time until the
+    earliest scheduled retry, or None when the queue is empty.
     """
-    all_carteirinhas = db.query(Carteirinha).filter(Carteirinha.is_temporary == False).all()
-    new_jobs = []
-    for cart in all_carteirinhas:
-         new_jobs.append(Job(carteirinha_id=cart.id, status="pending"))
-    
-    if new_jobs:
-        db.bulk_save_objects(new_jobs)
-        
-    return len(new_jobs)
+    row = db.execute(NEXT_CLAIMABLE_SQL).one()
+    if row.available:
+        return 0.0
+    return float(row.next_retry_in) if row.next_retry_in is not None else None
+
+# Fan-out is done in one INSERT ... SELECT: carteirinhas that already have an active
+# (pending/processing) job are skipped, and the partial unique index from migration 0017
+# turns any concurrent duplicate into a no-op (ON CONFLICT DO NOTHING).
+ACTIVE_JOB_FILTER = """
+NOT EXISTS (
+    SELECT 1 FROM jobs j
+    WHERE j.carteirinha_id = c.id AND j.status IN ('pending', 'processing')
+)
+"""
+
+FAN_OUT_SQL = """
+WITH eligible AS (
+    SELECT c.id FROM carteirinhas c WHERE {where}
+),
+inserted AS (
+    INSERT INTO jobs (carteirinha_id, status)
+    SELECT e.id, 'pending'
+    FROM eligible e
+    JOIN carteirinhas c ON c.id = e.id
+    WHERE """ + ACTIVE_JOB_FILTER + """
+    ON CONFLICT DO NOTHING
+    RETURNING id
+)
+SELECT (SELECT COUNT(*) FROM eligible) AS eligible, (SELECT COUNT(*) FROM inserted) AS created
+"""
 
-def create_temp_job(db: Session, carteirinha: str, paciente: str) -> int:
+CREATE_ALL_JOBS_SQL = text(FAN_OUT_SQL.format(
+    where="c.is_temporary IS NOT TRUE AND COALESCE(LOWER(c.status), 'ativo') = 'ativo'"
+))
+
+CREATE_JOBS_BULK_SQL = text(FAN_OUT_SQL.format(where="c.id = ANY(:ids)"))
+
+def create_jobs_bulk(db: Session, carteirinha_ids: List[int]) -> Tuple[int, int]:
+    """
+    Creates jobs for the given carteirinhas in a single statement.
+    Returns (created, skipped); skipped covers unknown ids and carteirinhas with an active job.
+    """
+    ids = sorted(set(carteirinha_ids or []))
+    if not ids:
+        return 0, 0
+
+    row = db.execute(CREATE_JOBS_BULK_SQL, {"ids": ids}).one()
+    notify_jobs_created(db, row.created)
+    return row.created, len(ids) - row.created
+
+def create_all_jobs(db: Session) -> Tuple[int, int]:
     """
-    Creates a temporary patient and job.
+    Creates jobs for ALL active, non-temporary carteirinhas without an active job.
+    Returns (created, skipped).
+    """
+    row = db.execute(CREATE_ALL_JOBS_SQL).one()
+    notify_jobs_created(db, row.created)
+    return row.created, row.eligible - row.created
+
+INSERT_JOB_SQL = text("""
+INSERT INTO jobs (carteirinha_id, status)
+VALUES (:carteirinha_id, 'pending')
+ON CONFLICT DO NOTHING
+RETURNING id
+""")
+
+def create_temp_job(db: Session, carteirinha: str, paciente: str) -> Tuple[int, int]:
+    """
+    Creates a temporary patient and job. Returns (created, skipped) like the bulk paths.
     """
     # Check if carteirinha already exists (even temp)
     existing = db.query(Carteirinha).filter(Carteirinha.carteirinha == carteirinha).first()
@@ -67,8 +158,188 @@ def create_temp_job(db: Session, carteirinha: str, paciente: str) -> int:
         db.flush() # Get ID
         cart_id = new_cart.id
     
-    # Create Job
-    job = Job(carteirinha_id=cart_id, status="pending")
-    db.add(job)
-    
-    return 1
+    # Create Job (skipped if the carteirinha already has an active one)
+    created = db.execute(INSERT_JOB_SQL, {"carteirinha_id": cart_id}).first() is not None
+    if created:
+        notify_jobs_created(db, 1)
+    return (1, 0) if created else (0, 1)
+
+CLAIM_JOBS_SQL = text("""
+WITH candidates AS (
+    SELECT id
+    FROM jobs
+    WHERE status = 'pending'
+      AND (next_attempt_at IS NULL OR next_attempt_at <= NOW())
+      -- Only jobs the join below can update; anything else would be locked and skipped on every claim
+      AND carteirinha_id IS NOT NULL
+      AND EXISTS (SELECT 1 FROM carteirinhas c WHERE c.id = jobs.carteirinha_id)
+    ORDER BY priority DESC, created_at ASC, id ASC
+    LIMIT :limit
+    FOR UPDATE OF jobs SKIP LOCKED
+)
+UPDATE jobs j
+SET status = 'processing',
+    locked_by = :worker_id,
+    timeout = NOW() + make_interval(secs => :lease_seconds),
+    updated_at = NOW()
+FROM candidates, carteirinhas c
+WHERE j.id = candidates.id
+  AND c.id = j.carteirinha_id
+RETURNING j.id AS job_id, j.carteirinha_id, j.priority, j.attempts, j.timeout,
+          c.carteirinha, c.paciente, c.id_paciente, c.id_pagamento, c.is_temporary
+""")
+
+def claim_jobs(db: Session, worker_id: str, limit: int, lease_seconds: int) -> List[dict]:
+    """
+    Atomically leases up to `limit` pending jobs (highest priority, oldest first) to a worker.
+    FOR UPDATE SKIP LOCKED lets concurrent workers claim different rows without waiting on
+    each other. Returns the leased jobs with their carteirinha data. The caller commits.
+    """
+    rows = db.execute(CLAIM_JOBS_SQL, {
+        "worker_id": worker_id,
+        "limit": limit,
+        "lease_seconds": lease_seconds
+    }).mappings().all()
+
+    jobs = [dict(row) for row in rows]
+    jobs.sort(key=lambda job: (-(job["priority"] or 0), job["job_id"]))
+    notify_job_events(
+        db,
+        {"pending": -len(jobs), "processing": len(jobs)},
+        [{"id": job["job_id"], "status": "processing"} for job in jobs]
+    )
+    return jobs
+
+# SET clause shared by the reaper and the fail endpoint: count the attempt, then either
+# schedule a retry (equal jitter: 50-100% of the capped exponential delay) or give up.
+RETRY_SET_SQL = """
+    attempts = COALESCE(j.attempts, 0) + 1,
+    status = CASE WHEN COALESCE(j.attempts, 0) + 1 >= :max_attempts THEN 'error' ELSE 'pending' END,
+    next_attempt_at = CASE
+        WHEN COALESCE(j.attempts, 0) + 1 >= :max_attempts THEN NULL
+        ELSE NOW() + make_interval(secs => LEAST(:backoff_max, :backoff_base * power(2, COALESCE(j.attempts, 0)))
+                                            * (0.5 + random() * 0.5))
+    END,
+    locked_by = NULL,
+    timeout = NULL,
+    updated_at = NOW()
+"""
+
+REAP_EXPIRED_SQL = text(f"""
+UPDATE jobs j
+SET {RETRY_SET_SQL}
+FROM (
+    SELECT id
+    FROM jobs
+    WHERE status = 'processing' AND timeout < NOW()
+    ORDER BY timeout
+    LIMIT :batch_size
+    FOR UPDATE SKIP LOCKED
+) expired
+WHERE j.id = expired.id
+RETURNING j.id, j.status
+""")
+
+FAIL_JOB_SQL = text(f"""
+UPDATE jobs j
+SET {RETRY_SET_SQL}
+WHERE j.id = :job_id AND j.status = 'processing'
+  -- Re-checked here: the lease may have been reaped and re-claimed after the SELECT in fail_job
+  AND (CAST(:worker_id AS TEXT) IS NULL OR j.locked_by IS NULL OR j.locked_by = :worker_id)
+RETURNING j.id, j.carteirinha_id, j.status, j.attempts, j.next_attempt_at
+""")
+
+def _retry_params() -> dict:
+    return {
+        "max_attempts": JOB_MAX_ATTEMPTS,
+        "backoff_base": JOB_BACKOFF_BASE_SECONDS,
+        "backoff_max": JOB_BACKOFF_MAX_SECONDS
+    }
+
+def reap_expired_jobs(db: Session, batch_size: int = None) -> dict:
+    """
+    Returns jobs whose lease (timeout) expired while 'processing' to the pool, in batches
+    committed one at a time so no long lock is held. Each expiry counts as an attempt.
+    Returns {"requeued": n, "failed": n}.
+    """
+    batch_size = batch_size or JOB_REAPER_BATCH_SIZE
+    params = {**_retry_params(), "batch_size": batch_size}
+    result = {"requeued": 0, "failed": 0}
+
+    while True:
+        rows = db.execute(REAP_EXPIRED_SQL, params).all()
+        requeued = sum(1 for row in rows if row.status == "pending")
+        notify_job_events(
+            db,
+            {"processing": -len(rows), "pending": requeued, "error": len(rows) - requeued},
+            [{"id": row.id, "status": row.status} for row in rows]
+        )
+        db.commit()
+        result["requeued"] += requeued
+        result["failed"] += len(rows) - requeued
+        if len(rows) < batch_size:
+            break
+
+    if result["requeued"] or result["failed"]:
+        logger.info(f"Reaper: {result['requeued']} expired jobs requeued, {result['failed']} moved to error.")
+    return result
+
+def fail_job(db: Session, job_id: int, worker_id: Optional[str] = None):
+    """
+    Reports a failed attempt for a job leased by a worker. The job is rescheduled with
+    backoff, or moved to 'error' after JOB_MAX_ATTEMPTS. The caller commits.
+    """
+    job = db.query(Job.id, Job.status, Job.locked_by).filter(Job.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "processing":
+        raise HTTPException(status_code=409, detail="Job não está em processamento.")
+    if worker_id and job.locked_by and job.locked_by != worker_id:
+        raise HTTPException(status_code=409, detail="Job está reservado para outro worker.")
+
+    row = db.execute(FAIL_JOB_SQL, {**_retry_params(), "job_id": job_id, "worker_id": worker_id}).mappings().first()
+    if row is None:
+        # Lease expired and was reaped (and possibly re-claimed) between the check and the update
+        raise HTTPException(status_code=409, detail="Job não está em processamento ou está reservado para outro worker.")
+    notify_job_events(db, {"processing": -1, row.status: 1}, [{"id": row.id, "status": row.status}])
+    return dict(row)
+
+def complete_job(db: Session, job_id: int, guias: List[dict], worker_id: Optional[str] = None, message: Optional[str] = None) -> dict:
+    """
+    Stores the guias scraped for a leased job and marks it 'success' in one transaction:
+    one upsert for all guias (the statement-level PEI trigger recomputes each affected
+    (carteirinha, codigo_terapia) once) and a Log entry. The caller commits.
+    """
+    job = db.query(Job).filter(Job.id == job_id).with_for_update().first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != "processing":
+        raise HTTPException(status_code=409, detail="Job não está em processamento.")
+    if worker_id and job.locked_by and job.locked_by != worker_id:
+        raise HTTPException(status_code=409, detail="Job está reservado para outro worker.")
+
+    added, updated = guia_service.upsert_guias(db, job.carteirinha_id, guias)
+
+    job.status = "success"
+    job.locked_by = None
+    job.timeout = None
+    job.next_attempt_at = None
+    job.updated_at = datetime.utcnow()
+
+    db.add(Log(
+        job_id=job.id,
+        carteirinha_id=job.carteirinha_id,
+        level="INFO",
+        message=message or f"Job concluído: {len(guias)} guias recebidas ({added} novas, {updated} atualizadas)."
+    ))
+    notify_job_events(db, {"processing": -1, "success": 1}, [{"id": job.id, "status": "success"}])
+    if added or updated:
+        pei_stats_service.notify_pei_changed(db)
+
+    return {
+        "id": job.id,
+        "status": job.status,
+        "guias_received": len(guias),
+        "guias_added": added,
+        "guias_updated": updated
+    }
@@ -0,0 +1,234 @@
+import os
+import json
+import asyncio
+import select
+import logging
+import threading
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+from database import SQLALCHEMY_DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+# LISTEN needs a session-level connection, which the Supabase transaction pooler (port 6543)
+# does not provide. Point JOB_NOTIFY_DATABASE_URL at the direct/session connection (port 5432).
+JOB_NOTIFY_DATABASE_URL = os.getenv("JOB_NOTIFY_DATABASE_URL") or SQLALCHEMY_DATABASE_URL
+JOB_NOTIFY_ENABLED = os.getenv("JOB_NOTIFY_ENABLED", "true").lower() == "true"
+
+JOBS_CHANNEL = "jobs_new" # work available (workers)
+JOB_EVENTS_CHANNEL = "job_events" # status transitions and counter deltas (dashboards)
+PEI_CHANNEL = "pei_changed" # patient_pei written (sent by recompute_patient_pei too)
+CHANNELS = (JOBS_CHANNEL, JOB_EVENTS_CHANNEL, PEI_CHANNEL)
+
+
+class Subscription:
+    """Queue of (channel, payload) events for one asyncio consumer."""
+
+    def __init__(self, broadcaster, channels, maxsize: int):
+        self.broadcaster = broadcaster
+        self.channels = set(channels)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Slow consumer: drop instead of growing without bound
+            self.dropped += 1
+
+    async def get(self):
+        return await self.queue.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.broadcaster.unsubscribe(self)
+
+
+class Broadcaster:
+    """
+    In-process fan-out of notifications to asyncio subscribers and plain callbacks.
+    publish() is thread safe, so it can be called from the listener thread, the
+    threadpool or the event loop.
+    """
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._callbacks = {} # channel -> [callback(payload)]
+        self._lock = threading.Lock()
+
+    def add_callback(self, channel: str, callback):
+        """Runs callback(payload) synchronously on every publish (keep it cheap, e.g. cache invalidation)."""
+        with self._lock:
+            self._callbacks.setdefault(channel, []).append(callback)
+
+    def subscribe(self, *channels, maxsize: int = 100) -> Subscription:
+        subscription = Subscription(self, channels, maxsize)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, channel: str, payload=None):
+        with self._lock:
+            targets = [s for s in self._subscriptions if channel in s.channels]
+            callbacks = list(self._callbacks.get(channel, ()))
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.warning(f"Notification callback error on {channel}: {e}")
+        for subscription in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._put, (channel, payload))
+            except RuntimeError:
+                # Event loop already closed
+                self.unsubscribe(subscription)
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscriptions)
+
+
+broadcaster = Broadcaster()
+
+
+def _decode_payload(payload: str):
+    try:
+        return json.loads(payload) if payload else None
+    except ValueError:
+        return payload
+
+
+class PostgresListener:
+    """
+    Background thread holding one dedicated connection that LISTENs on CHANNELS and
+    forwards every notification to the broadcaster. Reconnects with backoff; while it is
+    down, notify() falls back to publishing in-process after commit.
+    """
+
+    def __init__(self, url: str, channels=CHANNELS):
+        self.url = make_url(url)
+        self.channels = channels
+        self.listening = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _dsn(self) -> str:
+        return self.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set():
+            try:
+                if self.url.get_driver_name() == "psycopg2":
+                    self._listen_psycopg2()
+                else:
+                    self._listen_psycopg()
+                delay = 1
+            except Exception as e:
+                logger.warning(f"Notification listener error: {e}")
+            finally:
+                self.listening = False
+            self._stop.wait(delay)
+            delay = min(delay * 2, 60)
+
+    def _on_connected(self):
+        self.listening = True
+        logger.info(f"Notification listener connected: {', '.join(self.channels)}")
+        # Anything sent while disconnected was lost; wake waiters so they re-check
+        for channel in self.channels:
+            broadcaster.publish(channel, {"reconnected": True})
+
+    def _listen_psycopg(self):
+        import psycopg
+
+        with psycopg.connect(self._dsn(), autocommit=True) as conn:
+            for channel in self.channels:
+                conn.execute(f"LISTEN {channel}")
+            self._on_connected()
+            while not self._stop.is_set():
+                for notify in conn.notifies(timeout=5.0):
+                    broadcaster.publish(notify.channel, _decode_payload(notify.payload))
+
+    def _listen_psycopg2(self):
+        import psycopg2
+
+        conn = psycopg2.connect(self._dsn())
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                for channel in self.channels:
+                    cur.execute(f"LISTEN {channel}")
+            self._on_connected()
+            while not self._stop.is_set():
+                if select.select([conn], [], [], 5.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    broadcaster.publish(notify.channel, _decode_payload(notify.payload))
+        finally:
+            conn.close()
+
+
+listener = PostgresListener(JOB_NOTIFY_DATABASE_URL)
+
+
+def start_listener():
+    if JOB_NOTIFY_ENABLED:
+        listener.start()
+
+
+def stop_listener():
+    listener.stop()
+
+
+def notify(db: Session, channel: str, payload: dict = None):
+    """
+    Sends pg_notify(channel, payload) inside the caller's transaction, so it is only
+    delivered if the transaction commits. When this process is not listening, the event
+    is also published in-process after commit so local waiters still wake up.
+    """
+    body = json.dumps(payload or {}, default=str)
+    db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": body})
+    db.info.setdefault("pending_notifications", []).append((channel, payload))
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_after_commit(session):
+    pending = session.info.pop("pending_notifications", None)
+    if pending and not listener.listening:
+        for channel, payload in pending:
+            broadcaster.publish(channel, payload)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_rollback(session):
+    session.info.pop("pending_notifications", None)
+
+
+def stats() -> dict:
+    return {
+        "enabled": JOB_NOTIFY_ENABLED,
+        "listening": listener.listening,
+        "channels": list(listener.channels),
+        "subscribers": broadcaster.subscriber_count()
+    }
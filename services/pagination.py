@@ -0,0 +1,109 @@
+import base64
+import json
+from datetime import date, datetime
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import and_, or_, tuple_, false
+
+# Sort orders are lists of (column, descending). The last column must be unique (the id).
+# NULLs always sort first (ASC NULLS FIRST / DESC NULLS FIRST) so that a row-value
+# comparison against a non-NULL cursor never skips rows; the composite indexes in
+# migrations/0014 are declared with the same ordering.
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"dt": value.isoformat()}
+    if isinstance(value, date):
+        return {"d": value.isoformat()}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if "dt" in value:
+            return datetime.fromisoformat(value["dt"])
+        if "d" in value:
+            return date.fromisoformat(value["d"])
+    return value
+
+def encode_cursor(key: str, values: list) -> str:
+    payload = json.dumps({"k": key, "v": [_encode_value(v) for v in values]}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(key: str, cursor: str, size: int) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        values = [_decode_value(v) for v in payload["v"]]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido.")
+
+    if payload.get("k") != key or len(values) != size:
+        raise HTTPException(status_code=400, detail="Cursor inválido para esta listagem.")
+    return values
+
+def _order_by(order):
+    return [column.desc() if descending else column.asc().nulls_first() for column, descending in order]
+
+def _row_after(order, values):
+    """Rows strictly after values for a run of columns sharing one direction (index friendly)."""
+    descending = order[0][1]
+    columns = [column for column, _ in order]
+    if len(columns) == 1:
+        return columns[0] < values[0] if descending else columns[0] > values[0]
+    return tuple_(*columns) < tuple_(*values) if descending else tuple_(*columns) > tuple_(*values)
+
+def _null_aware_after(order, values):
+    """Expanded (slower) predicate used only when the cursor sits on NULL sort keys."""
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        equal = [order[j][0].is_(None) if values[j] is None else order[j][0] == values[j] for j in range(i)]
+        value = values[i]
+        if value is None:
+            after = column.isnot(None)
+        else:
+            after = column < value if descending else column > value
+        clauses.append(and_(*equal, after))
+    return or_(*clauses) if clauses else false()
+
+def _fetch_after(query, order, full_order, values, count: int):
+    # Split the sort into its first run of columns with the same direction. Mixed
+    # directions (e.g. status ASC, updated_at DESC) become two index range scans:
+    # the rest of the current group, then the groups after it.
+    run = 1
+    while run < len(order) and order[run][1] == order[0][1]:
+        run += 1
+
+    if run == len(order):
+        return query.filter(_row_after(order, values)).order_by(*_order_by(full_order)).limit(count).all()
+
+    group = query.filter(*[column == value for (column, _), value in zip(order[:run], values[:run])])
+    rows = _fetch_after(group, order[run:], full_order, values[run:], count)
+    if len(rows) < count:
+        rows += query.filter(_row_after(order[:run], values[:run]))\
+                     .order_by(*_order_by(full_order)).limit(count - len(rows)).all()
+    return rows
+
+def paginate(query, order: List[Tuple], limit: int, skip: int = 0, cursor: Optional[str] = None, key: str = "") -> Tuple[list, Optional[str]]:
+    """
+    Returns (rows, next_cursor) for query sorted by order.
+    - cursor is None: classic offset pagination (skip/limit), kept for backwards compatibility.
+    - cursor == "": first page in keyset mode.
+    - otherwise: keyset page after the cursor, so deep pages cost the same as the first one.
+    next_cursor is None on the last page.
+    """
+    if cursor:
+        values = decode_cursor(key, cursor, len(order))
+        if any(value is None for value in values):
+            rows = query.filter(_null_aware_after(order, values))\
+                        .order_by(*_order_by(order)).limit(limit + 1).all()
+        else:
+            rows = _fetch_after(query, order, order, values, limit + 1)
+    else:
+        rows = query.order_by(*_order_by(order)).offset(0 if cursor is not None else skip).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(key, [getattr(last, column.key) for column, _ in order])
+    return rows, next_cursor
@@ -0,0 +1,253 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import HTTPException
+from sqlalchemy import text
+from database import SessionLocal
+from services import pei_stats_service
+
+logger = logging.getLogger(__name__)
+
+PEI_REBUILD_WORKERS = int(os.getenv("PEI_REBUILD_WORKERS", "4"))
+PEI_REBUILD_CHUNK_SIZE = int(os.getenv("PEI_REBUILD_CHUNK_SIZE", "5000"))
+MAX_TRACKED_REBUILDS = 50
+WATERMARK_KEY = "pei_rebuild"
+# Extra overlap subtracted from the watermark (re-checking a few already processed pairs is cheap)
+PEI_REBUILD_WATERMARK_MARGIN = int(os.getenv("PEI_REBUILD_WATERMARK_MARGIN", "60"))
+
+REBUILD_MODES = ("full", "incremental")
+
+# The PEI rules live in patient_pei_computed() (migration 0018); change them there and run
+# a full rebuild. Each chunk upserts on the (carteirinha_id, codigo_terapia) key (0022) and
+# writes only rows whose computed values differ, in its own short transaction, so readers
+# and the triggers are never blocked for long.
+WRITE_CHUNK_SQL = """
+WITH pairs AS (
+    {pairs}
+),
+computed AS (
+    SELECT c.*
+    FROM (SELECT ARRAY_AGG(carteirinha_id) AS ids, ARRAY_AGG(codigo_terapia) AS codigos FROM pairs) a,
+         LATERAL patient_pei_computed(a.ids, a.codigos) c
+),
+upserted AS (
+    INSERT INTO patient_pei AS p (carteirinha_id, codigo_terapia, base_guia_id, pei_semanal, validade, status, updated_at)
+    SELECT c.carteirinha_id, c.codigo_terapia, c.base_guia_id, c.pei_semanal, c.validade, c.status, NOW()
+    FROM computed c
+    ON CONFLICT (carteirinha_id, codigo_terapia) DO UPDATE
+    SET base_guia_id = EXCLUDED.base_guia_id,
+        pei_semanal = EXCLUDED.pei_semanal,
+        validade = EXCLUDED.validade,
+        status = EXCLUDED.status,
+        updated_at = NOW()
+    WHERE (p.base_guia_id, p.pei_semanal, p.validade, p.status)
+          IS DISTINCT FROM (EXCLUDED.base_guia_id, EXCLUDED.pei_semanal, EXCLUDED.validade, EXCLUDED.status)
+    RETURNING (xmax = 0) AS inserted
+),
+deleted AS (
+    -- PEI rows left without any guia (orphans)
+    DELETE FROM patient_pei p
+    WHERE {delete_scope}
+      AND NOT EXISTS (
+          SELECT 1 FROM computed c
+          WHERE c.carteirinha_id = p.carteirinha_id AND c.codigo_terapia = p.codigo_terapia
+      )
+    RETURNING 1
+)
+SELECT (SELECT COUNT(*) FROM pairs) AS pairs,
+       (SELECT COUNT(*) FROM upserted WHERE NOT inserted) AS updated,
+       (SELECT COUNT(*) FROM upserted WHERE inserted) AS inserted,
+       (SELECT COUNT(*) FROM deleted) AS deleted
+"""
+
+RANGE_CHUNK_SQL = text(WRITE_CHUNK_SQL.format(
+    pairs="""
+    SELECT DISTINCT carteirinha_id, codigo_terapia
+    FROM base_guias
+    WHERE carteirinha_id >= :lo AND carteirinha_id < :hi AND codigo_terapia IS NOT NULL
+    """,
+    delete_scope="p.carteirinha_id >= :lo AND p.carteirinha_id < :hi"
+))
+
+PAIRS_CHUNK_SQL = text(WRITE_CHUNK_SQL.format(
+    pairs="""
+    SELECT DISTINCT carteirinha_id, codigo_terapia
+    FROM unnest(CAST(:ids AS INTEGER[]), CAST(:codigos AS TEXT[])) AS t(carteirinha_id, codigo_terapia)
+    """,
+    delete_scope="(p.carteirinha_id, p.codigo_terapia) IN (SELECT carteirinha_id, codigo_terapia FROM pairs)"
+))
+
+ID_BOUNDS_SQL = text("""
+SELECT LEAST((SELECT MIN(carteirinha_id) FROM base_guias), (SELECT MIN(carteirinha_id) FROM patient_pei)) AS lo,
+       GREATEST((SELECT MAX(carteirinha_id) FROM base_guias), (SELECT MAX(carteirinha_id) FROM patient_pei)) AS hi
+""")
+
+CHANGED_PAIRS_SQL = text("""
+SELECT DISTINCT carteirinha_id, codigo_terapia
+FROM (
+    SELECT carteirinha_id, codigo_terapia FROM base_guias WHERE updated_at > :since
+    UNION ALL
+    SELECT g.carteirinha_id, g.codigo_terapia
+    FROM pei_temp t JOIN base_guias g ON g.id = t.base_guia_id
+    WHERE t.updated_at > :since
+) changed
+WHERE carteirinha_id IS NOT NULL AND codigo_terapia IS NOT NULL
+""")
+
+_rebuilds = OrderedDict() # rebuild_id -> state dict
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pei-rebuild")
+
+
+def get_watermark(db) -> Optional[datetime]:
+    return db.execute(text("SELECT value FROM maintenance_state WHERE key = :key"), {"key": WATERMARK_KEY}).scalar()
+
+def set_watermark(db, value: datetime):
+    db.execute(text("""
+        INSERT INTO maintenance_state (key, value, updated_at) VALUES (:key, :value, NOW())
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
+    """), {"key": WATERMARK_KEY, "value": value})
+
+def _run_chunk(statement, params: dict) -> dict:
+    db = SessionLocal()
+    try:
+        row = db.execute(statement, params).one()
+        db.commit()
+        return dict(row._mapping)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def _plan_chunks(db, mode: str, chunk_size: int, since: Optional[datetime]):
+    """Returns a list of (statement, params) to run."""
+    if mode == "incremental" and since is not None:
+        pairs = db.execute(CHANGED_PAIRS_SQL, {"since": since}).all()
+        return [
+            (PAIRS_CHUNK_SQL, {
+                "ids": [p.carteirinha_id for p in pairs[i:i + chunk_size]],
+                "codigos": [p.codigo_terapia for p in pairs[i:i + chunk_size]]
+            })
+            for i in range(0, len(pairs), chunk_size)
+        ]
+
+    bounds = db.execute(ID_BOUNDS_SQL).one()
+    if bounds.lo is None:
+        return []
+    return [
+        (RANGE_CHUNK_SQL, {"lo": lo, "hi": lo + chunk_size})
+        for lo in range(bounds.lo, bounds.hi + 1, chunk_size)
+    ]
+
+def rebuild_pei(mode: str = "full", workers: int = None, chunk_size: int = None, state: dict = None) -> dict:
+    """
+    Recomputes patient_pei from base_guias/pei_temp.
+    - full: every carteirinha id range (chunk_size ids per chunk), also deleting orphan rows.
+    - incremental: only (carteirinha, codigo_terapia) pairs whose guias or overrides changed
+      since the last successful run (falls back to full when there is no watermark).
+    Chunks run in parallel on `workers` threads, each in its own transaction.
+    """
+    if mode not in REBUILD_MODES:
+        raise HTTPException(status_code=400, detail=f"Modo inválido. Use: {', '.join(REBUILD_MODES)}.")
+
+    workers = workers or PEI_REBUILD_WORKERS
+    chunk_size = chunk_size or PEI_REBUILD_CHUNK_SIZE
+    state = state if state is not None else {}
+    for key in ("chunks_done", "pairs", "updated", "inserted", "deleted"):
+        state[key] = 0
+
+    db = SessionLocal()
+    try:
+        # updated_at is the writing transaction's start time, so a transaction still in flight
+        # now may commit rows older than NOW() that this run does not see. The next incremental
+        # run starts from the oldest open transaction (minus a margin) so it picks them up.
+        started_at = db.execute(text("""
+            SELECT LEAST(NOW(), MIN(xact_start)) - make_interval(secs => :margin)
+            FROM pg_stat_activity WHERE xact_start IS NOT NULL
+        """), {"margin": PEI_REBUILD_WATERMARK_MARGIN}).scalar()
+        since = get_watermark(db) if mode == "incremental" else None
+        chunks = _plan_chunks(db, mode, chunk_size, since)
+        db.rollback()
+    finally:
+        db.close()
+
+    state["since"] = since
+    state["chunks"] = len(chunks)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pei-rebuild-chunk") as pool:
+        for result in pool.map(lambda chunk: _run_chunk(*chunk), chunks):
+            state["chunks_done"] += 1
+            for key in ("pairs", "updated", "inserted", "deleted"):
+                state[key] += result[key]
+
+    db = SessionLocal()
+    try:
+        set_watermark(db, started_at)
+        if state["updated"] or state["inserted"] or state["deleted"]:
+            pei_stats_service.notify_pei_changed(db)
+        db.commit()
+    finally:
+        db.close()
+
+    logger.info(f"PEI rebuild ({mode}): {state['chunks']} chunks, {state['pairs']} pairs, "
+                f"{state['updated']} updated, {state['inserted']} inserted, {state['deleted']} deleted.")
+    return state
+
+def start_rebuild(mode: str) -> str:
+    """Queues a background rebuild. Only one rebuild runs at a time."""
+    if mode not in REBUILD_MODES:
+        raise HTTPException(status_code=400, detail=f"Modo inválido. Use: {', '.join(REBUILD_MODES)}.")
+
+    with _lock:
+        if any(r["status"] in ("queued", "running") for r in _rebuilds.values()):
+            raise HTTPException(status_code=409, detail="Já existe uma reconstrução de PEI em andamento.")
+
+        rebuild_id = uuid.uuid4().hex
+        _rebuilds[rebuild_id] = {
+            "id": rebuild_id,
+            "mode": mode,
+            "status": "queued", # queued, running, completed, failed
+            "error": None,
+            "created_at": datetime.now(timezone.utc),
+            "finished_at": None
+        }
+        while len(_rebuilds) > MAX_TRACKED_REBUILDS:
+            _rebuilds.popitem(last=False)
+
+    _executor.submit(_run_rebuild, rebuild_id)
+    return rebuild_id
+
+def get_rebuild(rebuild_id: str):
+    with _lock:
+        state = _rebuilds.get(rebuild_id)
+        if state is None:
+            return None
+        snapshot = dict(state)
+
+    started = snapshot.pop("_started_monotonic", None)
+    finished = snapshot.pop("_finished_monotonic", None)
+    snapshot["elapsed_seconds"] = round(((finished or time.monotonic()) - started), 2) if started else 0.0
+    return snapshot
+
+def _run_rebuild(rebuild_id: str):
+    with _lock:
+        state = _rebuilds[rebuild_id]
+    state["status"] = "running"
+    state["_started_monotonic"] = time.monotonic()
+    try:
+        rebuild_pei(state["mode"], state=state)
+        state["status"] = "completed"
+    except Exception as e:
+        logger.exception(f"PEI rebuild {rebuild_id} failed")
+        state["error"] = str(e)
+        state["status"] = "failed"
+    finally:
+        state["finished_at"] = datetime.now(timezone.utc)
+        state["_finished_monotonic"] = time.monotonic()
@@ -0,0 +1,75 @@
+import os
+import threading
+from datetime import date, timedelta
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from services.cache import TTLCache
+from services import notifier
+
+PEI_STATS_CACHE_TTL = float(os.getenv("PEI_STATS_CACHE_TTL", "60"))
+
+pei_stats_cache = TTLCache(maxsize=4, ttl=PEI_STATS_CACHE_TTL)
+_refresh_lock = threading.Lock()
+
+# All dashboard buckets in one pass over patient_pei: the () grouping set is the overall
+# row, the (codigo_terapia) set gives the same buckets per therapy.
+STATS_SQL = text("""
+SELECT
+    GROUPING(codigo_terapia) = 1 AS overall,
+    codigo_terapia,
+    COUNT(*) AS total,
+    COUNT(*) FILTER (WHERE validade < :today) AS vencidos,
+    COUNT(*) FILTER (WHERE validade >= :today AND validade <= :d7_end) AS vence_d7,
+    COUNT(*) FILTER (WHERE validade >= :today AND validade <= :d30_end) AS vence_d30,
+    COUNT(*) FILTER (WHERE status = 'Pendente') AS pendentes,
+    COUNT(*) FILTER (WHERE status = 'Validado') AS validados
+FROM patient_pei
+GROUP BY GROUPING SETS ((), (codigo_terapia))
+ORDER BY overall DESC, codigo_terapia
+""")
+
+BUCKETS = ("total", "vencidos", "vence_d7", "vence_d30", "pendentes", "validados")
+
+def compute_pei_stats(db: Session, today: date) -> dict:
+    rows = db.execute(STATS_SQL, {
+        "today": today,
+        "d7_end": today + timedelta(days=7),
+        "d30_end": today + timedelta(days=30)
+    }).all()
+
+    stats = {bucket: 0 for bucket in BUCKETS}
+    por_terapia = []
+    for row in rows:
+        buckets = {bucket: getattr(row, bucket) for bucket in BUCKETS}
+        if row.overall:
+            stats.update(buckets)
+        else:
+            por_terapia.append({"codigo_terapia": row.codigo_terapia, **buckets})
+    stats["por_terapia"] = por_terapia
+    return stats
+
+def get_pei_stats(db: Session) -> dict:
+    """
+    Dashboard buckets, cached for PEI_STATS_CACHE_TTL seconds and dropped whenever
+    patient_pei is written (pei_changed notification). Concurrent misses share one query.
+    """
+    today = date.today() # buckets are relative to today, so the date is part of the key
+    stats = pei_stats_cache.get(today)
+    if stats is not None:
+        return stats
+
+    with _refresh_lock:
+        stats = pei_stats_cache.get(today)
+        if stats is None:
+            stats = compute_pei_stats(db, today)
+            pei_stats_cache.set(today, stats)
+    return stats
+
+def invalidate_pei_stats(payload=None):
+    pei_stats_cache.clear()
+
+def notify_pei_changed(db: Session):
+    """Drops cached PEI aggregates in every API process once the transaction commits."""
+    notifier.notify(db, notifier.PEI_CHANNEL)
+
+notifier.broadcaster.add_callback(notifier.PEI_CHANNEL, invalidate_pei_stats)
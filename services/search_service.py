@@ -0,0 +1,54 @@
+import re
+from sqlalchemy import or_, cast, false, Text
+from models import Carteirinha, PatientPei
+
+# Carteirinha-shaped or numeric input: digits plus the usual separators (0064.8000.400948.00-5)
+IDENTIFIER_PATTERN = re.compile(r"^[\d.\-/\s]+$")
+
+def _escape_like(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def is_identifier_search(term: str) -> bool:
+    return bool(IDENTIFIER_PATTERN.match(term)) and any(ch.isdigit() for ch in term)
+
+def build_search_clause(term: str, text_columns, prefix_columns):
+    """
+    Builds the WHERE clause for a free-text search box.
+    - Carteirinha-shaped / numeric input: digit-only prefix match (LIKE 'digits%') on
+      prefix_columns, served by the text_pattern_ops B-tree indexes (migrations/0013).
+    - Anything else: ILIKE '%term%' on text_columns, served by the pg_trgm GIN indexes.
+    """
+    term = term.strip()
+    if is_identifier_search(term):
+        prefix = _escape_like(re.sub(r"\D", "", term)) + "%"
+        return or_(*[column.like(prefix, escape="\\") for column in prefix_columns])
+
+    pattern = "%" + _escape_like(term) + "%"
+    return or_(*[column.ilike(pattern, escape="\\") for column in text_columns])
+
+def carteirinha_search(term: str):
+    return build_search_clause(
+        term,
+        text_columns=[Carteirinha.paciente, Carteirinha.carteirinha],
+        prefix_columns=[
+            Carteirinha.carteirinha_digits,
+            cast(Carteirinha.id_paciente, Text),
+            cast(Carteirinha.id_pagamento, Text)
+        ]
+    )
+
+def pei_search(term: str):
+    # Used together with a join on Carteirinha
+    return build_search_clause(
+        term,
+        text_columns=[Carteirinha.paciente, Carteirinha.carteirinha, PatientPei.codigo_terapia],
+        prefix_columns=[Carteirinha.carteirinha_digits, PatientPei.codigo_terapia]
+    )
+
+def id_prefix_filter(column, value: str):
+    """Prefix filter on an integer id column (uses the (col::text) text_pattern_ops index)."""
+    digits = re.sub(r"\D", "", value)
+    if not digits:
+        # No digits can never match an integer id (an empty prefix would match every row)
+        return false()
+    return cast(column, Text).like(_escape_like(digits) + "%", escape="\\")
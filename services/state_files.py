@@ -0,0 +1,152 @@
+import os
+import re
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Ids are generated with uuid4().hex; anything else (e.g. "../x" from a URL) is rejected
+_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# Every process that saves state touches <directory>/<WORKER_ID>.worker this often. A queued
+# or running task whose worker has not done so for INTERRUPTED_AFTER_SECONDS will never
+# finish (the process died or restarted); a task still waiting in a live worker's queue
+# is not affected, however long it waits.
+WORKER_ID = uuid.uuid4().hex
+HEARTBEAT_SECONDS = 30
+INTERRUPTED_AFTER_SECONDS = 120
+
+_heartbeat_dirs = set()
+_heartbeat_lock = threading.Lock()
+
+
+def valid_id(state_id: str) -> bool:
+    return bool(_ID_PATTERN.match(state_id or ""))
+
+def state_path(directory: str, state_id: str) -> str:
+    return os.path.join(directory, f"{state_id}.json")
+
+def save_state(directory: str, state: dict):
+    """
+    Writes the public fields of a background task's state (keys not starting with "_") to
+    <directory>/<id>.json, atomically, so any worker process sharing the directory can
+    answer status and download requests for it.
+    """
+    _start_heartbeat(directory)
+    public = public_fields(state)
+    public["_worker"] = WORKER_ID
+    path = state_path(directory, state["id"])
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(tmp_path, "wb") as out:
+            out.write(orjson.dumps(public, default=str))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not save state {state['id']}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def public_fields(state: dict) -> dict:
+    return {k: v for k, v in state.items() if not k.startswith("_")}
+
+def load_state(directory: str, state_id: str) -> Optional[dict]:
+    """
+    The saved state, None if unknown. Includes "_worker" (the process that owns it) and
+    "_saved_at" (epoch seconds of the last save); see is_interrupted() and public_fields().
+    """
+    if not valid_id(state_id):
+        return None
+    path = state_path(directory, state_id)
+    try:
+        with open(path, "rb") as f:
+            state = orjson.loads(f.read())
+            state["_saved_at"] = os.fstat(f.fileno()).st_mtime
+    except (OSError, ValueError):
+        return None
+    return state
+
+def is_interrupted(directory: str, state: dict) -> bool:
+    """True for a loaded queued/running state whose owning worker process stopped its heartbeat."""
+    if state["status"] not in ("queued", "running"):
+        return False
+    worker = state.get("_worker")
+    if not worker:
+        last_seen = state["_saved_at"] # Saved before workers were recorded
+    else:
+        try:
+            last_seen = os.path.getmtime(_heartbeat_path(directory, worker))
+        except OSError:
+            return True
+    return time.time() - last_seen > INTERRUPTED_AFTER_SECONDS
+
+def _heartbeat_path(directory: str, worker: str) -> str:
+    return os.path.join(directory, f"{worker}.worker")
+
+def _touch_heartbeats():
+    with _heartbeat_lock:
+        directories = list(_heartbeat_dirs)
+    for directory in directories:
+        try:
+            with open(_heartbeat_path(directory, WORKER_ID), "a"):
+                pass
+            os.utime(_heartbeat_path(directory, WORKER_ID))
+        except OSError as e:
+            logger.warning(f"Heartbeat in {directory} failed: {e}")
+
+def _heartbeat_loop():
+    while True:
+        _touch_heartbeats()
+        time.sleep(HEARTBEAT_SECONDS)
+
+def _start_heartbeat(directory: str):
+    with _heartbeat_lock:
+        if directory in _heartbeat_dirs:
+            return
+        first = not _heartbeat_dirs
+        _heartbeat_dirs.add(directory)
+    os.makedirs(directory, exist_ok=True)
+    if first:
+        threading.Thread(target=_heartbeat_loop, name="state-heartbeat", daemon=True).start()
+    else:
+        _touch_heartbeats()
+
+def cleanup_expired(directory: str, ttl_seconds: float):
+    """
+    Deletes every file of the tasks whose state was last saved more than ttl_seconds ago.
+    Files are grouped by id (the name up to the first dot); files without a state file
+    expire by their own mtime.
+    """
+    cutoff = time.time() - ttl_seconds
+    try:
+        entries = [(entry.name, entry.path, entry.stat().st_mtime) for entry in os.scandir(directory)]
+    except OSError:
+        return
+
+    saved_at = {name[:-len(".json")]: mtime for name, _, mtime in entries if name.endswith(".json")}
+    for name, path, mtime in entries:
+        if saved_at.get(name.split(".", 1)[0], mtime) >= cutoff:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass # Removed by another worker process
+
+def elapsed_seconds(state: dict) -> float:
+    """Seconds between started_at and finished_at (or now), from live or loaded state."""
+    started = state.get("started_at")
+    if not started:
+        return 0.0
+    if isinstance(started, str):
+        started = datetime.fromisoformat(started)
+    finished = state.get("finished_at") or datetime.now(timezone.utc)
+    if isinstance(finished, str):
+        finished = datetime.fromisoformat(finished)
+    return (finished - started).total_seconds()